@@ -22,27 +22,112 @@ load_dotenv()
 import os
 import re
 import json
+import time
+import fcntl
 import asyncio
-import requests
+import threading
 from datetime import datetime
 
-from anthropic import Anthropic
-from anthropic import BadRequestError
+# --------------------------------------------------------------------------------
+# Provider clients, built on first use and keyed by model name prefix. The SDKs
+# are imported by the factories, so importing this module (and the orchestrator
+# and server behind it) costs milliseconds and needs no keys or network. A
+# provider that is never called is never imported.
+# --------------------------------------------------------------------------------
 
-from tavily import TavilyClient
 
-from openai import OpenAI
+class ProviderRegistry:
 
-import google.generativeai as genai
+    def __init__(self):
+        self.prefixes = {}
+        self.factories = {}
+        self.closers = {}
+        self.clients = {}
+        self._lock = threading.Lock()
 
-# --------------------------------------------------------------------------------
-# Instantiate the clients for the various LLMs
-# --------------------------------------------------------------------------------
+    def register(self, name: str, factory, prefixes: tuple = (), close=None, aclose=None):
+        self.factories[name] = factory
+        self.closers[name] = (close, aclose)
+        for prefix in prefixes:
+            self.prefixes[prefix] = name
+
+    def provider_for(self, model_name: str):
+        # longest prefix wins, igpt-4-turbo is igpt and not gpt
+        for prefix in sorted(self.prefixes, key=len, reverse=True):
+            if model_name.startswith(prefix):
+                return self.prefixes[prefix]
+        raise ValueError(f"Unsupported model: {model_name}")
+
+    def client(self, name: str):
+        client = self.clients.get(name)
+        if client is None:
+            with self._lock:
+                client = self.clients.get(name)
+                if client is None:
+                    client = self.clients[name] = self.factories[name]()
+        return client
+
+    def client_for(self, model_name: str):
+        return self.client(self.provider_for(model_name))
+
+    def warm(self):
+        '''
+        Build every client that has its credentials and SDK, worker processes
+        call this so the first run doesn't pay for the SDK imports
+        '''
+        for name in self.factories:
+            try:
+                self.client(name)
+            except (KeyError, ImportError):
+                pass
+        return sorted(self.clients)
+
+    def close(self):
+        for name, client in list(self.clients.items()):
+            close, _ = self.closers[name]
+            if close is not None:
+                close(client)
+
+    async def aclose(self):
+        for name, client in list(self.clients.items()):
+            _, aclose = self.closers[name]
+            if aclose is not None:
+                await aclose(client)
+
+
+def anthropic_factory():
+    from anthropic import AsyncAnthropic
+    return AsyncAnthropic(api_key=os.environ["ANTHROPIC_API_KEY"])
 
-openai_client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
-anthropic_client = Anthropic(api_key=os.environ["ANTHROPIC_API_KEY"])
-tavily_client = TavilyClient(api_key=os.environ["TAVILY_API_KEY"])
-genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
+
+def gemini_factory():
+    import google.generativeai as genai
+    genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
+    return genai
+
+
+def openai_factory():
+    from openai import OpenAI
+    return OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+
+
+def tavily_factory():
+    from tavily import TavilyClient
+    return TavilyClient(api_key=os.environ["TAVILY_API_KEY"],
+                        api_base_url=os.environ.get("TAVILY_API_URL"))
+
+
+def igpt_factory():
+    return iGPT(os.environ['IGPT_KEY'], os.environ['IGPT_SECRET'])
+
+
+providers = ProviderRegistry()
+providers.register("anthropic", anthropic_factory, prefixes=("claude",))
+providers.register("gemini", gemini_factory, prefixes=("gemini",))
+providers.register("igpt", igpt_factory, prefixes=("igpt",),
+                   close=lambda client: client.close(), aclose=lambda client: client.aclose())
+providers.register("openai", openai_factory, prefixes=("gpt",))
+providers.register("tavily", tavily_factory)
 
 # --------------------------------------------------------------------------------
 # Safety settings for ggl
@@ -68,15 +153,77 @@ ggl_safety_settings = [
     },
 ]
 
+# --------------------------------------------------------------------------------
+# Bearer token cache for igpt, shared by every process on the host through a
+# json file. The file lock makes the refresh single-flight across processes,
+# the client's own locks make it single-flight across threads and tasks.
+# --------------------------------------------------------------------------------
+
+IGPT_TOKEN_CACHE = os.environ.get('IGPT_TOKEN_CACHE', 'cache/igpt_token.json')
+IGPT_TOKEN_MARGIN = float(os.environ.get('IGPT_TOKEN_MARGIN', 120))
+IGPT_TOKEN_TTL = float(os.environ.get('IGPT_TOKEN_TTL', 3600))
+
+class TokenCache:
+
+    def __init__(self, path: str = IGPT_TOKEN_CACHE, margin: float = IGPT_TOKEN_MARGIN):
+        self.path = path
+        self.margin = margin
+
+    def fresh(self, expires_at: float):
+        return time.time() < expires_at - self.margin
+
+    def acquire(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        lock_fd = os.open(f"{self.path}.lock", os.O_CREAT | os.O_RDWR, 0o600)
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        return lock_fd
+
+    def release(self, lock_fd: int):
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        os.close(lock_fd)
+
+    def load(self, key: str, rejected: str = None):
+        '''
+        The cached token of key, rejected is a token the gateway already
+        refused so it is skipped even if its expiry says it is still fresh
+        '''
+        try:
+            with open(self.path) as fid:
+                cached = json.load(fid)
+        except (OSError, ValueError):
+            return None, 0
+        if cached.get('client_id') != key or not self.fresh(cached.get('expires_at', 0)):
+            return None, 0
+        if rejected is not None and cached.get('access_token') == rejected:
+            return None, 0
+        return cached['access_token'], cached['expires_at']
+
+    def store(self, key: str, token: str, expires_at: float):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as fid:
+            json.dump({'client_id': key, 'access_token': token, 'expires_at': expires_at}, fid)
+        os.replace(tmp_path, self.path)
+
 # --------------------------------------------------------------------------------
 # Client for igpt since it doesn't exist
-# TODO: cache the token
+# One client is shared per process, it holds a keep-alive connection pool for
+# the blocking calls (requests) and one per event loop for the async calls
+# (aiohttp) so the gateway handshake is only paid once per connection.
+# Connection errors and 5xx answers are retried with exponential backoff, a
+# read timeout is not since the gateway may still be generating. A 429 goes
+# straight back to the caller so the shared rate limiter backs off for it.
 # --------------------------------------------------------------------------------
 
-IGPT_KEY = os.environ['IGPT_KEY']
-IGPT_SECRET = os.environ['IGPT_SECRET']
-IGPT_AUTH_URI = os.environ['IGPT_AUTH_URI']
-IGPT_INF_URI = os.environ['IGPT_INF_URI']
+IGPT_AUTH_URI = os.environ.get('IGPT_AUTH_URI')
+IGPT_INF_URI = os.environ.get('IGPT_INF_URI')
+IGPT_POOL_SIZE = int(os.environ.get('IGPT_POOL_SIZE', 16))
+IGPT_CONNECT_TIMEOUT = float(os.environ.get('IGPT_CONNECT_TIMEOUT', 10))
+IGPT_READ_TIMEOUT = float(os.environ.get('IGPT_READ_TIMEOUT', 600))
+IGPT_RETRIES = int(os.environ.get('IGPT_RETRIES', 3))
+IGPT_BACKOFF = float(os.environ.get('IGPT_BACKOFF', 0.5))
+IGPT_RETRY_STATUS = (500, 502, 503, 504)
 
 class iGPT:
 
@@ -86,37 +233,168 @@ class iGPT:
                  top_p: float = 0.85,
                  frequency_penalty: float = 0,
                  presence_penalty: float = 0,
-                 max_tokens: int = 4096):
-        headers = {"Content-Type": "application/x-www-form-urlencoded"}
-        data = {'grant_type': 'client_credentials',
-                'client_id': key, 'client_secret': secret}
-        response = requests.post(IGPT_AUTH_URI, headers=headers, data=data)
-        if response.status_code == 200:
-            self._token = json.loads(response.content)['access_token']
-        else:
-            raise ValueError(f"Can't get the auth token  {response.status_code}: {response.text}")
-
+                 max_tokens: int = 4096,
+                 pool_size: int = IGPT_POOL_SIZE,
+                 connect_timeout: float = IGPT_CONNECT_TIMEOUT,
+                 read_timeout: float = IGPT_READ_TIMEOUT,
+                 retries: int = IGPT_RETRIES,
+                 backoff: float = IGPT_BACKOFF,
+                 token_cache: TokenCache = None):
+        self.key = key
+        self.secret = secret
         self.model = model
         self.temperature = temperature
         self.top_p = top_p
         self.frequency_penalty = frequency_penalty
         self.presence_penalty = presence_penalty
         self.max_tokens = max_tokens
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
 
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=Retry(total=retries, connect=retries, read=0,
+                                                status=retries, status_forcelist=IGPT_RETRY_STATUS,
+                                                allowed_methods=None, raise_on_status=False,
+                                                backoff_factor=backoff))
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._async_session = None
+        self._async_loop = None
 
-    def generate(self, conversation: list[dict], correlationId: str = "iGPT design agents", ):
-        '''
-        [
-            {
-            "role": "system",
-            "content": "Summarize everything to as few words as possible."
-            },
-            {
-            "role": "user",
-            "content": "Tell me a story about Little Red Riding Hood"
-            }
-        ]
-        '''
+        # the token is fetched on first use, not at construction
+        self.token_cache = token_cache or TokenCache()
+        self._token = None
+        self._expires_at = 0
+        self._rejected = None
+        self._lock = threading.Lock()
+        self._async_lock = None
+
+
+    def _asession(self):
+        import aiohttp
+        # aiohttp sessions are bound to the loop they were created on
+        loop = asyncio.get_running_loop()
+        if self._async_session is None or self._async_session.closed or self._async_loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.pool_size)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout,
+                                            sock_read=self.read_timeout)
+            self._async_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._async_lock = asyncio.Lock()
+            self._async_loop = loop
+        return self._async_session
+
+
+    async def _apost(self, url: str, **kwargs):
+        import aiohttp
+        for idx_try in range(self.retries + 1):
+            try:
+                async with self._asession().post(url, **kwargs) as response:
+                    content = await response.read()
+                    if response.status not in IGPT_RETRY_STATUS or idx_try >= self.retries:
+                        return response.status, content
+            except (aiohttp.ClientConnectorError, aiohttp.ServerDisconnectedError):
+                if idx_try >= self.retries:
+                    raise
+            await asyncio.sleep(self.backoff * 2 ** idx_try)
+
+
+    def close(self):
+        self._session.close()
+
+
+    async def aclose(self):
+        if self._async_session is not None and not self._async_session.closed:
+            await self._async_session.close()
+        self._async_session = None
+        self._async_loop = None
+
+
+    def _auth_request(self):
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        data = {'grant_type': 'client_credentials',
+                'client_id': self.key, 'client_secret': self.secret}
+        return headers, data
+
+
+    def _set_token(self, content: bytes):
+        auth = json.loads(content)
+        self._token = auth['access_token']
+        self._expires_at = time.time() + float(auth.get('expires_in', IGPT_TOKEN_TTL))
+        self.token_cache.store(self.key, self._token, self._expires_at)
+
+
+    def _load_token(self):
+        token, expires_at = self.token_cache.load(self.key, rejected=self._rejected)
+        if token is not None:
+            self._token, self._expires_at = token, expires_at
+        return token is not None
+
+
+    def authenticate(self):
+        headers, data = self._auth_request()
+        response = self._session.post(IGPT_AUTH_URI, headers=headers, data=data,
+                                      timeout=(self.connect_timeout, self.read_timeout))
+        if response.status_code == 200:
+            self._set_token(response.content)
+        else:
+            raise ValueError(f"Can't get the auth token  {response.status_code}: {response.text}")
+
+
+    async def aauthenticate(self):
+        headers, data = self._auth_request()
+        status, content = await self._apost(IGPT_AUTH_URI, headers=headers, data=data)
+        if status == 200:
+            self._set_token(content)
+        else:
+            raise ValueError(f"Can't get the auth token  {status}: {content.decode()}")
+
+
+    def get_token(self):
+        if self.token_cache.fresh(self._expires_at):
+            return self._token
+        with self._lock:
+            if not self.token_cache.fresh(self._expires_at):
+                lock_fd = self.token_cache.acquire()
+                try:
+                    if not self._load_token():
+                        self.authenticate()
+                finally:
+                    self.token_cache.release(lock_fd)
+        return self._token
+
+
+    async def aget_token(self):
+        if self.token_cache.fresh(self._expires_at):
+            return self._token
+        self._asession()
+        async with self._async_lock:
+            if not self.token_cache.fresh(self._expires_at):
+                lock_fd = await asyncio.to_thread(self.token_cache.acquire)
+                try:
+                    if not self._load_token():
+                        await self.aauthenticate()
+                finally:
+                    self.token_cache.release(lock_fd)
+        return self._token
+
+
+    def expire_token(self, token: str):
+        # only drop the token that failed, another caller may have refreshed it,
+        # and remember it so the copy in the token cache is not loaded again
+        self._rejected = token
+        if self._token == token:
+            self._expires_at = 0
+
+
+    def _inference_request(self, conversation: list[dict], correlationId: str, token: str,
+                           max_tokens: int = None):
         prompt = {
             "correlationId": correlationId,
             "options": {
@@ -124,20 +402,63 @@ class iGPT:
                 "top_P": self.top_p,
                 "frequency_Penalty": self.frequency_penalty,
                 "presence_Penalty": self.presence_penalty,
-                "max_Tokens": self.max_tokens,
+                "max_Tokens": max_tokens or self.max_tokens,
                 "model": self.model,
             },
             "conversation": conversation
         }
 
-        headers = {"Authorization": f"Bearer {self._token}",
-                   "Content-Type": "application/json"} 
-        response = requests.post(IGPT_INF_URI, headers=headers, data=json.dumps(prompt))
+        headers = {"Authorization": f"Bearer {token}",
+                   "Content-Type": "application/json"}
+        return headers, json.dumps(prompt)
+
+
+    def generate(self, conversation: list[dict], correlationId: str = "iGPT design agents",
+                 max_tokens: int = None):
+        '''
+        [
+            {
+            "role": "system",
+            "content": "Summarize everything to as few words as possible."
+            },
+            {
+            "role": "user",
+            "content": "Tell me a story about Little Red Riding Hood"
+            }
+        ]
+        '''
+        for idx_try in range(2):
+            token = self.get_token()
+            headers, data = self._inference_request(conversation, correlationId, token, max_tokens)
+            response = self._session.post(IGPT_INF_URI, headers=headers, data=data,
+                                          timeout=(self.connect_timeout, self.read_timeout))
+            if "Token has expired" not in response.text:
+                break
+            self.expire_token(token)
         if response.status_code == 200:
             return json.loads(response.content)
         else:
             return f"iGPT Generate Error  {response.status_code}: {response.text}"
 
+
+    async def agenerate(self, conversation: list[dict], correlationId: str = "iGPT design agents",
+                        max_tokens: int = None):
+        '''
+        Same as generate but through aiohttp so it can run on the event loop,
+        max_tokens overrides the client's for this request only
+        '''
+        for idx_try in range(2):
+            token = await self.aget_token()
+            headers, data = self._inference_request(conversation, correlationId, token, max_tokens)
+            status, content = await self._apost(IGPT_INF_URI, headers=headers, data=data)
+            if b"Token has expired" not in content:
+                break
+            self.expire_token(token)
+        if status == 200:
+            return json.loads(content)
+        else:
+            return f"iGPT Generate Error  {status}: {content.decode()}"
+
 # --------------------------------------------------------------------------------
 # Done :)
 # --------------------------------------------------------------------------------
@@ -0,0 +1,173 @@
+# --------------------------------------------------------------------------------
+# File : artifacts.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Append only store of the files a run has generated.
+# Purp : The project zip used to be built once at the end of the run, so a
+#        crash in the last refiner call lost every file, and truncated refiner
+#        replies rebuilt the whole zip on every continuation. Each file is now
+#        committed to the run's store the moment it is generated, partial
+#        archives can be downloaded mid-run and the final archive is written
+#        from the store. The store does blocking file IO (fsync, zip), the
+#        orchestrator calls it through asyncio.to_thread.
+# --------------------------------------------------------------------------------
+
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import zipfile
+import threading
+
+
+ARTIFACT_DIR = os.environ.get('ARTIFACT_DIR', './output/artifacts')
+
+RUN_ID = re.compile(r'^[0-9A-Za-z_-]+$')
+
+
+class ArtifactStore:
+    '''
+    One directory per run, blobs/ holds every version of every file and
+    manifest.jsonl one line per commit. The last commit of a name wins.
+    The manifest is read once per instance, commits through the instance
+    keep its index up to date.
+    '''
+
+    def __init__(self, run_id: str, root: str = ARTIFACT_DIR):
+        if not RUN_ID.match(str(run_id)):
+            raise ValueError(f"Invalid run id: {run_id!r}")
+        self.run_id = str(run_id)
+        self.path = os.path.join(root, self.run_id)
+        self.blobs = os.path.join(self.path, "blobs")
+        self.manifest = os.path.join(self.path, "manifest.jsonl")
+        self.index = None
+        # the concurrently refined files commit from several threads
+        self.lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.manifest)
+
+    def entries(self):
+        '''
+        {name: entry} of the latest commit of each name, in first commit order
+        '''
+        with self.lock:
+            if self.index is None:
+                self.index = self.read_manifest()
+            return dict(self.index)
+
+    def read_manifest(self):
+        entries = {}
+        try:
+            with open(self.manifest, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a commit torn by a crash, the blob is there but it never happened
+                        break
+                    entries[entry["name"]] = entry
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def blob_path(self, entry: dict):
+        return os.path.join(self.blobs, entry["blob"])
+
+    def put(self, name: str, data):
+        '''
+        Commit a version of name, data is str or bytes-like. Returns the
+        manifest entry, or None when the content didn't change.
+        '''
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        sha256 = hashlib.sha256(data).hexdigest()
+        self.entries()
+        with self.lock:
+            return self.commit(name, data, sha256)
+
+    def commit(self, name: str, data: bytes, sha256: str):
+        latest = self.index.get(name)
+        if latest is not None and latest["sha256"] == sha256:
+            return None
+
+        # the blob is durable before the manifest line that points at it
+        os.makedirs(self.blobs, exist_ok=True)
+        blob = uuid.uuid4().hex
+        with open(os.path.join(self.blobs, blob), "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        entry = {"name": name, "blob": blob, "size": len(data), "sha256": sha256, "time": time.time()}
+        with open(self.manifest, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.index[name] = entry
+        return entry
+
+    def write_zip(self, path: str, names: list[str] = None, extras: dict = None):
+        '''
+        Write the latest version of names (all when None) and the extras
+        {name: str or bytes-like} to a zip at path, the files are streamed
+        from their blobs
+        '''
+        entries = self.entries()
+        if names is None:
+            names = list(entries)
+        tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED, False) as zip_file:
+            for name in names:
+                if name in entries:
+                    zip_file.write(self.blob_path(entries[name]), name)
+            for name, data in (extras or {}).items():
+                if isinstance(data, str):
+                    zip_file.writestr(name, data)
+                else:
+                    with zip_file.open(name, "w") as fp:
+                        fp.write(data)
+        os.replace(tmp, path)
+        return path
+
+    def partial_zip(self):
+        '''
+        Archive of everything committed so far, rebuilt only when there are
+        new commits
+        '''
+        path = os.path.join(self.path, f"{self.run_id}_partial.zip")
+        try:
+            if os.stat(path).st_mtime >= os.stat(self.manifest).st_mtime:
+                return path
+        except FileNotFoundError:
+            pass
+        return self.write_zip(path)
+
+    def discard(self):
+        with self.lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.index = {}
+        drop_store(self.run_id)
+
+
+# the stores of the runs in this process, so the index is only built once
+stores = {}
+
+
+def artifact_store(run_id: str):
+    store = stores.get(str(run_id))
+    if store is None:
+        store = stores[str(run_id)] = ArtifactStore(run_id)
+    return store
+
+
+def drop_store(run_id: str):
+    stores.pop(str(run_id), None)
+
+
+# --------------------------------------------------------------------------------
+# Done :)
+# --------------------------------------------------------------------------------
@@ -0,0 +1,458 @@
+# --------------------------------------------------------------------------------
+# File : mock_providers.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Local stand-ins for the Anthropic, Gemini, iGPT and Tavily APIs.
+# Purp : The benchmarks run the real clients against these endpoints instead
+#        of the providers, so they are free, offline and repeatable. Each
+#        provider has its own behaviour (latency distribution, streaming
+#        speed, reply sizes, truncation and 429 rates), set through
+#        /mock/behaviour while the server runs. Replies are shaped like the
+#        loop expects them, subtask text, a folder structure for the refiner,
+#        file contents, and a continuation picks up where the prefill stops.
+#
+#        python -m bench.mock_providers --port 8765
+# --------------------------------------------------------------------------------
+
+import re
+import json
+import math
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import threading
+
+from pydantic import BaseModel
+from fastapi import FastAPI, Request
+from starlette.responses import JSONResponse, StreamingResponse, PlainTextResponse
+import uvicorn
+
+
+MOCK_HOST = "127.0.0.1"
+PROVIDERS = ("anthropic", "gemini", "igpt", "tavily")
+
+WORDS = ("the orchestrator splits objective into subtasks each subagent answers one "
+         "refiner merges results files folder module function test config data value").split()
+FILE_REQUEST = re.compile(r"ONLY the file contents for (\S+) and not")
+# planning mode asks for a dependency graph of subtasks
+PLAN_REQUEST = re.compile(r"into at most (\d+) subtasks")
+
+
+class Behaviour(BaseModel):
+    latency: str = "fixed"          # fixed, uniform, exponential or lognormal
+    latency_mean: float = 0.0       # seconds to the first token
+    latency_spread: float = 0.0     # uniform half width or lognormal sigma
+    tokens_per_second: float = 0.0  # streaming speed, 0 sends the reply at once
+    chunk_tokens: int = 8           # tokens per streamed chunk
+    output_tokens: int = 200        # length of subtask and orchestrator replies
+    file_tokens: int = 400          # length of each generated file
+    files: int = 3                  # files in the folder structure
+    truncate_rate: float = 0.0      # share of replies cut off at max_tokens
+    rate_limit_rate: float = 0.0    # share of requests answered with a 429
+    retry_after: float = 0.0        # retry-after of the 429s
+
+
+class MockReply(BaseModel):
+    tokens: list[str]
+    input_tokens: int
+    truncated: bool = False
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+
+    @property
+    def text(self):
+        return "".join(self.tokens)
+
+
+def filler(count: int, seed: int = 0):
+    # numbered words, so a continuation's prefill is found at one place only
+    return " ".join(f"{WORDS[(seed + i) % len(WORDS)]}{seed + i}" for i in range(count))
+
+
+def split_tokens(text: str):
+    return re.findall(r"\s*\S+\s*", text) or [text]
+
+
+def approx_tokens(text: str):
+    return max(len(text) // 4, 1)
+
+
+class MockState:
+    '''
+    Behaviour and counters of every provider, one instance per server
+    '''
+
+    def __init__(self, seed: int = 0):
+        self.seed = seed
+        self.reset()
+
+    def reset(self):
+        self.rng = random.Random(self.seed)
+        self.behaviour = {provider: Behaviour() for provider in PROVIDERS}
+        self.stats = {provider: {"requests": 0, "rate_limited": 0, "truncated": 0, "continuations": 0,
+                                 "input_tokens": 0, "output_tokens": 0, "busy_seconds": 0.0}
+                      for provider in PROVIDERS}
+        self.prefixes = set()
+
+    def delay(self, provider: str):
+        behaviour = self.behaviour[provider]
+        mean, spread = behaviour.latency_mean, behaviour.latency_spread
+        if mean <= 0:
+            return 0.0
+        if behaviour.latency == "uniform":
+            return max(self.rng.uniform(mean - spread, mean + spread), 0.0)
+        if behaviour.latency == "exponential":
+            return self.rng.expovariate(1.0 / mean)
+        if behaviour.latency == "lognormal":
+            # mean of the distribution stays mean whatever the spread
+            return self.rng.lognormvariate(math.log(mean) - spread ** 2 / 2, spread)
+        return mean
+
+    def rate_limited(self, provider: str):
+        self.stats[provider]["requests"] += 1
+        if self.rng.random() < self.behaviour[provider].rate_limit_rate:
+            self.stats[provider]["rate_limited"] += 1
+            return True
+        return False
+
+    def reply(self, provider: str, prompt: str, max_tokens: int = None,
+              prefill: str = None, prefix: str = None):
+        '''
+        The reply to prompt, or the rest of it after prefill
+        '''
+        behaviour = self.behaviour[provider]
+        full = reply_text(prompt, behaviour)
+        if prefill:
+            self.stats[provider]["continuations"] += 1
+            at = full.find(prefill)
+            full = full[at + len(prefill):] if at >= 0 else filler(behaviour.output_tokens)
+        tokens = split_tokens(full)
+
+        truncated = self.rng.random() < behaviour.truncate_rate and len(tokens) > 1
+        if truncated:
+            tokens = tokens[:len(tokens) // 2]
+        if max_tokens and len(tokens) > max_tokens:
+            tokens, truncated = tokens[:max_tokens], True
+
+        reply = MockReply(tokens=tokens, input_tokens=approx_tokens(prompt + (prefill or "")),
+                          truncated=truncated)
+        if prefix:
+            key = hashlib.sha256(prefix.encode()).hexdigest()
+            if key in self.prefixes:
+                reply.cache_read_tokens = approx_tokens(prefix)
+            else:
+                self.prefixes.add(key)
+                reply.cache_write_tokens = approx_tokens(prefix)
+
+        stats = self.stats[provider]
+        stats["truncated"] += truncated
+        stats["input_tokens"] += reply.input_tokens
+        stats["output_tokens"] += self.output_tokens(reply, max_tokens)
+        return reply
+
+    @staticmethod
+    def output_tokens(reply: MockReply, max_tokens: int = None):
+        # a truncated reply reports the whole max_tokens, like the providers do
+        if reply.truncated and max_tokens:
+            return max_tokens
+        return len(reply.tokens)
+
+    async def stream(self, provider: str, reply: MockReply, first_delay: float):
+        '''
+        The chunks of reply, paced by the provider's streaming speed
+        '''
+        behaviour = self.behaviour[provider]
+        start = time.monotonic()
+        await asyncio.sleep(first_delay)
+        step = max(behaviour.chunk_tokens, 1)
+        for i in range(0, len(reply.tokens), step):
+            if i > 0 and behaviour.tokens_per_second > 0:
+                await asyncio.sleep(step / behaviour.tokens_per_second)
+            yield "".join(reply.tokens[i:i + step])
+        self.stats[provider]["busy_seconds"] += time.monotonic() - start
+
+    async def wait(self, provider: str, reply: MockReply, first_delay: float):
+        '''
+        Same pacing as stream, for the providers that answer in one piece
+        '''
+        async for _ in self.stream(provider, reply, first_delay):
+            pass
+
+
+def reply_text(prompt: str, behaviour: Behaviour):
+    if "<folder_structure>" in prompt and "Do not include the file contents" in prompt:
+        structure = {"src": {f"module_{i}.py": None for i in range(max(behaviour.files - 1, 0))},
+                     "README.md": None}
+        return (f"<project_name>bench</project_name>\n"
+                f"<folder_structure>{json.dumps(structure)}</folder_structure>\n")
+    match = FILE_REQUEST.search(prompt)
+    if match is not None:
+        return filler(behaviour.file_tokens, seed=len(match.group(1)))
+    match = PLAN_REQUEST.search(prompt)
+    if match is not None:
+        # independent subtasks and one that joins them, two levels deep
+        count = max(int(match.group(1)), 1)
+        tasks = [{"id": f"part_{i}", "prompt": f"Write part {i}. {filler(20, seed=i)}", "depends_on": []}
+                 for i in range(count - 1)]
+        tasks.append({"id": "join", "prompt": f"Join the parts. {filler(20)}",
+                      "depends_on": [task["id"] for task in tasks]})
+        return f"<plan>{json.dumps(tasks)}</plan>"
+    text = filler(behaviour.output_tokens)
+    if "'search_query'" in prompt:
+        text += "\n{'search_query': 'benchmark topic'}"
+    return text
+
+
+# --------------------------------------------------------------------------------
+# Provider endpoints
+# --------------------------------------------------------------------------------
+
+
+def sse(event: str, data: dict):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def anthropic_prompt(messages: list[dict]):
+    '''
+    (prompt, cached prefix, prefill) of a messages request
+    '''
+    prompt, prefix, prefill = "", "", None
+    for message in messages:
+        content = message["content"]
+        if message["role"] == "assistant":
+            prefill = content if isinstance(content, str) else "".join(b.get("text", "") for b in content)
+            continue
+        if isinstance(content, str):
+            prompt += content
+            continue
+        for block in content:
+            if "cache_control" in block:
+                prefix += block.get("text", "")
+            prompt += block.get("text", "")
+    return prompt, prefix or None, prefill
+
+
+def create_app(state: MockState):
+    app = FastAPI()
+
+    @app.post("/v1/messages")
+    async def anthropic_messages(request: Request):
+        body = await request.json()
+        if state.rate_limited("anthropic"):
+            retry_after = state.behaviour["anthropic"].retry_after
+            return JSONResponse({"type": "error", "error": {"type": "rate_limit_error",
+                                                            "message": "mock rate limit"}},
+                                status_code=429, headers={"retry-after": f"{retry_after:g}"})
+        prompt, prefix, prefill = anthropic_prompt(body["messages"])
+        max_tokens = body.get("max_tokens")
+        reply = state.reply("anthropic", prompt, max_tokens, prefill, prefix)
+        usage = {"input_tokens": reply.input_tokens - reply.cache_read_tokens - reply.cache_write_tokens,
+                 "cache_read_input_tokens": reply.cache_read_tokens,
+                 "cache_creation_input_tokens": reply.cache_write_tokens}
+        stop_reason = "max_tokens" if reply.truncated else "end_turn"
+        output_tokens = state.output_tokens(reply, max_tokens)
+        message = {"id": f"msg_{state.stats['anthropic']['requests']}", "type": "message",
+                   "role": "assistant", "model": body["model"], "stop_sequence": None}
+        delay = state.delay("anthropic")
+
+        if not body.get("stream"):
+            await state.wait("anthropic", reply, delay)
+            return {**message, "content": [{"type": "text", "text": reply.text}],
+                    "stop_reason": stop_reason, "usage": {**usage, "output_tokens": output_tokens}}
+
+        async def events():
+            yield sse("message_start", {"type": "message_start", "message": {
+                **message, "content": [], "stop_reason": None, "usage": {**usage, "output_tokens": 1}}})
+            yield sse("content_block_start", {"type": "content_block_start", "index": 0,
+                                              "content_block": {"type": "text", "text": ""}})
+            async for text in state.stream("anthropic", reply, delay):
+                yield sse("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                  "delta": {"type": "text_delta", "text": text}})
+            yield sse("content_block_stop", {"type": "content_block_stop", "index": 0})
+            yield sse("message_delta", {"type": "message_delta",
+                                        "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+                                        "usage": {"output_tokens": output_tokens}})
+            yield sse("message_stop", {"type": "message_stop"})
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/v1beta/models/{target}")
+    async def gemini_generate(target: str, request: Request):
+        body = await request.json()
+        if state.rate_limited("gemini"):
+            return JSONResponse({"error": {"code": 429, "message": "mock resource exhausted",
+                                           "status": "RESOURCE_EXHAUSTED"}}, status_code=429)
+        prompt, prefill = "", None
+        for content in body.get("contents", []):
+            text = "".join(part.get("text", "") for part in content.get("parts", []))
+            if content.get("role") == "model":
+                prefill = text
+            elif prefill is None:
+                prompt += text
+        max_tokens = body.get("generationConfig", {}).get("maxOutputTokens")
+        reply = state.reply("gemini", prompt, max_tokens, prefill)
+        usage = {"promptTokenCount": reply.input_tokens,
+                 "candidatesTokenCount": state.output_tokens(reply, max_tokens),
+                 "totalTokenCount": reply.input_tokens + state.output_tokens(reply, max_tokens)}
+        # finish reasons as ints, the client asks for enum-encoding=int
+        finish_reason = 2 if reply.truncated else 1
+
+        def chunk(text: str, last: bool):
+            candidate = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+            if last:
+                candidate["finishReason"] = finish_reason
+            return {"candidates": [candidate], "usageMetadata": usage}
+
+        delay = state.delay("gemini")
+        if not target.endswith(":streamGenerateContent"):
+            await state.wait("gemini", reply, delay)
+            return chunk(reply.text, True)
+
+        async def chunks():
+            # a JSON array sent an element at a time, the REST streaming format
+            yield "["
+            previous = None
+            async for text in state.stream("gemini", reply, delay):
+                if previous is not None:
+                    yield json.dumps(chunk(previous, False)) + ",\r\n"
+                previous = text
+            yield json.dumps(chunk(previous or "", True)) + "]"
+        return StreamingResponse(chunks(), media_type="application/json")
+
+    @app.post("/igpt/auth")
+    async def igpt_auth():
+        return {"access_token": "mock-token", "expires_in": 3600}
+
+    @app.post("/igpt/inference")
+    async def igpt_inference(request: Request):
+        body = await request.json()
+        if state.rate_limited("igpt"):
+            return PlainTextResponse("Too Many Requests", status_code=429)
+        prompt, prefill = "", None
+        for message in body["conversation"]:
+            if message["role"] == "assistant":
+                prefill = message["content"]
+            elif message["role"] == "user" and prefill is None:
+                prompt += message["content"]
+        max_tokens = body.get("options", {}).get("max_Tokens")
+        reply = state.reply("igpt", prompt, max_tokens, prefill)
+        await state.wait("igpt", reply, state.delay("igpt"))
+        return {"currentResponse": reply.text,
+                "usage": {"promptTokens": reply.input_tokens,
+                          "completionTokens": state.output_tokens(reply, max_tokens)}}
+
+    @app.post("/search")
+    async def tavily_search(request: Request):
+        body = await request.json()
+        if state.rate_limited("tavily"):
+            return JSONResponse({"detail": {"error": "mock usage limit"}}, status_code=429)
+        reply = state.reply("tavily", body["query"])
+        await state.wait("tavily", reply, state.delay("tavily"))
+        return {"query": body["query"], "answer": reply.text, "images": [], "follow_up_questions": None,
+                "results": [{"title": f"Result {i}", "url": f"https://example.com/{i}",
+                             "content": filler(40, seed=i), "score": 1.0 - i / 10} for i in range(5)],
+                "response_time": 0.0}
+
+    # ----------------------------------------------------------------------------
+    # Control, the benchmarks set behaviours and read the counters over HTTP
+    # ----------------------------------------------------------------------------
+
+    @app.get("/mock/stats")
+    async def mock_stats():
+        return state.stats
+
+    @app.get("/mock/behaviour")
+    async def mock_behaviours():
+        return state.behaviour
+
+    @app.post("/mock/behaviour/{provider}")
+    async def mock_behaviour(provider: str, behaviour: Behaviour):
+        '''
+        Set the behaviour of one provider, or of all of them
+        '''
+        providers = PROVIDERS if provider == "all" else [provider]
+        for name in providers:
+            if name not in state.behaviour:
+                return JSONResponse({"error": f"Unknown provider {name}"}, status_code=404)
+            state.behaviour[name] = behaviour.model_copy()
+        return state.behaviour
+
+    @app.post("/mock/reset")
+    async def mock_reset():
+        state.reset()
+        return state.stats
+
+    return app
+
+
+# --------------------------------------------------------------------------------
+# Running the server, in a thread for tests or as its own process
+# --------------------------------------------------------------------------------
+
+
+class MockServer:
+
+    def __init__(self, host: str = MOCK_HOST, port: int = 0, seed: int = 0):
+        self.host = host
+        self.port = port
+        self.state = MockState(seed)
+        self.app = create_app(self.state)
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def environ(self):
+        return environ(self.url)
+
+    def start(self):
+        config = uvicorn.Config(self.app, host=self.host, port=self.port,
+                                log_level="warning", lifespan="off")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        self.port = self.server.servers[0].sockets[0].getsockname()[1]
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def environ(url: str):
+    '''
+    Environment that points the provider clients at the server at url
+    '''
+    return {"ANTHROPIC_BASE_URL": url,
+            "TAVILY_API_URL": url,
+            "IGPT_AUTH_URI": f"{url}/igpt/auth",
+            "IGPT_INF_URI": f"{url}/igpt/inference"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-ins for the model and search APIs")
+    parser.add_argument("--host", default=MOCK_HOST)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    uvicorn.run(create_app(MockState(args.seed)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
+
+
+# --------------------------------------------------------------------------------
+# Done :)
+# --------------------------------------------------------------------------------
@@ -0,0 +1,430 @@
+# --------------------------------------------------------------------------------
+# File : run_bench.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Offline benchmarks of the orchestrator loop, extraction, SSE fan-out
+#        and concurrent runs.
+# Purp : Every number that matters for a run used to come from live providers,
+#        so nothing could be compared from one change to the next. The suite
+#        runs the real loop against the local stand-ins in mock_providers.py
+#        and writes the results as JSON, --baseline compares them with an
+#        earlier run and fails on a regression.
+#
+#        python -m bench.run_bench --out bench.json
+#        python -m bench.run_bench --quick --baseline bench.json
+# --------------------------------------------------------------------------------
+
+import io
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import statistics
+
+import httpx
+
+from bench.mock_providers import environ
+
+
+# behaviours of the stand-ins, set on every provider
+PROFILES = {
+    "instant": {},
+    "fast": {"latency": "lognormal", "latency_mean": 0.02, "latency_spread": 0.5,
+             "tokens_per_second": 5000},
+    "slow": {"latency": "lognormal", "latency_mean": 0.25, "latency_spread": 0.5,
+             "tokens_per_second": 500},
+    "flaky": {"latency": "lognormal", "latency_mean": 0.02, "latency_spread": 0.5,
+              "tokens_per_second": 5000, "truncate_rate": 0.2, "rate_limit_rate": 0.05},
+}
+
+MODELS = {"anthropic": "claude-3-haiku-20240307", "igpt": "igpt-4-turbo"}
+
+# the metrics --baseline compares, and which way is better
+REGRESSION_METRICS = {"overhead_per_call": "lower", "mb_per_second": "higher",
+                      "deliveries_per_second": "higher", "p99_latency": "lower",
+                      "speedup": "higher"}
+
+
+def percentile(values: list, q: float):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# --------------------------------------------------------------------------------
+# The stand-in server, a process of its own so it doesn't share the loop or
+# the GIL with the code being measured
+# --------------------------------------------------------------------------------
+
+
+class MockClient:
+
+    def __init__(self, url: str):
+        self.url = url
+        self.client = httpx.AsyncClient(base_url=url, timeout=10)
+
+    async def configure(self, profile: dict):
+        await self.client.post("/mock/reset")
+        response = await self.client.post("/mock/behaviour/all", json=profile)
+        response.raise_for_status()
+
+    async def stats(self):
+        return (await self.client.get("/mock/stats")).json()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def start_mock(port: int):
+    process = subprocess.Popen([sys.executable, "-m", "bench.mock_providers", "--port", str(port)])
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(200):
+        try:
+            httpx.get(f"{url}/mock/stats", timeout=1)
+            return process, url
+        except httpx.TransportError:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError(f"Mock providers didn't start on port {port}")
+
+
+def configure_environment(url: str, workdir: str, keep_rate_limits: bool):
+    '''
+    Point the provider clients at the stand-ins, this has to happen before
+    the orchestrator is imported
+    '''
+    os.environ.update(environ(url))
+    for key in ("OPENAI_API_KEY", "ANTHROPIC_API_KEY", "TAVILY_API_KEY", "GOOGLE_API_KEY",
+                "IGPT_KEY", "IGPT_SECRET"):
+        os.environ[key] = "bench"
+    for key, value in (("MONGO_CONN", "localhost"), ("MONGO_PORT", "27017"), ("MONGO_DBNAME", "bench"),
+                       ("HOSTNAME", "localhost"), ("APP_PORT", "3434")):
+        os.environ.setdefault(key, value)
+    os.environ.update({"LLM_CACHE_MODE": "off", "RUN_CHECKPOINTS": "0",
+                       "OUTPUT_DIR": os.path.join(workdir, "output"),
+                       "ARTIFACT_DIR": os.path.join(workdir, "output", "artifacts"),
+                       "IGPT_TOKEN_CACHE": os.path.join(workdir, "cache", "igpt_token.json")})
+    if not keep_rate_limits:
+        # the client side limiter would measure itself, 0 is unlimited
+        for key in ("ANTHROPIC_RPM", "ANTHROPIC_TPM", "GEMINI_RPM", "GEMINI_TPM",
+                    "IGPT_RPM", "IGPT_TPM", "TAVILY_RPM"):
+            os.environ[key] = "0"
+    for folder in ("output", "output/artifacts", "final", "logs", "cache"):
+        os.makedirs(os.path.join(workdir, folder), exist_ok=True)
+
+
+# --------------------------------------------------------------------------------
+# Runs, through workers.run_job so the console, event file, tracer and broker
+# are the same as in production
+# --------------------------------------------------------------------------------
+
+
+class BenchBroker:
+    '''
+    Stands in for the event broker, keeps the call_end events of the runs
+    '''
+
+    def __init__(self):
+        self.events = 0
+        self.calls = []
+
+    def open(self, run_id: str):
+        pass
+
+    def publish(self, run_id: str, event: dict):
+        self.events += 1
+        if event["event"] == "call_end":
+            self.calls.append(event)
+
+
+def agent_data(args, refine_concurrency: int):
+    from fastapi.encoders import jsonable_encoder
+    from orchestrator import ModelConfig, AgentConfig
+    model_name = MODELS[args.provider]
+    model = ModelConfig(orchestrator_model=model_name, refiner_model=model_name, subagent_model=model_name,
+                        strategy=args.strategy, task_iter=args.task_iter, refine_iter=args.refine_iter,
+                        refine_concurrency=refine_concurrency, task_planning=args.task_planning)
+    agent = AgentConfig(name="bench", objective="Build a small command line tool.", model=model,
+                        use_search=True)
+    return jsonable_encoder(agent)
+
+
+async def run_agents(count: int, args, refine_concurrency: int):
+    from workers import run_job
+    broker = BenchBroker()
+    agents = [agent_data(args, refine_concurrency) for _ in range(count)]
+    start = time.perf_counter()
+    statuses = await asyncio.gather(*[run_job(agent["_id"], agent, broker) for agent in agents])
+    wall = time.perf_counter() - start
+    if any(status != "complete" for status in statuses):
+        raise RuntimeError(f"Benchmark runs didn't complete: {statuses}")
+    return wall, broker
+
+
+async def bench_loop(mock: MockClient, args):
+    '''
+    One run at a time, files refined one after the other so the calls are
+    sequential and the wall clock splits into loop, client and provider time
+    '''
+    cases = []
+    for _ in range(args.repeats):
+        await mock.configure(PROFILES[args.profile])
+        wall, broker = await run_agents(1, args, refine_concurrency=1)
+        stats = await mock.stats()
+        search_seconds = stats["tavily"]["busy_seconds"]
+        stats = stats[args.provider]
+        model_seconds = sum(call["latency"] for call in broker.calls)
+        calls = len(broker.calls)
+        cases.append({"wall_seconds": wall, "calls": calls, "events": broker.events,
+                      "model_seconds": model_seconds, "provider_seconds": stats["busy_seconds"],
+                      "search_seconds": search_seconds,
+                      "overhead_per_call": (wall - model_seconds - search_seconds) / max(calls, 1),
+                      "client_overhead_per_call": (model_seconds - stats["busy_seconds"]) / max(calls, 1),
+                      "retries": sum(call["retries"] for call in broker.calls),
+                      "rate_limit_wait": sum(call["rate_limit_wait"] for call in broker.calls),
+                      "truncated": stats["truncated"], "continuations": stats["continuations"],
+                      "rate_limited": stats["rate_limited"]})
+    # the median repeat by wall clock
+    result = sorted(cases, key=lambda case: case["wall_seconds"])[len(cases) // 2]
+    return {**result, "repeats": len(cases)}
+
+
+async def bench_scaling(mock: MockClient, args):
+    results = {}
+    single = None
+    for count in args.concurrency:
+        await mock.configure(PROFILES[args.profile])
+        wall, broker = await run_agents(count, args, refine_concurrency=4)
+        latencies = [call["latency"] for call in broker.calls]
+        if single is None:
+            single = wall / count
+        speedup = count * single / wall
+        results[f"runs_{count}"] = {"runs": count, "wall_seconds": wall, "runs_per_second": count / wall,
+                                    "calls": len(broker.calls), "speedup": speedup,
+                                    "efficiency": speedup / count,
+                                    "p50_call_latency": percentile(latencies, 0.5),
+                                    "p99_call_latency": percentile(latencies, 0.99)}
+    return results
+
+
+# --------------------------------------------------------------------------------
+# Extraction and SSE fan-out, no model calls
+# --------------------------------------------------------------------------------
+
+
+def refined_output(files: int, file_bytes: int):
+    structure = {"src": {f"module_{i}.py": None for i in range(files)}}
+    body = ("x = 1  # generated\n" * (file_bytes // 20 + 1))[:file_bytes]
+    parts = ["<project_name>bench</project_name>\n",
+             f"<folder_structure>{json.dumps(structure)}</folder_structure>\n"]
+    parts += [f'<file name="/src/module_{i}.py">\n{body}\n</file>\n' for i in range(files)]
+    return "".join(parts)
+
+
+def bench_extraction(args):
+    from rich.console import Console
+    from orchestrator import AgentConfig, extract_output
+    text = refined_output(args.files, args.file_kb * 1024)
+    agent = AgentConfig(**agent_data(args, refine_concurrency=1))
+    times = []
+    for _ in range(args.repeats):
+        console = Console(file=io.StringIO(), record=True, width=80)
+        start = time.perf_counter()
+        extract_output(text, agent=agent, console=console)
+        times.append(time.perf_counter() - start)
+    seconds = statistics.median(times)
+    megabytes = args.files * args.file_kb / 1024
+    return {"files": args.files, "file_kb": args.file_kb, "seconds": seconds,
+            "mb_per_second": megabytes / seconds, "files_per_second": args.files / seconds}
+
+
+async def bench_sse_fanout(args):
+    '''
+    Viewers of one run reading through the server's SSE event reader while
+    the run streams tokens
+    '''
+    from events import RunEvents, event_broker
+    from server import event_reader
+    results = {}
+    for viewers in args.viewers:
+        run_id = f"fanout{viewers}"
+        events = RunEvents(f"logs/run_orch_loop_{run_id}.events", run_id=run_id, broker=event_broker)
+        latencies = []
+
+        async def view():
+            async for message in event_reader(run_id):
+                data = json.loads(message["data"])
+                if "sent" in data:
+                    latencies.append(time.perf_counter() - data["sent"])
+
+        tasks = [asyncio.create_task(view()) for _ in range(viewers)]
+        await asyncio.sleep(0.05)
+        start = time.perf_counter()
+        for i in range(args.events):
+            events.emit("token", call="bench", phase="subagent", model="bench", text="token ",
+                        sent=time.perf_counter())
+            if i % 8 == 7:
+                # the model stream hands back to the loop between chunks
+                await asyncio.sleep(0)
+        events.emit("done", status="complete")
+        await asyncio.gather(*tasks)
+        wall = time.perf_counter() - start
+        events.close()
+        delivered = viewers * (args.events + 1)
+        results[f"viewers_{viewers}"] = {"viewers": viewers, "events": args.events, "wall_seconds": wall,
+                                         "deliveries_per_second": delivered / wall,
+                                         "p50_latency": percentile(latencies, 0.5),
+                                         "p99_latency": percentile(latencies, 0.99)}
+    return results
+
+
+# --------------------------------------------------------------------------------
+# Comparing with a baseline
+# --------------------------------------------------------------------------------
+
+
+def regressions(results: dict, baseline: dict, tolerance: float, path: str = ""):
+    '''
+    [(path, baseline, current)] of the metrics worse than baseline by more
+    than tolerance
+    '''
+    found = []
+    for key, value in results.items():
+        if key not in baseline:
+            continue
+        if isinstance(value, dict):
+            found += regressions(value, baseline[key], tolerance, f"{path}{key}.")
+        elif key in REGRESSION_METRICS and baseline[key]:
+            change = (value - baseline[key]) / abs(baseline[key])
+            if REGRESSION_METRICS[key] == "higher":
+                change = -change
+            if change > tolerance:
+                found.append((f"{path}{key}", baseline[key], value))
+    return found
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_suite(args, url: str):
+    mock = MockClient(url)
+    benchmarks = {}
+    try:
+        if "loop" in args.only:
+            benchmarks["loop"] = await bench_loop(mock, args)
+        if "extraction" in args.only:
+            benchmarks["extraction"] = bench_extraction(args)
+        if "sse_fanout" in args.only:
+            benchmarks["sse_fanout"] = await bench_sse_fanout(args)
+        if "scaling" in args.only:
+            benchmarks["scaling"] = await bench_scaling(mock, args)
+    finally:
+        await mock.aclose()
+        from agents import providers
+        await providers.aclose()
+    return benchmarks
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks against local provider stand-ins")
+    parser.add_argument("--out", help="write the JSON results here as well as to stdout")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative change of a metric that counts as a regression")
+    parser.add_argument("--only", nargs="+", default=["loop", "extraction", "sse_fanout", "scaling"],
+                        choices=["loop", "extraction", "sse_fanout", "scaling"])
+    parser.add_argument("--profile", default="fast", choices=sorted(PROFILES))
+    parser.add_argument("--provider", default="anthropic", choices=sorted(MODELS))
+    parser.add_argument("--mock-url", help="use a stand-in server that is already running")
+    parser.add_argument("--keep-rate-limits", action="store_true",
+                        help="keep the client side rate limits instead of turning them off")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--task-iter", type=int, default=3)
+    parser.add_argument("--refine-iter", type=int, default=2)
+    parser.add_argument("--strategy", default="IterativeRefinement",
+                        help="orchestration strategy of the benchmark agents")
+    parser.add_argument("--task-planning", action="store_true",
+                        help="plan each era as a dependency graph and run the subtasks concurrently")
+    parser.add_argument("--files", type=int, default=50)
+    parser.add_argument("--file-kb", type=int, default=64)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--viewers", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--quick", action="store_true", help="small sizes, for a smoke test")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.repeats, args.task_iter, args.refine_iter = 1, 2, 1
+        args.files, args.file_kb, args.events = 10, 16, 200
+        args.viewers, args.concurrency = [1, 10], [1, 4]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    repo = os.getcwd()
+    process = None
+    if args.mock_url is None:
+        process, url = start_mock(free_port())
+    else:
+        url = args.mock_url
+    workdir = tempfile.mkdtemp(prefix="agent_bench_")
+    try:
+        configure_environment(url, workdir, args.keep_rate_limits)
+        # imported for its side effects only, the server finds its static
+        # files and templates from the repo so it must load before the chdir
+        import server  # noqa: F401
+        os.chdir(workdir)
+        benchmarks = asyncio.run(run_suite(args, url))
+    finally:
+        os.chdir(repo)
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    results = {"meta": {"time": time.time(), "commit": git_commit(), "python": platform.python_version(),
+                        "platform": platform.platform(), "workdir": workdir,
+                        "profile": args.profile, "behaviour": PROFILES[args.profile],
+                        "provider": args.provider, "args": vars(args)},
+               "benchmarks": benchmarks}
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(benchmarks, baseline["benchmarks"], args.tolerance)
+        for path, before, after in found:
+            print(f"REGRESSION {path}: {before:.6g} -> {after:.6g}", file=sys.stderr)
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# --------------------------------------------------------------------------------
+# Done :)
+# --------------------------------------------------------------------------------
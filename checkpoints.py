@@ -0,0 +1,153 @@
+# --------------------------------------------------------------------------------
+# File : checkpoints.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Run state checkpoints in Mongo.
+# Purp : The subtask queries, results and era results of a run only lived in
+#        memory, so a crash, a rate limit give-up or a cancelled run lost every
+#        model call made so far. The loop saves each step as it finishes, and a
+#        run started again picks up after the last saved step. The results go
+#        to their own collection, one document per step, so the agent document
+#        only ever gets small $set / $push updates.
+# --------------------------------------------------------------------------------
+
+import os
+import time
+
+from pymongo import ASCENDING
+
+
+RUN_CHECKPOINTS = os.environ.get('RUN_CHECKPOINTS', '1') != '0'
+
+# the task number of an era's refined result in the results collection
+ERA_TASK = -1
+
+# run state that used to be kept in the agent document
+LEGACY_FIELDS = ["subtask_queries", "subtask_results", "era_results"]
+
+
+def results_collection_name(db_name: str):
+    return os.environ.get('MONGO_RESULTS', f"{db_name}_results")
+
+
+async def create_indexes(results):
+    await results.create_index([("agent_id", ASCENDING), ("era", ASCENDING), ("task", ASCENDING)],
+                               unique=True, name="agent_era_task")
+
+
+class CheckpointStore:
+    '''
+    Saves the steps of a run, the agents collection holds the run state and
+    progress, the results collection one document per (agent_id, era, task).
+    The motor client is created on first use so it binds to the event loop
+    of the process using it.
+    '''
+
+    def __init__(self, agents=None, results=None):
+        self.agents = agents
+        self.results = results
+
+    async def connect(self):
+        if self.agents is not None:
+            return
+        import motor.motor_asyncio
+        client = motor.motor_asyncio.AsyncIOMotorClient(
+            os.environ['MONGO_CONN'], int(os.environ['MONGO_PORT']), tls=True,
+            tlsAllowInvalidCertificates=True)
+        db_name = os.environ['MONGO_DBNAME']
+        self.agents = client[db_name][db_name]
+        self.results = client[db_name][results_collection_name(db_name)]
+        await create_indexes(self.results)
+
+    async def update(self, agent, update: dict, console=None):
+        '''
+        Apply update to the agent document, a failed save is reported and the
+        run carries on without it
+        '''
+        try:
+            await self.connect()
+            await self.agents.update_one({"_id": str(agent.id)}, update)
+        except Exception as e:
+            if console is not None:
+                console.print(f"[bold red]Checkpoint failed {e!r}[/bold red]")
+
+    async def put_result(self, agent, era: int, task: int, fields: dict, console=None):
+        try:
+            await self.connect()
+            key = {"agent_id": str(agent.id), "era": era, "task": task}
+            await self.results.replace_one(key, {**key, **fields, "time": time.time()}, upsert=True)
+        except Exception as e:
+            if console is not None:
+                console.print(f"[bold red]Checkpoint failed {e!r}[/bold red]")
+
+    # ----------------------------------------------------------------------------
+    # Steps of a run
+    # ----------------------------------------------------------------------------
+
+    async def start(self, agent, fresh: bool, console=None):
+        if fresh:
+            try:
+                await self.connect()
+                await self.results.delete_many({"agent_id": str(agent.id)})
+            except Exception as e:
+                if console is not None:
+                    console.print(f"[bold red]Checkpoint failed {e!r}[/bold red]")
+            unset = {field: "" for field in LEGACY_FIELDS + ["subtask_digests", "subtask_plans", "era_digests",
+                                                             "steps"]}
+            await self.update(agent, {"$set": {"run_state": agent.run_state, "tokens_used": agent.tokens_used},
+                                      "$unset": unset}, console)
+        else:
+            await self.update(agent, {"$set": {"run_state": agent.run_state}}, console)
+
+    async def plan(self, agent, era: int, console=None):
+        # small, it stays in the agent document next to the digests
+        await self.update(agent, {"$set": {f"subtask_plans.{era}": agent.subtask_plans[era]}}, console)
+
+    async def subtask(self, agent, era: int, task: int, console=None):
+        await self.put_result(agent, era, task, {"query": agent.subtask_queries[era][task],
+                                                 "result": agent.subtask_results[era][task]}, console)
+        update = {"tokens_used": agent.tokens_used}
+        if era in agent.subtask_digests:
+            update[f"subtask_digests.{era}"] = agent.subtask_digests[era]
+        await self.update(agent, {"$set": update, "$push": {"steps": self.step(agent, era, task)}}, console)
+
+    async def era(self, agent, era: int, console=None):
+        await self.put_result(agent, era, ERA_TASK, {"result": agent.era_results[era]}, console)
+        update = {"tokens_used": agent.tokens_used}
+        if era in agent.era_digests:
+            update[f"era_digests.{era}"] = agent.era_digests[era]
+        await self.update(agent, {"$set": update, "$push": {"steps": self.step(agent, era, ERA_TASK)}}, console)
+
+    async def complete(self, agent, console=None):
+        await self.update(agent, {"$set": {"run_state": agent.run_state, "tokens_used": agent.tokens_used}},
+                          console)
+
+    @staticmethod
+    def step(agent, era: int, task: int):
+        return {"era": era, "task": task, "tokens_used": agent.tokens_used, "time": time.time()}
+
+    async def load(self, agent):
+        '''
+        Fill the subtask and era results of agent from the results collection
+        '''
+        await self.connect()
+        queries, results, era_results = {}, {}, []
+        cursor = self.results.find({"agent_id": str(agent.id)}, {"_id": 0, "time": 0})
+        async for doc in cursor.sort([("era", ASCENDING), ("task", ASCENDING)]):
+            if doc["task"] == ERA_TASK:
+                era_results.append(doc["result"])
+            else:
+                queries.setdefault(doc["era"], []).append(doc["query"])
+                results.setdefault(doc["era"], []).append(doc["result"])
+        # runs checkpointed before the results collection keep their inline state
+        if len(results) > 0 or len(era_results) > 0:
+            agent.subtask_queries, agent.subtask_results, agent.era_results = queries, results, era_results
+        return agent
+
+
+checkpoint_store = CheckpointStore()
+
+
+# --------------------------------------------------------------------------------
+# Done :)
+# --------------------------------------------------------------------------------
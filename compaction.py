@@ -0,0 +1,78 @@
+# --------------------------------------------------------------------------------
+# File : compaction.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Rolling digest of earlier subtask results.
+# Purp : The orchestrator and subagent prompts used to carry every earlier
+#        subtask result and the full baseline, so the prompts grew with every
+#        iteration. Only the last few results stay verbatim now, older ones are
+#        folded one at a time into a digest of bounded size.
+# --------------------------------------------------------------------------------
+
+import os
+
+from tokens import count_tokens, truncate_to_tokens
+
+
+CONTEXT_KEEP = int(os.environ.get('CONTEXT_KEEP', 2))
+CONTEXT_DIGEST_TOKENS = int(os.environ.get('CONTEXT_DIGEST_TOKENS', 1500))
+
+
+digest_prompt = '''
+You maintain the running digest of the earlier results of an AI agent working on the Objective.
+Merge the New Result into the Digest. Keep the decisions made, file names, interfaces and code
+that later steps depend on, and any errors or open problems still to fix. Drop anything the
+New Result supersedes. Keep the digest under {words} words and reply with the updated digest only.
+'''
+
+
+def fold_index(results: list[str], keep: int):
+    '''
+    Index of the result that just left the verbatim window, None if no
+    result left it with the last append
+    '''
+    idx = len(results) - keep - 1
+    return idx if idx >= 0 else None
+
+
+def render_results(results: list[str], digest: str, keep: int,
+                   label: str = "Subtask", compact: bool = True):
+    '''
+    Digest of the older results followed by the last keep results verbatim
+    '''
+    if not compact:
+        return [f"**{label} {i} Results**\n{r}" for i, r in enumerate(results)]
+
+    first = max(len(results) - keep, 0)
+    rendered = []
+    if first > 0:
+        rendered.append(f"**{label} 0-{first - 1} Results (digest)**\n{digest}")
+    rendered += [f"**{label} {i} Results**\n{results[i]}" for i in range(first, len(results))]
+    return rendered
+
+
+async def update_digest(objective: str, digest: str, result: str, name: str,
+                        max_tokens: int, summarize):
+    '''
+    Fold one result into the digest. summarize(prompt, max_tokens) returns
+    the model text or None, a failed summary falls back to truncation.
+    '''
+    prompt = "".join([
+        digest_prompt.format(words=int(max_tokens * 0.7)),
+        f"\n**Objective:**\n{objective}\n\n",
+        f"**Digest:**\n{digest or 'None'}\n\n",
+        f"**New Result ({name}):**\n{result}\n",
+    ])
+    text = await summarize(prompt, max_tokens)
+    if text is None:
+        text = f"{digest}\n\n**{name}**\n{result}" if digest else result
+    return truncate_to_tokens(text, max_tokens)
+
+
+def needs_digest(text: str, max_tokens: int):
+    return count_tokens(text) > max_tokens
+
+
+# --------------------------------------------------------------------------------
+# Done :)
+# --------------------------------------------------------------------------------
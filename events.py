@@ -0,0 +1,188 @@
+# --------------------------------------------------------------------------------
+# File : events.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Typed events for a running agent (log output, model tokens).
+# Purp : The orchestrator emits events while it runs and the server forwards
+#        them to the browser over SSE, so model output shows up as it is
+#        generated instead of after the whole completion. Viewers of a run in
+#        this process subscribe to the broker, anything else (a run in another
+#        process, a finished run) is read back from the event file.
+# --------------------------------------------------------------------------------
+
+import io
+import json
+import asyncio
+
+from contextvars import ContextVar
+
+
+# --------------------------------------------------------------------------------
+# Events for one run, one json object per line
+#   log        : console output       {"text"}
+#   call_start : model call started   {"call", "phase", "model"}
+#   token      : streamed model text  {"call", "phase", "model", "text"}
+#   call_end   : model call finished  {"call", "phase", "model", "input_tokens", "output_tokens",
+#                                       "cache_read_tokens", "cache_write_tokens", "provider",
+#                                       "latency", "ttft", "retries", "rate_limit_wait",
+#                                       "cached", "failed"}
+#   usage      : run token totals     {"limit", "used", "calls", "input_tokens", "output_tokens"}
+#   search     : web search lookup    {"provider", "outcome"} hit, coalesced or miss
+#   done       : run finished         {"status"}
+# --------------------------------------------------------------------------------
+
+
+EVENT_POLL = 0.25
+
+
+class EventBroker:
+    '''
+    In process pub/sub, one publisher per run fanned out to every subscriber.
+    Publish and subscribe are both called on the event loop thread.
+    '''
+
+    def __init__(self):
+        self.history = {}
+        self.subscribers = {}
+        # called with (run_id, event) for every event, metrics and the like
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def open(self, run_id: str):
+        self.history[run_id] = []
+        self.subscribers.setdefault(run_id, set())
+
+    def live(self, run_id: str):
+        return run_id in self.history
+
+    def publish(self, run_id: str, event: dict):
+        for listener in self.listeners:
+            listener(run_id, event)
+        if run_id not in self.history:
+            return
+        self.history[run_id].append(event)
+        for queue in self.subscribers[run_id]:
+            queue.put_nowait(event)
+        if event["event"] == "done":
+            # late viewers read the finished run from its file, the viewers
+            # still reading drop the entry when they leave
+            del self.history[run_id]
+            if not self.subscribers[run_id]:
+                del self.subscribers[run_id]
+
+    def viewers(self, run_id: str):
+        return len(self.subscribers.get(run_id, ()))
+
+    async def subscribe(self, run_id: str, path: str):
+        if not self.live(run_id):
+            async for event in read_events(path):
+                yield event
+            return
+
+        # snapshot and register with no await in between, nothing is missed
+        # or sent twice
+        queue = asyncio.Queue()
+        backlog = list(self.history[run_id])
+        self.subscribers[run_id].add(queue)
+        try:
+            for event in backlog:
+                yield event
+            while True:
+                event = await queue.get()
+                yield event
+                if event["event"] == "done":
+                    return
+        finally:
+            self.subscribers[run_id].discard(queue)
+            if not self.subscribers[run_id] and not self.live(run_id):
+                del self.subscribers[run_id]
+
+
+async def read_events(path: str, poll: float = EVENT_POLL):
+    '''
+    Follow an event file until its done event, reads happen off the loop
+    and waiting for more data never blocks it
+    '''
+    with open(path) as fid:
+        buffer = ""
+        while True:
+            chunk = await asyncio.to_thread(fid.read, 65536)
+            if not chunk:
+                await asyncio.sleep(poll)
+                continue
+            buffer += chunk
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                if not line:
+                    continue
+                event = json.loads(line)
+                yield event
+                if event["event"] == "done":
+                    return
+
+
+event_broker = EventBroker()
+
+
+class RunEvents:
+
+    def __init__(self, path: str, run_id: str = None, broker: EventBroker = event_broker):
+        self.path = path
+        self.run_id = run_id
+        self.broker = broker
+        self._file = open(path, "w")
+        if run_id is not None:
+            broker.open(run_id)
+
+    def emit(self, event: str, **data):
+        if self._file.closed:
+            return
+        event = {"event": event, **data}
+        self._file.write(json.dumps(event) + "\n")
+        self._file.flush()
+        if self.run_id is not None:
+            self.broker.publish(self.run_id, event)
+
+    def close(self):
+        self._file.close()
+
+
+class RunLog(io.TextIOBase):
+    '''
+    File for the rich Console of a run, keeps the plain log file and emits
+    everything printed as log events
+    '''
+
+    def __init__(self, path: str, events: RunEvents):
+        self._file = open(path, "wt")
+        self.events = events
+
+    def write(self, text: str):
+        self._file.write(text)
+        self._file.flush()
+        self.events.emit("log", text=text)
+        return len(text)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+# the events of the run the current task belongs to
+run_events = ContextVar("run_events", default=None)
+
+
+def emit(event: str, **data):
+    events = run_events.get()
+    if events is not None:
+        events.emit(event, **data)
+
+
+# --------------------------------------------------------------------------------
+# Done :)
+# --------------------------------------------------------------------------------
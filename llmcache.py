@@ -0,0 +1,158 @@
+# --------------------------------------------------------------------------------
+# File : llmcache.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Content addressed cache for LLM responses.
+# Purp : Identical prompts (reruns of a saved agent, restarted runs, refiner
+#        retries) are answered from a local SQLite store instead of the
+#        provider. The replay mode serves recorded responses only so the
+#        tests can run offline.
+# --------------------------------------------------------------------------------
+
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+import threading
+
+
+# --------------------------------------------------------------------------------
+# Modes
+#   off    : never read or write
+#   on     : read through, write misses
+#   record : always call the provider and overwrite the entry
+#   replay : only read, a miss raises CacheMissError
+# --------------------------------------------------------------------------------
+
+LLM_CACHE_MODE = os.environ.get('LLM_CACHE_MODE', 'on')
+LLM_CACHE_PATH = os.environ.get('LLM_CACHE_PATH', 'cache/llm_cache.sqlite')
+LLM_CACHE_MAX_MB = float(os.environ.get('LLM_CACHE_MAX_MB', 512))
+LLM_CACHE_TTL = float(os.environ.get('LLM_CACHE_TTL', 0))
+
+CACHE_MODES = ("off", "on", "record", "replay")
+
+
+class CacheMissError(LookupError):
+    pass
+
+
+class LLMCache:
+
+    def __init__(self, path: str = LLM_CACHE_PATH, mode: str = LLM_CACHE_MODE,
+                 max_bytes: int = int(LLM_CACHE_MAX_MB * 1024 * 1024),
+                 ttl: float = LLM_CACHE_TTL):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unsupported cache mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # WAL lets the server workers share the file
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    provider TEXT,
+                    model TEXT,
+                    response TEXT,
+                    size INTEGER,
+                    created REAL,
+                    accessed REAL)""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def key(provider: str, model: str, params: dict, messages):
+        entry = {"provider": provider, "model": model, "params": params, "messages": messages}
+        return hashlib.sha256(json.dumps(entry, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str):
+        '''
+        Cached response dict for key or None, raises CacheMissError in replay
+        '''
+        if self.mode in ("off", "record"):
+            return None
+        with self._lock:
+            conn = self.connect()
+            row = conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl > 0 and time.time() - row[1] > self.ttl and self.mode != "replay":
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                if self.mode == "replay":
+                    raise CacheMissError(f"No recorded response for {key}")
+                return None
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key: str, provider: str, model: str, response: dict):
+        if self.mode in ("off", "replay"):
+            return
+        data = json.dumps(response)
+        now = time.time()
+        with self._lock:
+            conn = self.connect()
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (key, provider, model, data, len(data), now, now))
+            self.evict(conn)
+            conn.commit()
+
+    async def aget(self, key: str):
+        '''
+        get on a worker thread, a busy database waits up to the connect
+        timeout and must not hold up the event loop meanwhile
+        '''
+        if self.mode in ("off", "record"):
+            return None
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key: str, provider: str, model: str, response: dict):
+        if self.mode in ("off", "replay"):
+            return
+        await asyncio.to_thread(self.put, key, provider, model, response)
+
+    def evict(self, conn: sqlite3.Connection):
+        '''
+        Drop the least recently used entries until the store fits max_bytes
+        '''
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = conn.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+        stale = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+llm_cache = LLMCache()
+
+
+# --------------------------------------------------------------------------------
+# Done :)
+# --------------------------------------------------------------------------------
@@ -0,0 +1,211 @@
+# --------------------------------------------------------------------------------
+# File : metrics.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Per model call metrics and their Prometheus exposition.
+# Purp : Token counts printed into the run log don't say which provider or
+#        phase the wall clock time goes to. Every model call now records its
+#        latency, time to first token, tokens, retries, rate limit waits and
+#        cache hits. The numbers travel on the call_end event, so calls made in
+#        the worker processes are counted by the server too, which keeps the
+#        counters and histograms served on /metrics.
+# --------------------------------------------------------------------------------
+
+import time
+import threading
+
+from contextvars import ContextVar
+
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 60.0, 120.0, 300.0)
+TOKEN_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144)
+
+
+# --------------------------------------------------------------------------------
+# Measuring one call, query_model sets current_call for the duration of the call
+# and the rate limiter and provider retry loops add to it
+# --------------------------------------------------------------------------------
+
+
+class CallMetrics:
+
+    def __init__(self, provider: str, model: str, phase: str):
+        self.provider = provider
+        self.model = model
+        self.phase = phase
+        self.start = time.monotonic()
+        self.first_token = None
+        self.retries = 0
+        self.rate_limit_wait = 0.0
+
+    def token(self):
+        if self.first_token is None:
+            self.first_token = time.monotonic()
+
+    def fields(self, response):
+        '''
+        The call_end fields of a finished call
+        '''
+        end = time.monotonic()
+        return {"provider": self.provider,
+                "latency": round(end - self.start, 4),
+                "ttft": round((self.first_token or end) - self.start, 4),
+                "retries": self.retries,
+                "rate_limit_wait": round(self.rate_limit_wait, 4),
+                "cached": response.cached,
+                "failed": response.failed}
+
+
+current_call = ContextVar("current_call", default=None)
+
+
+def record_retry():
+    call = current_call.get()
+    if call is not None:
+        call.retries += 1
+
+
+def record_wait(seconds: float):
+    call = current_call.get()
+    if call is not None:
+        call.rate_limit_wait += seconds
+
+
+# --------------------------------------------------------------------------------
+# In process registry, a metric keeps one series per label value tuple
+# --------------------------------------------------------------------------------
+
+
+def format_labels(names: tuple, values: tuple, extra: dict = None):
+    pairs = list(zip(names, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def format_value(value: float):
+    # every digit of large totals, :g would round 1234567 to 1.23457e+06
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class Counter:
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, *values, amount: float = 1.0):
+        self.series[values] = self.series.get(values, 0.0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for values, total in sorted(self.series.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, values)} {format_value(total)}")
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [bucket counts..., count, sum]
+        self.series = {}
+
+    def observe(self, *values, value: float):
+        series = self.series.setdefault(values, [0] * len(self.buckets) + [0, 0.0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, series in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, values, {'le': format_value(bound)})} {count}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labels, values, {'le': '+Inf'})} {series[-2]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, values)} {series[-2]}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, values)} {format_value(series[-1])}")
+        return lines
+
+
+class Metrics:
+    '''
+    The model call and search cache metrics, fed from the call_end, search
+    and done events
+    '''
+
+    def __init__(self):
+        labels = ("provider", "model", "phase")
+        self.lock = threading.Lock()
+        self.calls = Counter("agent_model_calls_total", "Model calls by outcome (ok, failed, cached)",
+                             labels + ("status",))
+        self.latency = Histogram("agent_model_call_seconds", "Model call wall clock time", labels)
+        self.ttft = Histogram("agent_model_ttft_seconds", "Time to the first streamed token", labels)
+        self.tokens = Counter("agent_model_tokens_total", "Tokens by kind (input, output, cache_read, cache_write)",
+                              labels + ("kind",))
+        self.output_tokens = Histogram("agent_model_output_tokens", "Output tokens per call", labels,
+                                       buckets=TOKEN_BUCKETS)
+        self.retries = Counter("agent_model_retries_total", "Model call retries after rate limit errors", labels)
+        self.rate_limit_wait = Counter("agent_rate_limit_wait_seconds_total",
+                                       "Time spent waiting for the client side rate limiter", labels)
+        self.runs = Counter("agent_runs_total", "Finished runs by status", ("status",))
+        self.search_hits = Counter("search_cache_hits_total", "Searches answered from the search cache",
+                                   ("provider",))
+        self.search_coalesced = Counter("search_cache_coalesced_total",
+                                        "Searches that shared a request already in flight", ("provider",))
+        self.search_misses = Counter("search_cache_misses_total", "Searches sent to the provider",
+                                     ("provider",))
+        self.metrics = [self.calls, self.latency, self.ttft, self.tokens, self.output_tokens,
+                        self.retries, self.rate_limit_wait, self.runs,
+                        self.search_hits, self.search_coalesced, self.search_misses]
+
+    def observe(self, run_id: str, event: dict):
+        if event["event"] == "done":
+            with self.lock:
+                self.runs.inc(event.get("status", "unknown"))
+            return
+        if event["event"] == "search":
+            counter = {"hit": self.search_hits, "coalesced": self.search_coalesced,
+                       "miss": self.search_misses}.get(event.get("outcome"))
+            if counter is not None:
+                with self.lock:
+                    counter.inc(event["provider"])
+            return
+        if event["event"] != "call_end" or "latency" not in event:
+            return
+
+        labels = (event["provider"], event["model"], event["phase"])
+        status = "cached" if event["cached"] else "failed" if event["failed"] else "ok"
+        with self.lock:
+            self.calls.inc(*labels, status)
+            self.latency.observe(*labels, value=event["latency"])
+            if event["cached"]:
+                return
+            self.ttft.observe(*labels, value=event["ttft"])
+            for kind in ("input", "output", "cache_read", "cache_write"):
+                self.tokens.inc(*labels, kind, amount=event.get(f"{kind}_tokens", 0))
+            self.output_tokens.observe(*labels, value=event.get("output_tokens", 0))
+            self.retries.inc(*labels, amount=event["retries"])
+            self.rate_limit_wait.inc(*labels, amount=event["rate_limit_wait"])
+
+    def render(self):
+        with self.lock:
+            lines = [line for metric in self.metrics for line in metric.render()]
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+# --------------------------------------------------------------------------------
+# Done :)
+# --------------------------------------------------------------------------------
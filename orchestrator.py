@@ -13,19 +13,14 @@
 from dotenv import load_dotenv
 load_dotenv() 
 
-import re
 import json
+import uuid
 import asyncio
 
-from datetime import datetime
-
 from typing import Any
-from typing import Dict
 from typing import Annotated
 from typing import Union
 
-import numpy as np
-import pandas as pd
 import os
 
 from pydantic import BaseModel
@@ -37,20 +32,31 @@ from pydantic import WithJsonSchema
 from rich.console import Console
 from rich.panel import Panel
 
-from agents import openai_client, anthropic_client, tavily_client, genai, ggl_safety_settings, iGPT, IGPT_KEY, IGPT_SECRET
-
-from anthropic import RateLimitError
-from requests.exceptions import HTTPError
-
-import time
+from agents import providers, ggl_safety_settings
 
-import io
-import zipfile
+import shutil
 
 
 from bson import ObjectId
 
-igpt_client = iGPT(IGPT_KEY, IGPT_SECRET)
+from ratelimit import rate_limiter
+from tokens import count_tokens, context_window, fit_sections, fit_section_texts, fit_prompt, tail_tokens
+from tokens import normalize_usage, cache_usage
+from tokens import TokenBudget, BudgetExceededError, run_budget, PROMPT_OVERHEAD
+from llmcache import llm_cache
+from searchcache import search_cache
+from events import RunEvents, run_events, emit
+from compaction import CONTEXT_KEEP, CONTEXT_DIGEST_TOKENS
+from compaction import fold_index, render_results, update_digest, needs_digest
+from tagparser import parse_output
+from artifacts import artifact_store, drop_store
+from metrics import CallMetrics, current_call, record_retry
+from tracing import Tracer, run_tracer, span, traced, annotate
+from planner import PlannedTask, PlanError, plan_prompt, plan_search_prompt
+from planner import parse_plan, plan_depth, run_plan
+from strategies import Strategy, register_strategy, get_strategy, similarity
+
+OUTPUT_DIR = os.environ.get('OUTPUT_DIR', './output')
 
 orch_base_prompt = '''
 Assess if the Objective has been fully achieved and if not, breakdown the next subtask.
@@ -100,6 +106,18 @@ class ModelConfig(BaseModel):
     orch_max_tokens: int = 4096
     sub_max_tokens: int = 4096
     refine_max_tokens: int = 4096
+    refine_concurrency: int = 4
+    # plan each era as a dependency graph of subtasks and run the independent
+    # ones concurrently, subtask_concurrency at a time (see planner.py)
+    task_planning: bool = False
+    subtask_concurrency: int = 4
+    # FixedPointIteration stops once two refined outputs are this similar
+    convergence_threshold: float = 0.95
+    context_compaction: bool = True
+    context_keep: int = CONTEXT_KEEP
+    context_digest_tokens: int = CONTEXT_DIGEST_TOKENS
+    max_continuation_tokens: int = 16384
+    continuation_tail: int = 2000
 
 
 class AgentConfig(BaseModel):
@@ -108,10 +126,17 @@ class AgentConfig(BaseModel):
     objective: str = Field(...)
     subtask_queries: dict[int, list[str]] = {}
     subtask_results: dict[int, list[str]] = {}
+    subtask_digests: dict[int, str] = {}
+    subtask_plans: dict[int, list[dict]] = {}
     era_results: list[str] = []
+    era_digests: dict[int, str] = {}
     files: dict[str, str] = {}
     use_search: bool = False
     include_files: bool = False
+    token_budget: int = 0
+    tokens_used: int = 0
+    # new, running (resumed from its checkpoint when started again) or complete
+    run_state: str = "new"
     model: ModelConfig
 
     class Config:
@@ -119,37 +144,381 @@ class AgentConfig(BaseModel):
         arbitrary_types_allowed = True
         json_encoders = {ObjectId: str}
 
+
+class ModelResponse(BaseModel):
+    text: str
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+    failed: bool = False
+    cached: bool = False
+    # the output allowance sent, the budget may have lowered the one asked for
+    max_tokens: int = 0
+
 # --------------------------------------------------------------------------------
-# Query the orchestrator for the next task
-# async
+# Query a model, dispatching on the model name to the async provider clients
+# max_tries = 0 keeps retrying rate limits forever, iGPT always gets >= 1 try
 # --------------------------------------------------------------------------------
 
 
-def query_orchestrator(agent: AgentConfig, idx_ref: int, era_output: str, console: Console):
-    console.print(f"\n[bold]Query orchestrator model: {agent.model.orchestrator_model}[/bold]")
+def is_truncated(response: ModelResponse, max_tokens: int):
+    return response.output_tokens > ((response.max_tokens or max_tokens) * 0.99)
+
+
+def print_usage(response: ModelResponse, title: str, console: Console):
+    console.print(f"[bold green]{title}[/bold green]")
+    console.print(f"[bold green]Input Tokens {response.input_tokens}[/bold green]")
+    console.print(f"[bold green]Output Tokens {response.output_tokens}[/bold green]")
+    if response.cache_read_tokens or response.cache_write_tokens:
+        console.print(f"[bold green]Prompt Cache Read {response.cache_read_tokens} "
+                      f"Write {response.cache_write_tokens}[/bold green]")
+
+
+async def query_anthropic(model_name: str, prompt: str, max_tokens: int,
+                          console: Console, max_tries: int = 0, on_text=None,
+                          prefill: str = None, prefix: str = None):
+    from anthropic import RateLimitError
+    client = providers.client("anthropic")
+    idx_try = 0
+    estimated = count_tokens(prompt)
+    content = [{"type": "text", "text": prompt}]
+    if prefix:
+        # the prefix is the same on every call of a run, cache it server side
+        content.insert(0, {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}})
+        estimated += count_tokens(prefix)
+    messages = [{"role": "user", "content": content}]
+    if prefill:
+        # the reply picks up right where the prefilled assistant turn stops
+        messages.append({"role": "assistant", "content": prefill})
+        estimated += count_tokens(prefill)
+    while True:
+        await rate_limiter.acquire("anthropic", model_name, estimated)
+        try:
+            async with client.messages.stream(
+                model=model_name,
+                max_tokens=max_tokens,
+                messages=messages
+            ) as stream:
+                rate_limiter.observe("anthropic", model_name, stream.response.headers)
+                async for text in stream.text_stream:
+                    if on_text is not None:
+                        on_text(text)
+                response = await stream.get_final_message()
+            input_tokens, output_tokens = normalize_usage("anthropic", response.usage)
+            cache_read, cache_write = cache_usage("anthropic", response.usage)
+            # cache reads don't count towards the input token rate limit
+            rate_limiter.record("anthropic", model_name, estimated,
+                                input_tokens + cache_write + output_tokens)
+            return ModelResponse(text=response.content[0].text,
+                                 input_tokens=input_tokens, output_tokens=output_tokens,
+                                 cache_read_tokens=cache_read, cache_write_tokens=cache_write)
+        except RateLimitError as e:
+            wait = rate_limiter.backoff("anthropic", model_name, idx_try, e.response.headers)
+            console.print(f"\n[bold red]Hit Rate Limit Error, will retry in {wait:.0f}s[/bold red]")
+            idx_try += 1
+            record_retry()
+            if max_tries and idx_try >= max_tries:
+                return ModelResponse(text="Rate Limit Error, anthropic AI sucks!", failed=True)
+
+
+async def query_gemini(model_name: str, prompt: str, max_tokens: int, console: Console,
+                       max_tries: int = 0, on_text=None, prefill: str = None):
+    from google.api_core.exceptions import ResourceExhausted
+    model = providers.client("gemini").GenerativeModel(model_name)
+    idx_try = 0
+    estimated = count_tokens(prompt)
+    contents = prompt
+    if prefill:
+        contents = [{"role": "user", "parts": [prompt]},
+                    {"role": "model", "parts": [prefill]},
+                    {"role": "user", "parts": [continue_prompt]}]
+        estimated += count_tokens(prefill)
+    while True:
+        await rate_limiter.acquire("gemini", model_name, estimated)
+        try:
+            response = await model.generate_content_async(contents, safety_settings=ggl_safety_settings,
+                                                          generation_config={"max_output_tokens": max_tokens},
+                                                          stream=True)
+            async for chunk in response:
+                try:
+                    if on_text is not None:
+                        on_text(chunk.text)
+                except ValueError:
+                    # blocked chunks have no text, reported below
+                    pass
+            break
+        except ResourceExhausted:
+            wait = rate_limiter.backoff("gemini", model_name, idx_try)
+            console.print(f"\n[bold red]Hit Rate Limit Error, will retry in {wait:.0f}s[/bold red]")
+            idx_try += 1
+            record_retry()
+            if max_tries and idx_try >= max_tries:
+                return ModelResponse(text="come again?", failed=True)
+    try:
+        text = response.text
+    except ValueError:
+        # If the response doesn't contain text, check if the prompt was blocked.
+        console.print(f"\n[bold red]Value Error During response.text[/bold red]")
+        console.print(f"\n[bold red]Prompt Feedback : {response.prompt_feedback}[/bold red]")
+        console.print(f"\n[bold red]Finish Reason : {response.candidates[0].finish_reason}[/bold red]")
+        console.print(f"\n[bold red]Safety Ratings : {response.candidates[0].safety_ratings}[/bold red]")
+        text = None
+    usage = getattr(response, "usage_metadata", None)
+    input_tokens, output_tokens = normalize_usage("gemini", usage)
+    cache_read, _ = cache_usage("gemini", usage)
+    response = ModelResponse(text="come again?" if text is None else text, failed=text is None,
+                             input_tokens=input_tokens, output_tokens=output_tokens,
+                             cache_read_tokens=cache_read)
+    rate_limiter.record("gemini", model_name, estimated,
+                        response.input_tokens + response.output_tokens)
+    return response
+
+
+async def query_igpt(prompt: str, role: str, max_tokens: int, correlation_id: str,
+                     console: Console, max_tries: int = 1, prefill: str = None):
+    igpt_client = providers.client("igpt")
+    conversation = []
+    estimated = count_tokens(prompt) + count_tokens(role)
+    conversation.append({'role': 'system', 'content': role})
+    conversation.append({'role': 'user', 'content': prompt})
+    if prefill:
+        conversation.append({'role': 'assistant', 'content': prefill})
+        conversation.append({'role': 'user', 'content': continue_prompt})
+        estimated += count_tokens(prefill)
+    console.print(f"\n[bold]iGPT prompt tokens: {estimated}[/bold]")
+    for idx_try in range(max(max_tries, 1)):
+        if idx_try > 0:
+            record_retry()
+        await rate_limiter.acquire("igpt", igpt_client.model, estimated)
+        # the client is shared by every run, the allowance goes with the request
+        response = await igpt_client.agenerate(conversation=conversation, correlationId=correlation_id,
+                                               max_tokens=max_tokens)
+        if isinstance(response, str) and response.startswith("iGPT Generate Error  429"):
+            wait = rate_limiter.backoff("igpt", igpt_client.model, idx_try)
+            console.print(f"\n[bold red]Hit Rate Limit Error, will retry in {wait:.0f}s[/bold red]")
+            continue
+        if 'usage' not in response or 'currentResponse' not in response:
+            console.print(f"[bold red]Error querying model {response}[/bold red]")
+            continue
+        input_tokens, output_tokens = normalize_usage("igpt", response['usage'])
+        rate_limiter.record("igpt", igpt_client.model, estimated, input_tokens + output_tokens)
+        return ModelResponse(text=response['currentResponse'],
+                             input_tokens=input_tokens, output_tokens=output_tokens)
+    return ModelResponse(text="come again?", failed=True)
+
+
+def provider_for(model_name: str):
+    provider = providers.provider_for(model_name)
+    if provider == "openai":
+        raise NotImplementedError("GPT-4 is not yet supported")
+    return provider
+
+
+async def query_model(model_name: str, prompt: str, max_tokens: int, console: Console,
+                      role: str = "You are a helpful assistant.",
+                      correlation_id: str = "iGPT design agents",
+                      max_tries: int = 0, phase: str = "model", prefill: str = None,
+                      prefix: str = None):
+    '''
+    prefix is the start of the prompt that stays the same across the calls of
+    a run, it is cached by the provider where that is supported. prefill is
+    the start of the reply, the model continues it as the next turn of the
+    conversation (see continue_model).
+    '''
+    provider = provider_for(model_name)
+    if prefix and provider != "anthropic":
+        # gemini caches repeated prefixes implicitly, iGPT not at all
+        prompt, prefix = prefix + prompt, None
+
+    # pre-flight, fit the model window then the run's token budget
+    full_prompt = (prefix or "") + prompt
+    fitted, max_tokens = fit_prompt(full_prompt, model_name, max_tokens)
+    if fitted != full_prompt:
+        console.print(f"[bold red]Prompt of {count_tokens(full_prompt)} tokens trimmed to fit "
+                      f"the {context_window(model_name)} token window of {model_name}[/bold red]")
+        prompt, prefix, full_prompt = fitted, None, fitted
+
+    messages = full_prompt if prefill is None else [full_prompt, prefill]
+    cache_key = llm_cache.key(provider, model_name, {"max_tokens": max_tokens, "role": role}, messages)
+    cached = await llm_cache.aget(cache_key)
+    budget = run_budget.get()
+    allowance, held = max_tokens, 0
+    if cached is None and budget is not None:
+        prompt_tokens = count_tokens(full_prompt) + count_tokens(role) + count_tokens(prefill or "")
+        allowance = budget.reserve(prompt_tokens, max_tokens)
+        # concurrent calls of the run can't spend what this one holds
+        held = prompt_tokens + allowance if budget.limit > 0 else 0
+    try:
+        if allowance < max_tokens:
+            # a reply cut short by the budget is only good for the same allowance
+            max_tokens = allowance
+            cache_key = llm_cache.key(provider, model_name, {"max_tokens": max_tokens, "role": role}, messages)
+            cached = await llm_cache.aget(cache_key)
+
+        call_id = uuid.uuid4().hex[:8]
+        call = CallMetrics(provider, model_name, phase)
+        call_token = current_call.set(call)
+        emit("call_start", call=call_id, phase=phase, model=model_name)
+        def on_text(text):
+            call.token()
+            emit("token", call=call_id, phase=phase, model=model_name, text=text)
+
+        with span("model_call", cat=phase, provider=provider, model=model_name, call=call_id):
+            try:
+                if cached is not None:
+                    console.print(f"[bold green]Cached {provider} response {cache_key[:12]}[/bold green]")
+                    response = ModelResponse(**cached).model_copy(update={"cached": True})
+                    on_text(response.text)
+                elif provider == "anthropic":
+                    response = await query_anthropic(model_name, prompt, max_tokens, console,
+                                                     max_tries=max_tries, on_text=on_text, prefill=prefill,
+                                                     prefix=prefix)
+                elif provider == "gemini":
+                    response = await query_gemini(model_name, prompt, max_tokens, console,
+                                                  max_tries=max_tries, on_text=on_text, prefill=prefill)
+                else:
+                    # the iGPT gateway doesn't stream, the text arrives in one piece
+                    response = await query_igpt(prompt, role, max_tokens, correlation_id, console,
+                                                max_tries=max_tries, prefill=prefill)
+                    on_text(response.text)
+            finally:
+                current_call.reset(call_token)
+            if not response.max_tokens:
+                response.max_tokens = max_tokens
+            annotate(input_tokens=response.input_tokens, output_tokens=response.output_tokens,
+                     cached=response.cached, failed=response.failed)
+
+        # never remember a give-up
+        if not response.failed and not response.cached:
+            await llm_cache.aput(cache_key, provider, model_name, response.model_dump(exclude={"cached"}))
+        if budget is not None and not response.cached:
+            input_tokens = response.input_tokens
+            if provider == "anthropic":
+                input_tokens += response.cache_read_tokens + response.cache_write_tokens
+            budget.charge(input_tokens, response.output_tokens, held)
+            held = 0
+        emit("call_end", call=call_id, phase=phase, model=model_name,
+             input_tokens=response.input_tokens, output_tokens=response.output_tokens,
+             cache_read_tokens=response.cache_read_tokens, cache_write_tokens=response.cache_write_tokens,
+             **call.fields(response))
+        return response
+    finally:
+        # an error or a cancel gives the tokens held for the call back
+        if held:
+            budget.release(held)
+
+
+def prompt_budget(model_name: str, max_tokens: int):
+    return context_window(model_name) - max_tokens - PROMPT_OVERHEAD
+
+
+# --------------------------------------------------------------------------------
+# Continue a truncated reply, the original prompt goes out again with the tail
+# of the reply so far as the assistant turn, so every continuation costs about
+# the prompt plus continuation_tail tokens however long the reply gets. Total
+# continuation output is capped by max_continuation_tokens.
+# --------------------------------------------------------------------------------
+
+
+continue_prompt = "Continue exactly where your previous response stopped, without repeating any of it."
+
 
+def join_continuation(text: str, prefill: str, continuation: str):
+    # anthropic rejects a prefill ending in whitespace, the model writes it again
+    if prefill != prefill.rstrip():
+        text = text.rstrip()
+    return text + continuation
+
+
+async def continue_model(model_name: str, prompt: str, response: ModelResponse,
+                         max_tokens: int, console: Console,
+                         max_continuation_tokens: int, continuation_tail: int,
+                         max_continuations: int = None, on_truncated=None,
+                         title: str = "Continued output", **kwargs):
+    '''
+    Text of response plus its continuations. on_truncated(text, idx_cont) is
+    awaited each time the reply so far was cut off.
+    '''
+    text = response.text
+    spent = 0
+    idx_cont = 0
+    while is_truncated(response, max_tokens):
+        if on_truncated is not None:
+            await on_truncated(text, idx_cont)
+        idx_cont += 1
+        if max_continuations is not None and idx_cont > max_continuations:
+            break
+        if spent >= max_continuation_tokens:
+            console.print(f"[bold red]Continuation cap of {max_continuation_tokens} tokens reached[/bold red]")
+            break
+
+        console.print(f"[bold red]Warning truncated output, will try and continue ...[/bold red]")
+        prefill = tail_tokens(text, continuation_tail)
+        with span("continuation", index=idx_cont):
+            response = await query_model(model_name, prompt, min(max_tokens, max_continuation_tokens - spent),
+                                         console, prefill=prefill.rstrip(), **kwargs)
+        print_usage(response, title, console)
+        if response.failed:
+            break
+        spent += response.output_tokens
+        text = join_continuation(text, prefill, response.text)
+
+        # response text
+        response_pnl = Panel(text,
+                             title=f"[bold blue]{title}[/bold blue]",
+                             title_align="",
+                             border_style="blue",
+                             subtitle=title)
+        console.print(response_pnl)
+    return text
+
+# --------------------------------------------------------------------------------
+# Query the orchestrator for the next task
+# --------------------------------------------------------------------------------
+
+
+def orchestrator_results(agent: AgentConfig, idx_ref: int, era_output: str):
     results_str = "None"
     if era_output is not None:
-        results_str = f"**Baseline Results**\n{era_output}"
+        # the digest of the baseline when it was too big to repeat every task
+        baseline = agent.era_digests.get(idx_ref - 1, era_output)
+        results_str = f"**Baseline Results**\n{baseline}"
 
-    results = [f"**Subtask {i} Results**\n{r}" for i, r in enumerate(agent.subtask_results[idx_ref])]
+    results = render_results(agent.subtask_results[idx_ref], agent.subtask_digests.get(idx_ref, ""),
+                             agent.model.context_keep, compact=agent.model.context_compaction)
     if len(results) > 0:
         results_str += "\n".join(results)
+    return results_str
+
+
+@traced("orchestrator")
+async def query_orchestrator(agent: AgentConfig, idx_ref: int, era_output: str, console: Console):
+    console.print(f"\n[bold]Query orchestrator model: {agent.model.orchestrator_model}[/bold]")
+
+    results_str = orchestrator_results(agent, idx_ref, era_output)
 
+    # (text, priority), files are trimmed before results when the prompt
+    # doesn't fit the window. Everything up to the results is the same for
+    # every task of the run and goes first so the provider can cache it.
     orch_prompt = [
-        "**PROMPT**\n\n",
-        "In order to fully, correctly and comprehensively complete the Objective, ",
-        f"{' and using the file content ' if agent.include_files else ''}",
-        f"{' without forgetting anything from the previous subtask results, ' if len(results_str) > 0 else ''}",
-        agent.model.orchestrator_prompt,
-        "If the previous subtask results comprehensively complete all the requirements of the objective ",
-        "start your response with the phrase 'Objective Complete:'. ",
-        f"\n\n**Objective:**\n{agent.objective}\n\n",
-        f"\n\n**Results:**\n{results_str}\n\n\n",
-        "IMPORTANT, YOUR JOB IS TO GENERATE A PROMPT FOR SUBAGENT IF THE OBJECTIVE IS NOT COMPLETE!!!!\n\n\n"
+        ("**PROMPT**\n\n", None),
+        ("In order to fully, correctly and comprehensively complete the Objective, ", None),
+        (f"{' and using the file content ' if agent.include_files else ''}", None),
+        (" without forgetting anything from the previous subtask results, ", None),
+        (agent.model.orchestrator_prompt, None),
+        ("If the previous subtask results comprehensively complete all the requirements of the objective ", None),
+        ("start your response with the phrase 'Objective Complete:'. ", None),
+        (f"\n\n**Objective:**\n{agent.objective}\n\n", None),
     ]
     if agent.include_files:
-        orch_prompt += [f'**File content ({name}):**\n{cont}\n\n' for name, cont in agent.files.items()]
+        orch_prompt += [(f'**File content ({name}):**\n{cont}\n\n', 1) for name, cont in agent.files.items()]
+    idx_prefix = len(orch_prompt)
+
+    orch_prompt += [
+        (f"\n\n**Results:**\n{results_str}\n\n\n", 2),
+        ("IMPORTANT, YOUR JOB IS TO GENERATE A PROMPT FOR SUBAGENT IF THE OBJECTIVE IS NOT COMPLETE!!!!\n\n\n", None)
+    ]
 
     if agent.use_search:
         # TODO: rewrite the boilerplate search query
@@ -159,75 +528,25 @@ def query_orchestrator(agent: AgentConfig, idx_ref: int, era_output: str, consol
             "The question should be specific and targeted to elicit the most relevant and helpful resources. ",
             "Format your JSON like this, with no additional text before or after:\n{'search_query': '<question>'}\n"
         ]
-        orch_prompt += ["".join(search_query)]
-
-    orch_str = "".join(orch_prompt)
-    orch_response = None
-    if 'claude' in agent.model.orchestrator_model:
-        orch_messages = [{"role": "user", "content": [{"type": "text", "text": orch_str}]}]
-        while True:
-            try:
-                orch_response = anthropic_client.messages.create(
-                    model=agent.model.orchestrator_model,
-                    max_tokens=agent.model.orch_max_tokens,
-                    messages=orch_messages
-                )
-                console.print(f"[bold green]Orchestrator output[/bold green]")
-                console.print(f"[bold green]Input Tokens {orch_response.usage.input_tokens}[/bold green]")
-                console.print(f"[bold green]Output Tokens {orch_response.usage.output_tokens}[/bold green]")
-                response_text = orch_response.content[0].text
-                break
-            except RateLimitError as e:
-                console.print(f"\n[bold red]Hit Rate Limit Error, will retry in 60s[/bold red]")
-                time.sleep(60)
-
-    elif 'gemini' in agent.model.orchestrator_model:
-        model = genai.GenerativeModel(agent.model.orchestrator_model)
-        orch_response = model.generate_content("".join(orch_prompt), safety_settings=ggl_safety_settings)
-        try:
-            response_text = orch_response.text
-        except ValueError:
-            # If the response doesn't contain text, check if the prompt was blocked.
-            console.print(f"\n[bold red]Value Error During response.text[/bold red]")
-            console.print(f"\n[bold red]Prompt Feedback : {orch_response.prompt_feedback}[/bold red]")
-            console.print(f"\n[bold red]Finish Reason : {orch_response.candidates[0].finish_reason}[/bold red]")
-            console.print(f"\n[bold red]Safety Ratings : {orch_response.candidates[0].safety_ratings}[/bold red]")
-            response_text = "come again?"
-    
-
-    elif 'igpt' in agent.model.orchestrator_model:
-        global igpt_client
-        conversation = []
-        role = "You are a expert at creating prompts for AI sub-agents."
-        orch_prompt.append("\n\nDO NOT INCLUDE THE PHRASE 'Objective Complete:' IN YOUR RESPONSE UNTIL THE OBJECTIVE IS FULLY COMPLETED!\n\n")
-        orch_str = "".join(orch_prompt)
-        console.print(f"\n[bold]iGPT content length: {len(orch_str)}[/bold]")
-        console.print(f"\n[bold]iGPT total length: {len(orch_str) + len(role)}[/bold]")
-        conversation.append({'role': 'system', 'content': role})
-        conversation.append({'role': 'user', 'content': orch_str})
-
-        orch_response = igpt_client.generate(conversation=conversation, correlationId=str(agent.id))
-        if "Token has expired" in orch_response:
-            igpt_client = iGPT(key=IGPT_KEY, secret=IGPT_SECRET)
-            orch_response = igpt_client.generate(conversation=conversation, correlationId=str(agent.id))
-
-        if 'usage' in orch_response:
-            console.print(f"[bold green]Orchestrator output[/bold green]")
-            console.print(f"[bold green]Input Tokens {orch_response['usage']['promptTokens']}[/bold green]")
-            console.print(f"[bold green]Output Tokens {orch_response['usage']['completionTokens']}[/bold green]")
-        try:
-            response_text = orch_response['currentResponse']
-        except TypeError as e:
-            console.print(f"[bold red]Error querying orchestrator model {orch_response}[/bold red]")
-            response_text = "come again?"
-
-    elif 'gpt' in agent.model.orchestrator_model:
-        raise NotImplementedError("GPT-4 is not yet supported")
-    else:
-        raise ValueError(f"Unsupported orchestrator model: {agent.model.orchestrator_model}")
+        orch_prompt += [("".join(search_query), None)]
+
+    if 'igpt' in agent.model.orchestrator_model:
+        orch_prompt.append(("\n\nDO NOT INCLUDE THE PHRASE 'Objective Complete:' IN YOUR RESPONSE UNTIL THE OBJECTIVE IS FULLY COMPLETED!\n\n", None))
+
+    orch_texts = fit_section_texts(orch_prompt, prompt_budget(agent.model.orchestrator_model,
+                                                              agent.model.orch_max_tokens))
+    orch_prefix = "".join(orch_texts[:idx_prefix])
+    orch_str = "".join(orch_texts[idx_prefix:])
+    orch_response = await query_model(agent.model.orchestrator_model, orch_str,
+                                      agent.model.orch_max_tokens, console,
+                                      role="You are a expert at creating prompts for AI sub-agents.",
+                                      correlation_id=str(agent.id), phase="orchestrator",
+                                      prefix=orch_prefix)
+    print_usage(orch_response, "Orchestrator output", console)
+    response_text = orch_response.text
 
     # response text
-    response_pnl = Panel(response_text, 
+    response_pnl = Panel(response_text,
                         title=f"[bold green]Orchestrator[/bold green]",
                         title_align="",
                         border_style="yellow",
@@ -247,20 +566,99 @@ def query_orchestrator(agent: AgentConfig, idx_ref: int, era_output: str, consol
     return response_text, search_query
 
 
+@traced("plan")
+async def query_planner(agent: AgentConfig, idx_ref: int, era_output: str, console: Console):
+    '''
+    Planning mode, the orchestrator returns the subtasks of the era with
+    their dependencies. No subtasks when the objective is complete.
+    '''
+    console.print(f"\n[bold]Query orchestrator model for a plan: {agent.model.orchestrator_model}[/bold]")
+
+    plan_sections = [
+        ("**PROMPT**\n\n", None),
+        ("In order to fully, correctly and comprehensively complete the Objective, ", None),
+        (f"{' and using the file content ' if agent.include_files else ''}", None),
+        (" without forgetting anything from the previous subtask results, ", None),
+        (plan_prompt.format(max_tasks=agent.model.task_iter), None),
+        (plan_search_prompt if agent.use_search else "", None),
+        ("If the previous results comprehensively complete all the requirements of the objective ", None),
+        ("start your response with the phrase 'Objective Complete:' instead of a plan. ", None),
+        (f"\n\n**Objective:**\n{agent.objective}\n\n", None),
+    ]
+    if agent.include_files:
+        plan_sections += [(f'**File content ({name}):**\n{cont}\n\n', 1) for name, cont in agent.files.items()]
+    idx_prefix = len(plan_sections)
+    plan_sections.append((f"\n\n**Results:**\n{orchestrator_results(agent, idx_ref, era_output)}\n\n\n", 2))
+
+    plan_texts = fit_section_texts(plan_sections, prompt_budget(agent.model.orchestrator_model,
+                                                                agent.model.orch_max_tokens))
+    plan_response = await query_model(agent.model.orchestrator_model, "".join(plan_texts[idx_prefix:]),
+                                      agent.model.orch_max_tokens, console,
+                                      role="You are a expert at planning work for AI sub-agents.",
+                                      correlation_id=str(agent.id), phase="orchestrator",
+                                      prefix="".join(plan_texts[:idx_prefix]))
+    print_usage(plan_response, "Planner output", console)
+    response_text = plan_response.text
+    console.print(Panel(response_text,
+                        title=f"[bold green]Planner[/bold green]",
+                        title_align="",
+                        border_style="yellow",
+                        subtitle="SubAgent Tasks"))
+
+    if "Objective Complete:" in response_text:
+        return response_text, []
+    try:
+        tasks = parse_plan(response_text, agent.model.task_iter)
+    except PlanError as e:
+        # run the reply as a single subtask, like the one task at a time mode
+        console.print(f"[bold red]{e}, running the reply as one subtask[/bold red]")
+        tasks = [PlannedTask(id="task_0", prompt=response_text)]
+    annotate(tasks=len(tasks), depth=plan_depth(tasks))
+    return response_text, tasks
+
+
 # --------------------------------------------------------------------------------
 # Search current data for the next task
+# tavily only ships a blocking client, run it on a worker thread. Searches go
+# through the search cache so repeated and concurrent questions share a result
 # --------------------------------------------------------------------------------
 
 
-def query_search_provider(query: str, provider: str, console: Console):
+async def search_tavily(query: str):
+    from tavily import UsageLimitExceededError
+    from requests.exceptions import HTTPError
+    tavily_client = providers.client("tavily")
+    idx_try = 0
+    while True:
+        await rate_limiter.acquire("tavily", "qna_search")
+        try:
+            return await asyncio.to_thread(tavily_client.qna_search, query=query)
+        except (HTTPError, UsageLimitExceededError):
+            if idx_try > 0:
+                raise
+            rate_limiter.backoff("tavily", "qna_search", idx_try)
+            idx_try += 1
+
+
+@traced("search")
+async def query_search_provider(query: str, provider: str, console: Console):
     if provider == "tavily":
+        from tavily import UsageLimitExceededError
+        from requests.exceptions import HTTPError
+        lookups = []
+
+        def on_lookup(outcome):
+            lookups.append(outcome)
+            # the server adds these up over every worker for /metrics
+            emit("search", provider=provider, outcome=outcome)
+
         try:
-            search_response = tavily_client.qna_search(query=query)
-        except HTTPError as e:
-            try:
-                search_response = tavily_client.qna_search(query=query)
-            except HTTPError as e:
-                search_response = "Error querying Tavily"
+            search_response = await search_cache.get_or_fetch(
+                f"tavily:{search_cache.normalize(query)}", lambda: search_tavily(query), on_lookup)
+        except (HTTPError, UsageLimitExceededError):
+            search_response = "Error querying Tavily"
+        if lookups != ["miss"]:
+            console.print(f"[bold green]Cached search result {search_cache.stats()}[/bold green]")
     else:
         raise ValueError(f"Unsupported search provider: {provider}")
     response_pnl = Panel(search_response,
@@ -277,7 +675,8 @@ def query_search_provider(query: str, provider: str, console: Console):
 # --------------------------------------------------------------------------------
 
 
-def refine_output_continue(agent: AgentConfig, idx_ref: int, era_output: str, console: Console):
+@traced("refine")
+async def refine_output_continue(agent: AgentConfig, idx_ref: int, era_output: str, console: Console):
     console.print("\n[bold]Refining the Subtask results[/bold]")
 
     subtask_str = '\n\n'.join([f"**Subtask {i}**\n{r}" for i, r in enumerate(agent.subtask_results[idx_ref])])
@@ -287,8 +686,11 @@ def refine_output_continue(agent: AgentConfig, idx_ref: int, era_output: str, co
     if era_output is not None:
         refiner_prompt.append(f"**Baseline result:**\n{era_output}\n\n",)
 
-    refiner_prompt += [
-        f"**Results:**\n{subtask_str}\n\n",
+    # objective, baseline and results repeat on every continuation, cache them
+    refiner_prompt.append(f"**Results:**\n{subtask_str}\n\n")
+    refiner_prefix = "".join(refiner_prompt)
+
+    refiner_prompt = [
         "**PROMPT:**\n\n",
         agent.model.refiner_prompt,
         "Provide a relevent, brief and descriptive name for the project and include it in the final output in the format <project_name>name</project_name>. ",
@@ -302,100 +704,31 @@ def refine_output_continue(agent: AgentConfig, idx_ref: int, era_output: str, co
         ]
     refiner_str = "".join(refiner_prompt)
 
-    if "claude" in agent.model.refiner_model:
-        idx_try = 0
-        while True:
-            try:
-                content = [{"type": "text", "text": refiner_str}]
-                refiner_response = anthropic_client.messages.create(
-                    model=agent.model.refiner_model,
-                    max_tokens=agent.model.refine_max_tokens,
-                    messages=[{"role": "user", "content": content}]
-                )
-                console.print(f"[bold green]Refined output, prompt length "
-                              f"{len(refiner_str)}[/bold green]")
-                console.print(f"[bold green]Input Tokens "
-                              f"{refiner_response.usage.input_tokens}"
-                              "[/bold green]")
-                console.print(f"[bold green]Output Tokens "
-                              f"{refiner_response.usage.output_tokens}"
-                              "[/bold green]")
-                refined_output = refiner_response.content[0].text
-
-                # response text
-                response_pnl = Panel(refined_output, 
-                                    title=f"[bold magenta]Refiner Output[/bold magenta]",
-                                    title_align="",
-                                    border_style="magenta",
-                                    subtitle="Refiner Output")
-                console.print(response_pnl)
-
-                idx_cont = 0
-                while refiner_response.usage.output_tokens > (agent.model.refine_max_tokens * 0.99):
-
-                    zip_bytes = extract_output(refined_output, agent=agent, console=console, idx_cont=idx_cont)
-                    idx_cont += 1
-                    if idx_cont > 3:
-                        break
-
-                    console.print(f"[bold red]Warning truncated output, will try and continue ...[/bold red]")
-                    refiner_continue_prompt = f"\n**PROMPT**\n\nContinuing from the Previous Response, please continue the response\n\n**PROMPT**\n\n"
-                    refiner_continue_prompt += f"\n**Previous Response:**\n\n{refined_output}"
-                    refiner_continue_prompt += f"\n\n**Original Query**\n\n{refiner_str}\n\n**Original Query**\n\n"
-
-                    # response text
-                    response_pnl = Panel(refiner_continue_prompt,
-                                         title=f"[bold cyan]Continued Refiner Prompt[/bold cyan]",
-                                         title_align="",
-                                         border_style="cyan",
-                                         subtitle="Continued Refiner Prompt")
-                    console.print(response_pnl)
-
-                    content = [{"type": "text", "text": refiner_continue_prompt}]
-                    refiner_response = anthropic_client.messages.create(
-                        model=agent.model.refiner_model,
-                        max_tokens=agent.model.refine_max_tokens,
-                        messages=[{"role": "user", "content": content}]
-                    )
-
-                    console.print(f"[bold green]Refined output, prompt length {len(refiner_str)}[/bold green]")
-                    console.print(f"[bold green]Input Tokens {refiner_response.usage.input_tokens}[/bold green]")
-                    console.print(f"[bold green]Output Tokens {refiner_response.usage.output_tokens}[/bold green]")
-                    refined_output += refiner_response.content[0].text
-
-                    # response text
-                    response_pnl = Panel(refined_output,
-                                         title=f"[bold blue]Continued Refiner Output[/bold blue]",
-                                         title_align="",
-                                         border_style="blue",
-                                         subtitle="Continued Refiner Output")
-                    console.print(response_pnl)
+    refiner_response = await query_model(agent.model.refiner_model, refiner_str,
+                                         agent.model.refine_max_tokens, console,
+                                         role="You are a master software architect.",
+                                         correlation_id=str(agent.id), max_tries=4, phase="refiner",
+                                         prefix=refiner_prefix)
+    console.print(f"[bold green]Refined output, prompt length "
+                  f"{len(refiner_prefix) + len(refiner_str)}[/bold green]")
+    print_usage(refiner_response, "Refiner output", console)
+    refined_output = refiner_response.text
 
-                break
-            except RateLimitError as e:
-                console.print(f"\n[bold red]Hit Rate Limit Error, will retry in 60s[/bold red]")
-                idx_try += 1
-                if idx_try > 3:
-                    refined_output = "Rate Limit Error, anthropic AI sucks!"
-                    break
-                time.sleep(60)
-    elif "gemini" in agent.model.refiner_model:
-        model = genai.GenerativeModel(agent.model.refiner_model)
-        ref_response = model.generate_content("".join(refiner_prompt))
-        try:
-            refined_output = ref_response.text
-        except ValueError:
-            # If the response doesn't contain text, check if the prompt was blocked.
-            console.print(f"\n[bold red]Value Error During response.text[/bold red]")
-            console.print(f"\n[bold red]Prompt Feedback : {ref_response.prompt_feedback}[/bold red]")
-            console.print(f"\n[bold red]Finish Reason : {ref_response.candidates[0].finish_reason}[/bold red]")
-            console.print(f"\n[bold red]Safety Ratings : {ref_response.candidates[0].safety_ratings}[/bold red]")
-            refined_output = "come again?"
-    elif 'gpt' in agent.model.refiner_model:
-        raise ValueError(f"Unsupported refiner model: {agent.model.refiner_model}")
-    else:
-        raise ValueError(f"Unsupported refiner model: {agent.model.refiner_model}")
+    # response text
+    response_pnl = Panel(refined_output,
+                        title=f"[bold magenta]Refiner Output[/bold magenta]",
+                        title_align="",
+                        border_style="magenta",
+                        subtitle="Refiner Output")
+    console.print(response_pnl)
 
+    refined_output = await continue_model(
+        agent.model.refiner_model, refiner_str, refiner_response, agent.model.refine_max_tokens, console,
+        agent.model.max_continuation_tokens, agent.model.continuation_tail, max_continuations=3,
+        on_truncated=lambda text, idx_cont: commit_artifacts(agent, text, console, complete_only=True),
+        title="Continued Refiner Output", role="You are a master software architect.",
+        correlation_id=str(agent.id), max_tries=4, phase="refiner", prefix=refiner_prefix)
+    await commit_artifacts(agent, refined_output, console)
 
     response_pnl = Panel(refined_output,
                          title="[bold orange]Refined Result[/bold orange]",
@@ -406,7 +739,69 @@ def refine_output_continue(agent: AgentConfig, idx_ref: int, era_output: str, co
     return refined_output
 
 
-def refine_output(agent: AgentConfig, idx_ref: int, era_output: str, console: Console):
+def list_files(entry, name: str = ""):
+    if isinstance(entry, dict):
+        names = []
+        for key, value in entry.items():
+            names += list_files(value, f"{name}/{key}")
+        return names
+    return [name]
+
+
+@traced("refine_file")
+async def refine_file(agent: AgentConfig, name: str, subtask_str: str,
+                      folder_structure: str, files: dict[str, str],
+                      refined_output: str, console: Console):
+    # the prefix is shared by every file of the project, only the existing
+    # files and the file name change between the calls
+    refiner_prefix = "\n\n".join([
+        "** PROMPT **",
+        agent.model.refiner_prompt,
+        f"** Subtask Results **\n{subtask_str}",
+        f"** Folder Structure **\n{folder_structure}",
+        "",
+        ])
+    existing_files = "\n\n".join([f"{c}" for n, c in files.items()])
+    refiner_files = [
+        f"** Existing Files **\n\n{existing_files}",
+        f"Please include ONLY the file contents for {name} and not any other info!!",
+        f"DO NOT INCLUDE the triple backticks ``` and filetype just the text inside the files!",
+        ]
+    refiner_file_str = "\n\n".join(refiner_files)
+    console.print(f"\n[bold]Generating File Output For : {name}[/bold]")
+    annotate(file=name)
+    file_response = await query_model(agent.model.refiner_model, refiner_file_str,
+                                      agent.model.refine_max_tokens, console,
+                                      role="You are a expert at coding large projects who can comprehend lots of detail.",
+                                      correlation_id=str(agent.id), max_tries=3, phase="refiner",
+                                      prefix=refiner_prefix)
+    console.print(f"[bold green]Refined output, prompt length "
+                  f"{len(refiner_prefix) + len(refiner_file_str)}[/bold green]")
+    print_usage(file_response, "Refiner File Output Tokens", console)
+    file_output = file_response.text
+
+    if parse_output(file_output).file(name) is None:
+        file_output = f'\n\n<file name="{name}">\n{file_output}\n</file>\n\n'
+    else:
+        file_output = f'\n\n{file_output}\n\n'
+
+    # response text
+    response_pnl = Panel(file_output,
+                         title=f"[bold magenta]Refiner Output[/bold magenta]",
+                         title_align="",
+                         border_style="magenta",
+                         subtitle=f"Refined File Output {name}")
+    console.print(response_pnl)
+
+    if is_truncated(file_response, agent.model.refine_max_tokens):
+        console.print(f"[bold red]Warning truncated output, saving what there is ...[/bold red]")
+    await commit_artifacts(agent, file_output, console)
+
+    return file_output
+
+
+@traced("refine")
+async def refine_output(agent: AgentConfig, idx_ref: int, era_output: str, console: Console):
     console.print("\n[bold]Refining the Subtask results[/bold]")
 
     subtask_str = '\n\n'.join([f"**Subtask {i}**\n{r}" for i, r in enumerate(agent.subtask_results[idx_ref])])
@@ -416,11 +811,13 @@ def refine_output(agent: AgentConfig, idx_ref: int, era_output: str, console: Co
     if era_output is not None:
         refiner_prompt.append(f"** Baseline result **\n\n{era_output}\n\n",)
 
-    refiner_folders = [
+    refiner_prefix = "".join([
         f"** Subtask Results **\n\n{subtask_str}\n\n",
         "** PROMPT **\n\n",
         agent.model.refiner_prompt,
         *refiner_prompt,
+        ])
+    refiner_folders = [
         "Provide a relevent, brief and descriptive name for the project and include it in the final output in the format <project_name>name</project_name>. ",
         "INCLUDE THE FOLLOWING:\n",
         "1. Folder Structure: Provide the folder structure as a valid JSON object, ",
@@ -437,324 +834,69 @@ def refine_output(agent: AgentConfig, idx_ref: int, era_output: str, console: Co
                           subtitle="Original Objective")
     console.print(objective_pnl)
 
-    refined_output = None
-    if "claude" in agent.model.refiner_model:
-        idx_try = 0
-        while True:
-            console.print(f"[bold green]Refined output, prompt length "
-                            f"{len(refiner_str)}[/bold green]")
-            try:
-                content = [{"type": "text", "text": refiner_str}]
-                refiner_response = anthropic_client.messages.create(
-                    model=agent.model.refiner_model,
-                    max_tokens=agent.model.refine_max_tokens,
-                    messages=[{"role": "user", "content": content}]
-                )
-                console.print(f"[bold green]Input Tokens "
-                              f"{refiner_response.usage.input_tokens}"
-                              "[/bold green]")
-                console.print(f"[bold green]Output Tokens "
-                              f"{refiner_response.usage.output_tokens}"
-                              "[/bold green]")
-                refined_output = refiner_response.content[0].text
-
-                # response text
-                response_pnl = Panel(refined_output, 
-                                     title=f"[bold magenta]Refiner Output[/bold magenta]",
-                                     title_align="",
-                                     border_style="magenta",
-                                     subtitle="Refined Folder Structure")
-                console.print(response_pnl)
-
-                idx_cont = 0
-                while refiner_response.usage.output_tokens > (agent.model.refine_max_tokens * 0.99):
-                    console.print(f"[bold red]Warning truncated output, will try and save result ...[/bold red]")
-                    zip_bytes = extract_output(refined_output, agent=agent, console=console, idx_cont=idx_cont)
-
-                    idx_cont += 1
-                    if idx_cont > 3:
-                        break
-                    
-                    refiner_continue_prompt = f"** PROMPT **\n\nContinuing from the Previous Response, please continue the response\n\n"
-                    refiner_continue_prompt += f"** Previous Response **\n\n{refined_output}\n\n"
-                    refiner_continue_prompt += f"** Original Query **\n\n{refiner_str}\n\n"
-
-                    # response text
-                    response_pnl = Panel(refiner_continue_prompt,
-                                         title=f"[bold cyan]Continued Refiner Prompt[/bold cyan]",
-                                         title_align="",
-                                         border_style="cyan",
-                                         subtitle="Continued Refiner Prompt")
-                    console.print(response_pnl)
-
-                    content = [{"type": "text", "text": refiner_continue_prompt}]
-                    refiner_response = anthropic_client.messages.create(
-                        model=agent.model.refiner_model,
-                        max_tokens=agent.model.refine_max_tokens,
-                        messages=[{"role": "user", "content": content}]
-                    )
-
-                    console.print(f"[bold green]Refined output, prompt length {len(refiner_str)}[/bold green]")
-                    console.print(f"[bold green]Input Tokens {refiner_response.usage.input_tokens}[/bold green]")
-                    console.print(f"[bold green]Output Tokens {refiner_response.usage.output_tokens}[/bold green]")
-                    refined_output += refiner_response.content[0].text
-
-                    # response text
-                    response_pnl = Panel(refined_output,
-                                         title=f"[bold blue]Continued Refiner Output[/bold blue]",
-                                         title_align="",
-                                         border_style="blue",
-                                         subtitle="Continued Refiner Output")
-                    console.print(response_pnl)
-
-                break
-            except RateLimitError as e:
-                console.print(f"\n[bold red]Hit Rate Limit Error, will retry in 60s[/bold red]")
-                idx_try += 1
-                if idx_try > 2:
-                    refined_output = "Rate Limit Error, anthropic AI sucks!"
-                    break
-                time.sleep(60)
-        
-        # Extract the folder structure and files
-        folder_structure = None
-        
-        if "<folder_structure>" in refined_output:
-            folder_structure = json.loads(refined_output.split("<folder_structure>")[1].split("</folder_structure>")[0])
-
-            # extract the files
-            files = {}
-            def walk_folder(name, entry, files, folder_structure=refined_output, agent=agent):
-                if isinstance(entry, dict):
-                    for key, value in entry.items():
-                        walk_folder(f"{name}/{key}", value, files)
-                else:
-                    existing_files = "\n\n".join([f"{c}" for n, c in files.items()])
-                    refiner_files = [
-                        f"** Subtask Results **\n{subtask_str}",
-                        f"** Folder Structure **\n{folder_structure}",
-                        f"** Existing Files **\n\n{existing_files}",
-                        "** PROMPT **",
-                        agent.model.refiner_prompt,
-                        f"Please include ONLY the file contents for {name} and not any other info!!",
-                        f"DO NOT INCLUDE the triple backticks ``` and filetype just the text inside the files!",
-                        ]
-                    refiner_str = "\n\n".join(refiner_files)
-                    idx_try = 0
-                    while True:
-                        try:
-                            content = [{"type": "text", "text": refiner_str}]
-                            refiner_response = anthropic_client.messages.create(
-                                model=agent.model.refiner_model,
-                                max_tokens=agent.model.refine_max_tokens,
-                                messages=[{"role": "user", "content": content}]
-                            )
-                            console.print(f"[bold green]Refined output, prompt length "
-                                          f"{len(refiner_str)}[/bold green]")
-                            console.print(f"[bold green]Input Tokens "
-                                          f"{refiner_response.usage.input_tokens}"
-                                          "[/bold green]")
-                            console.print(f"[bold green]Output Tokens "
-                                          f"{refiner_response.usage.output_tokens}"
-                                          "[/bold green]")
-                            file_output = f'\n\n<file name="{name}">\n{refiner_response.content[0].text}\n</file>\n\n'
-                            files[name] = file_output
-
-                            # response text
-                            response_pnl = Panel(file_output, 
-                                                 title=f"[bold magenta]Refiner Output[/bold magenta]",
-                                                 title_align="",
-                                                 border_style="magenta",
-                                                 subtitle=f"Refined File Output {name}")
-                            console.print(response_pnl)
-
-                            if refiner_response.usage.output_tokens > (agent.model.refine_max_tokens * 0.99):
-                                console.print(f"[bold red]Warning truncated output, will try and save result ...[/bold red]")
-                                zip_bytes = extract_output(refined_output, agent=agent, console=console, idx_cont=idx_try)
-
-                            break
-                        except RateLimitError as e:
-                            console.print(f"\n[bold red]Hit Rate Limit Error, will retry in 60s[/bold red]")
-                            idx_try += 1
-                            if idx_try > 2:
-                                refined_output = "Rate Limit Error, anthropic AI sucks!"
-                                break
-                            time.sleep(60)
-
-            walk_folder("", folder_structure, files)
-            for filename, content in files.items():
-                refined_output += content
-
-
-    elif "gemini" in agent.model.refiner_model:
-        model = genai.GenerativeModel(agent.model.refiner_model)
-        ref_response = model.generate_content("".join(refiner_prompt))
-        try:
-            refined_output = ref_response.text
-        except ValueError:
-            # If the response doesn't contain text, check if the prompt was blocked.
-            console.print(f"\n[bold red]Value Error During response.text[/bold red]")
-            console.print(f"\n[bold red]Prompt Feedback : {ref_response.prompt_feedback}[/bold red]")
-            console.print(f"\n[bold red]Finish Reason : {ref_response.candidates[0].finish_reason}[/bold red]")
-            console.print(f"\n[bold red]Safety Ratings : {ref_response.candidates[0].safety_ratings}[/bold red]")
-            refined_output = "come again?"
-
-        # Extract the folder structure and files
-        folder_structure = None
-        if "<folder_structure>" in refined_output:
-            folder_structure = json.loads(refined_output.split("<folder_structure>")[1].split("</folder_structure>")[0])
-
-            # extract the files
-            files = {}
-            def walk_folder(name, entry, files, refined_output=refined_output, agent=agent):
-                if isinstance(entry, dict):
-                    for key, value in entry.items():
-                        walk_folder(f"{name}/{key}", value, files)
-                else:
-                    existing_files = "\n\n".join([f"{c}" for n, c in files.items()])
-                    refiner_files = [
-                        f"** Subtask Results **\n{subtask_str}",
-                        f"** Folder Structure **\n{folder_structure}",
-                        f"** Existing Files **\n\n{existing_files}",
-                        "** PROMPT **",
-                        agent.model.refiner_prompt,
-                        f"Please include ONLY the file contents for {name} and not any other info!!",
-                        f"DO NOT INCLUDE the triple backticks ``` and filetype just the text inside the files!",
-                        ]
-                    refiner_str = "\n\n".join(refiner_files)
-                    refiner_response = model.generate_content(refiner_str)
-                    file_output = None
-                    try:
-                        file_output = ref_response.text
-                    except ValueError:
-                        # If the response doesn't contain text, check if the prompt was blocked.
-                        console.print(f"\n[bold red]Value Error During response.text[/bold red]")
-                        console.print(f"\n[bold red]Prompt Feedback : {ref_response.prompt_feedback}[/bold red]")
-                        console.print(f"\n[bold red]Finish Reason : {ref_response.candidates[0].finish_reason}[/bold red]")
-                        console.print(f"\n[bold red]Safety Ratings : {ref_response.candidates[0].safety_ratings}[/bold red]")
-                        file_output = "come again?"
-                    if f'<file name="{name}">' not in file_output:
-                        file_output = f'\n\n<file name="{name}">\n{file_output}\n</file>\n\n'
-                    else:
-                        file_output = f'\n\n{file_output}\n\n'
-
-                    files[name] = file_output
-
-            walk_folder("", folder_structure, files)
-            for filename, content in files.items():
-                refined_output += content
-
-
-    elif 'igpt' in agent.model.refiner_model:
-        global igpt_client
-        conversation = []
-        role = "You are a master software architect."
-        console.print(f"\n[bold]Generating File Structure[/bold]")
-        console.print(f"[bold]iGPT content length: {len(refiner_str)}[/bold]")
-        console.print(f"[bold]iGPT total length: {len(refiner_str) + len(role)}[/bold]")
-        conversation.append({'role': 'system', 'content': role})
-        conversation.append({'role': 'user', 'content': refiner_str})
-        for idx_try in range(3):
-            ref_response = igpt_client.generate(conversation=conversation, correlationId=str(agent.id))
-            if "Token has expired" in ref_response:
-                igpt_client = iGPT(key=IGPT_KEY, secret=IGPT_SECRET)
-                ref_response = igpt_client.generate(conversation=conversation, correlationId=str(agent.id))
-
-            if 'usage' in ref_response:
-                console.print(f"[bold green]Refiner File Structure Tokens[/bold green]")
-                console.print(f"[bold green]Input Tokens {ref_response['usage']['promptTokens']}[/bold green]")
-                console.print(f"[bold green]Output Tokens {ref_response['usage']['completionTokens']}[/bold green]")
-            else:
-                console.print(f"[bold red]Error querying refinement model {ref_response}[/bold red]")
-                continue
-            if 'currentResponse' in ref_response:
-                refined_output = ref_response['currentResponse']
-                break
-        if refined_output is None:
-            refined_output = "come again?"
-
-        # Extract the folder structure and files
-        folder_structure = None
-        if "<folder_structure>" in refined_output:
-            folder_structure = json.loads(refined_output.split("<folder_structure>")[1].split("</folder_structure>")[0])
-
-            # extract the files
-            files = {}
-            def walk_folder(name, entry, files, folder_structure=refined_output, agent=agent):
-                global igpt_client
-                if isinstance(entry, dict):
-                    for key, value in entry.items():
-                        walk_folder(f"{name}/{key}", value, files)
-                else:
-                    existing_files = "\n\n".join([f"{c}" for n, c in files.items()])
-                    refiner_files = [
-                        f"** Subtask Results **\n{subtask_str}",
-                        f"** Folder Structure **\n{folder_structure}",
-                        f"** Existing Files **\n\n{existing_files}",
-                        "** PROMPT **",
-                        agent.model.refiner_prompt,
-                        f"Please include ONLY the file contents for {name} and not any other info!!",
-                        f"DO NOT INCLUDE the triple backticks ``` and filetype just the text inside the files!",
-                        ]
-                    file_output = None
-                    conversation = []
-                    role = "You are a master software architect."
-                    refiner_file_str = "\n\n".join(refiner_files)
-                    console.print(f"\n[bold]Generating File Output For : {name}[/bold]")
-                    console.print(f"[bold]iGPT content length: {len(refiner_file_str)}[/bold]")
-                    console.print(f"[bold]iGPT total length: {len(refiner_file_str) + len(role)}[/bold]")
-                    role = "You are a expert at coding large projects who can comprehend lots of detail."
-                    conversation.append({'role': 'system', 'content': role})
-                    conversation.append({'role': 'user', 'content': refiner_file_str})
-
-                    for idx_try in range(3):
-                        file_response = igpt_client.generate(conversation=conversation, correlationId=str(agent.id))
-                        if "Token has expired" in file_response:
-                            igpt_client = iGPT(key=IGPT_KEY, secret=IGPT_SECRET)
-                            file_response = igpt_client.generate(conversation=conversation, correlationId=str(agent.id))
-                        if 'usage' in file_response:
-                            console.print(f"[bold green]Refiner File Output Tokens[/bold green]")
-                            console.print(f"[bold green]Input Tokens {file_response['usage']['promptTokens']}[/bold green]")
-                            console.print(f"[bold green]Output Tokens {file_response['usage']['completionTokens']}[/bold green]")
-                        else:
-                            console.print(f"[bold red]Error querying refinement model {file_response}[/bold red]")
-                            continue
-                        if 'currentResponse' in file_response:
-                            file_output = file_response['currentResponse']
-                            break
-                    if file_output is None:
-                        file_output = "come again?"
-
-                    file_response = igpt_client.generate(conversation=conversation, correlationId=str(agent.id))
-                    if 'usage' in file_response:
-                        console.print(f"[bold green]Refiner output[/bold green]")
-                        console.print(f"[bold green]Input Tokens {file_response['usage']['promptTokens']}[/bold green]")
-                        console.print(f"[bold green]Output Tokens {file_response['usage']['completionTokens']}[/bold green]")
-                    try:
-                        file_output = file_response['currentResponse']
-                    except TypeError as e:
-                        console.print(f"[bold red]Error querying file contents {file_response}[/bold red]")
-                        file_output = "come again?"
-
-                    if f'<file name="{name}">' not in file_output:
-                        file_output = f'\n\n<file name="{name}">\n{file_output}\n</file>\n\n'
-                    else:
-                        file_output = f'\n\n{file_output}\n\n'
-
-                    files[name] = file_output
-
-            walk_folder("", folder_structure, files)
-            for filename, content in files.items():
-                refined_output += content
-
-
-    elif 'gpt' in agent.model.refiner_model:
-        raise ValueError(f"Unsupported refiner model: {agent.model.refiner_model}")
-
+    console.print(f"\n[bold]Generating File Structure[/bold]")
+    console.print(f"[bold green]Refined output, prompt length "
+                  f"{len(refiner_prefix) + len(refiner_str)}[/bold green]")
+    with span("folder_structure"):
+        refiner_response = await query_model(agent.model.refiner_model, refiner_str,
+                                             agent.model.refine_max_tokens, console,
+                                             role="You are a master software architect.",
+                                             correlation_id=str(agent.id), max_tries=3, phase="refiner",
+                                             prefix=refiner_prefix)
+        print_usage(refiner_response, "Refiner File Structure Tokens", console)
+        refined_output = refiner_response.text
+
+        # response text
+        response_pnl = Panel(refined_output,
+                             title=f"[bold magenta]Refiner Output[/bold magenta]",
+                             title_align="",
+                             border_style="magenta",
+                             subtitle="Refined Folder Structure")
+        console.print(response_pnl)
 
-    else:
-        raise ValueError(f"Unsupported refiner model: {agent.model.refiner_model}")
+        refined_output = await continue_model(
+            agent.model.refiner_model, refiner_str, refiner_response, agent.model.refine_max_tokens, console,
+            agent.model.max_continuation_tokens, agent.model.continuation_tail, max_continuations=3,
+            on_truncated=lambda text, idx_cont: commit_artifacts(agent, text, console, complete_only=True),
+            title="Continued Refiner Output", role="You are a master software architect.",
+            correlation_id=str(agent.id), max_tries=3, phase="refiner", prefix=refiner_prefix)
+    await commit_artifacts(agent, refined_output, console)
 
+    # Extract the folder structure and files
+    folder_structure = None
+    parsed = parse_output(refined_output)
+    if parsed.folder_structure is not None:
+        folder_structure = json.loads(parsed.folder_structure.text)
+
+        # generate the files concurrently, sequential generation (concurrency 1)
+        # also shows each file the ones generated before it
+        files = {}
+        semaphore = asyncio.Semaphore(max(agent.model.refine_concurrency, 1))
+        async def generate_file(name):
+            async with semaphore:
+                existing_files = files if agent.model.refine_concurrency <= 1 else {}
+                files[name] = await refine_file(agent, name, subtask_str,
+                                                refined_output, existing_files,
+                                                refined_output, console=console)
+                return files[name]
+
+        # the first file writes the shared prompt prefix to the provider cache,
+        # the rest read it
+        names = list_files(folder_structure)
+        file_outputs = []
+        if len(names) > 0:
+            file_outputs.append(await generate_file(names[0]))
+        pending = [asyncio.create_task(generate_file(name)) for name in names[1:]]
+        try:
+            file_outputs += await asyncio.gather(*pending)
+        finally:
+            # a file that fails stops the others, none of them may commit
+            # artifacts once the run has moved on
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        for content in file_outputs:
+            refined_output += content
 
     response_pnl = Panel(refined_output,
                          title="[bold orange]Refined Result[/bold orange]",
@@ -770,101 +912,30 @@ def refine_output(agent: AgentConfig, idx_ref: int, era_output: str, console: Co
 # ----------------------------------------------------------------------------
 
 
-def run_subtask_agent(agent: AgentConfig, subtask_query: str, console: Console):
+@traced("subagent")
+async def run_subtask_agent(agent: AgentConfig, subtask_query: str, console: Console):
 
-    if "claude" in agent.model.subagent_model:
-        while True:
-            try:
-                subtask_messages = [{"role": "user", "content": [{"type": "text", "text": subtask_query}]}]
-                subagent_response = anthropic_client.messages.create(
-                    model=agent.model.subagent_model,
-                    max_tokens=agent.model.sub_max_tokens,
-                    messages=subtask_messages
-                )
-                console.print(f"[bold green]Subagent output prompt length {len(subtask_query)}[/bold green]")
-                console.print(f"[bold green]Input Tokens {subagent_response.usage.input_tokens}[/bold green]")
-                console.print(f"[bold green]Output Tokens {subagent_response.usage.output_tokens}[/bold green]")
-                idx_cont = 0
-                subtask_result = subagent_response.content[idx_cont].text
-
-                while subagent_response.usage.output_tokens > (agent.model.sub_max_tokens * 0.99):
-                    response_pnl = Panel(subtask_result,
-                                         title="[bold orange]Incremental SubAgent Result[/bold orange]",
-                                         border_style="red",
-                                         subtitle="[bold orange]Incremental SubAgent Result[/bold orange]")
-                    console.print(response_pnl)
-
-                    subagent_continue_prompt = f"\n\n*** PROMPT ***\n\n"
-                    subagent_continue_prompt += f"\n\n*** Continuing from the Previous Response and fulfilling the Original Query, please continue the response ***\n\n"
-                    subagent_continue_prompt += f"\n\n** Previous Response **\n\n{subtask_result}"
-                    subagent_continue_prompt += f"\n\n** Original Query **\n\n{subtask_query}"
-                    subtask_messages = [{"role": "user", "content": [{"type": "text", "text": subagent_continue_prompt}]}]
-                    console.print("[bold red]Warning truncated output, will try and continue ...[/bold red]")
-                    subprompt_pnl = Panel(subagent_continue_prompt,
-                                          title="[bold orange]Incremental SubAgent Prompt[/bold orange]",
-                                          border_style="red",
-                                          subtitle="[bold orange]Incremental SubAgent Prompt[/bold orange]")
-                    console.print(subprompt_pnl)
-                    subagent_response = anthropic_client.messages.create(
-                        model=agent.model.subagent_model,
-                        max_tokens=agent.model.sub_max_tokens,
-                        messages=subtask_messages
-                    )
-                    console.print(f"[bold green]Subagent output prompt length {len(subagent_continue_prompt)}[/bold green]")
-                    console.print(f"[bold green]Input Tokens {subagent_response.usage.input_tokens}[/bold green]")
-                    console.print(f"[bold green]Output Tokens {subagent_response.usage.output_tokens}[/bold green]")
-                    console.print(f"[bold green]Contents Length {len(subagent_response.content)}[/bold green]")
-                    subtask_result += subagent_response.content[idx_cont].text
-                break
-            except RateLimitError as e:
-                console.print(f"\n[bold red]Hit Rate Limit Error, will retry in 60s[/bold red]")
-                time.sleep(60)
-
-
-    elif 'gemini' in agent.model.subagent_model:
-        # TODO: need to check this query and output tokens etc for google model
-        model = genai.GenerativeModel(agent.model.subagent_model)
-        subtask_prompt = f"**prompt:**\n\n{subtask_query}\n\n"
-        subagent_response = model.generate_content("".join(subtask_prompt), safety_settings=ggl_safety_settings)
-        try:
-            subtask_result = subagent_response.text
-        except ValueError:
-            # If the response doesn't contain text, check if the prompt was blocked.
-            console.print(f"\n[bold red]Value Error During response.text[/bold red]")
-            console.print(f"\n[bold red]Prompt Feedback : {subagent_response.prompt_feedback}[/bold red]")
-            console.print(f"\n[bold red]Finish Reason : {subagent_response.candidates[0].finish_reason}[/bold red]")
-            console.print(f"\n[bold red]Safety Ratings : {subagent_response.candidates[0].safety_ratings}[/bold red]")
-            subtask_result = "come again?"
-
-
-    elif 'igpt' in agent.model.subagent_model:
-        global igpt_client
-        conversation = []
-        subtask_prompt = f"**prompt:**\n\n{subtask_query}\n\n"
-        role = "You are coding expert sub-agent who knowns about semiconductor physical design tasks."
-        console.print(f"\n[bold]iGPT content length: {len(subtask_prompt)}[/bold]")
-        console.print(f"\n[bold]iGPT total length: {len(subtask_prompt) + len(role)}[/bold]")
-        conversation.append({'role': 'system', 'content': role})
-        conversation.append({'role': 'user', 'content': subtask_prompt})
-        subagent_response = igpt_client.generate(conversation=conversation, correlationId=str(agent.id))
-
-        if "Token has expired" in subagent_response:
-            igpt_client = iGPT(key=IGPT_KEY, secret=IGPT_SECRET)
-            subagent_response = igpt_client.generate(conversation=conversation, correlationId=str(agent.id))
- 
-        if 'usage' in subagent_response:
-            console.print(f"[bold green]Orchestrator output[/bold green]")
-            console.print(f"[bold green]Input Tokens {subagent_response['usage']['promptTokens']}[/bold green]")
-            console.print(f"[bold green]Output Tokens {subagent_response['usage']['completionTokens']}[/bold green]")
-        try:
-            subtask_result = subagent_response['currentResponse']
-        except TypeError as e:
-            console.print(f"[bold red]Error querying subagent model {subagent_response}[/bold red]")
-            subtask_result = "come again?"
+    subtask_prompt = f"**prompt:**\n\n{subtask_query}\n\n"
+    subagent_response = await query_model(agent.model.subagent_model, subtask_prompt,
+                                          agent.model.sub_max_tokens, console,
+                                          role="You are coding expert sub-agent who knowns about semiconductor physical design tasks.",
+                                          correlation_id=str(agent.id), phase="subagent")
+    console.print(f"[bold green]Subagent output prompt length {len(subtask_query)}[/bold green]")
+    print_usage(subagent_response, "Subagent output", console)
 
+    async def show_partial(text, idx_cont):
+        response_pnl = Panel(text,
+                             title="[bold orange]Incremental SubAgent Result[/bold orange]",
+                             border_style="red",
+                             subtitle="[bold orange]Incremental SubAgent Result[/bold orange]")
+        console.print(response_pnl)
 
-    else:
-        raise ValueError(f"Unsupported subagent model: {agent.model.subagent_model}")
+    subtask_result = await continue_model(
+        agent.model.subagent_model, subtask_prompt, subagent_response, agent.model.sub_max_tokens, console,
+        agent.model.max_continuation_tokens, agent.model.continuation_tail, on_truncated=show_partial,
+        title="Continued subagent output",
+        role="You are coding expert sub-agent who knowns about semiconductor physical design tasks.",
+        correlation_id=str(agent.id), phase="subagent")
 
     response_pnl = Panel(subtask_result,
                          title="[bold orange]SubAgent Result[/bold orange]",
@@ -880,107 +951,372 @@ def run_subtask_agent(agent: AgentConfig, subtask_query: str, console: Console):
 # --------------------------------------------------------------------------------
 
 
-def generate_subtask_prompt(agent: AgentConfig, orch_response: str,
-                            search_query: str, era_output: str,
-                            idx_ref: int, idx_task: int, 
-                            console: Console):
+@traced("subtask_prompt")
+async def generate_subtask_prompt(agent: AgentConfig, orch_response: str,
+                                  search_query: str, era_output: str,
+                                  idx_ref: int, idx_task: int,
+                                  console: Console, dependencies: dict[str, str] = None):
+    '''
+    dependencies are the results a planned subtask depends on by id, they
+    take the place of the previous task results
+    '''
 
     # create a subtask query
     system_message = ""
-    subtask_query = ""
     if idx_ref != 0:
         system_message = "\n** Baseline Result **\n"
         system_message += f"{era_output}\n\n"
-    if idx_task != 0:
-        res = [f"**Task Result {idx}**\n{result}"
-               for idx, result in enumerate(agent.subtask_results[idx_ref])]
+    if dependencies is not None:
+        if len(dependencies) > 0:
+            system_message += "\n** Results Of The Tasks This Task Depends On **\n"
+            system_message += "\n".join(f"**Task {name} Results**\n{result}" for name, result in dependencies.items())
+    elif idx_task != 0:
+        res = render_results(agent.subtask_results[idx_ref], agent.subtask_digests.get(idx_ref, ""),
+                             agent.model.context_keep, label="Task", compact=agent.model.context_compaction)
         system_message = "\n** Previous Task Results **\n"
         system_message += "\n".join(res)
-    subtask_query += orch_response
-    subtask_query += system_message
+    # (text, priority), trimmed lowest priority first to fit the window
+    sections = [(orch_response, None), (system_message, 3)]
 
     # check if files are included
     if (idx_ref == 0) and (idx_task == 0) and len(agent.files) > 0:
-        subtask_query += "** FILES **\n\n" + "\n".join([f'** File content ({name}) **\n{cont}\n\n' for name, cont in agent.files.items()])
+        sections.append(("** FILES **\n\n" + "\n".join([f'** File content ({name}) **\n{cont}\n\n' for name, cont in agent.files.items()]), 1))
 
     # add in the search query if needed
     search_result = None
     if agent.use_search and search_query is not None:
-        search_result = query_search_provider(query=search_query, provider="tavily", console=console)
-        subtask_query += f"\n** Search Results **\n{search_result}"
+        search_result = await query_search_provider(query=search_query, provider="tavily", console=console)
+        sections.append((f"\n** Search Results **\n{search_result}", 2))
 
-    subtask_query += f"\n\nONLY INCLUDE THE CONCISE AND COMPLETE REPSPONSE TO THE SUBTASK IN THIS STEP!!\n\n"
+    sections.append((f"\n\nONLY INCLUDE THE CONCISE AND COMPLETE REPSPONSE TO THE SUBTASK IN THIS STEP!!\n\n", None))
+    subtask_query = fit_sections(sections, prompt_budget(agent.model.subagent_model,
+                                                         agent.model.sub_max_tokens))
 
     return subtask_query
 
 
+# --------------------------------------------------------------------------------
+# Rolling context, the prompts carry the last context_keep subtask results and
+# a digest of the older ones, updated one result at a time as they age out.
+# Baselines too big for the digest budget are condensed once per era.
+# --------------------------------------------------------------------------------
+
+
+async def summarize_context(agent: AgentConfig, prompt: str, max_tokens: int, console: Console):
+    response = await query_model(agent.model.orchestrator_model, prompt, max_tokens, console,
+                                 role="You are an expert at condensing technical work without losing detail.",
+                                 correlation_id=str(agent.id), max_tries=3, phase="compaction")
+    print_usage(response, "Context digest", console)
+    return None if response.failed else response.text
+
+
+@traced("compaction")
+async def compact_subtask_results(agent: AgentConfig, idx_ref: int, console: Console):
+    results = agent.subtask_results[idx_ref]
+    idx_fold = fold_index(results, agent.model.context_keep)
+    if not agent.model.context_compaction or idx_fold is None:
+        return
+    console.print(f"\n[bold]Folding subtask {idx_fold} result into the context digest[/bold]")
+    agent.subtask_digests[idx_ref] = await update_digest(
+        agent.objective, agent.subtask_digests.get(idx_ref, ""), results[idx_fold],
+        f"Subtask {idx_fold}", agent.model.context_digest_tokens,
+        lambda prompt, max_tokens: summarize_context(agent, prompt, max_tokens, console))
+
+
+@traced("compaction")
+async def compact_baseline(agent: AgentConfig, idx_ref: int, era_output: str, console: Console):
+    if not agent.model.context_compaction or not needs_digest(era_output, agent.model.context_digest_tokens):
+        return
+    console.print(f"\n[bold]Condensing the baseline of refine iteration {idx_ref + 1}[/bold]")
+    agent.era_digests[idx_ref] = await update_digest(
+        agent.objective, "", era_output, "Baseline", agent.model.context_digest_tokens,
+        lambda prompt, max_tokens: summarize_context(agent, prompt, max_tokens, console))
+
+
 # --------------------------------------------------------------------------------
 # Run the orchestrator to complete the objective
+# run_orchestrator_loop_async is for callers that already have an event loop
+# (the server runs one task per agent), run_orchestrator_loop is the blocking
+# entry point for scripts and tests
 # --------------------------------------------------------------------------------
 
 
-def run_orchestrator_loop(agent: AgentConfig, console: Console=Console(record=True)):
-    console.print("\n[bold]Starting orchestrator loop[/bold]")
-    console.print(f"[green]Strategy : {agent.model.strategy}[/green]")
-    console.print(f"[green]Orchestrator : {agent.model.orchestrator_model}[/green]")
-    console.print(f"[green]Subagent : {agent.model.subagent_model}[/green]")
-    console.print(f"[green]Refiner : {agent.model.refiner_model}[/green]")
+def reset_run_state(agent: AgentConfig):
+    agent.subtask_queries = {}
+    agent.subtask_results = {}
+    agent.subtask_digests = {}
+    agent.subtask_plans = {}
+    agent.era_results = []
+    agent.era_digests = {}
+    agent.tokens_used = 0
 
-    # refresh the bear token
-    global igpt_client
-    igpt_client = iGPT(IGPT_KEY, IGPT_SECRET)
 
-    era_output = None
+async def run_orchestrator_loop_async(agent: AgentConfig, console: Console,
+                                      events: RunEvents = None, checkpoint=None, tracer: Tracer = None):
+    '''
+    checkpoint is a CheckpointStore (see checkpoints.py), every subtask and
+    era is saved to it as it finishes. An agent whose run_state is running
+    picks up after its last saved step, any other starts from scratch.
+    tracer collects the spans of the run (see tracing.py), it is saved to
+    its path however the run ends.
+    '''
+    if events is not None:
+        run_events.set(events)
+    tracer = tracer if tracer is not None else Tracer()
+    run_tracer.set(tracer)
+    try:
+        with span("run", agent=str(agent.id), strategy=agent.model.strategy):
+            return await orchestrate(agent, console, checkpoint)
+    finally:
+        tracer.save()
+        drop_store(agent.id)
+
+
+async def run_planned_era(agent: AgentConfig, idx_ref: int, era_output: str, console: Console,
+                          save_checkpoint, fan_out: bool = False):
+    '''
+    Planning mode of an era, the plan is saved with the run so a resumed era
+    runs the rest of the same plan. fan_out drops the dependencies so every
+    subtask is ready at once. Returns the planner reply.
+    '''
+    if idx_ref in agent.subtask_plans:
+        plan_response = ""
+        tasks = [PlannedTask(**task) for task in agent.subtask_plans[idx_ref]]
+    else:
+        agent.include_files = idx_ref == 0
+        plan_response, tasks = await query_planner(agent, idx_ref, era_output, console=console)
+        agent.include_files = False
+        if len(tasks) == 0:
+            return plan_response
+        if fan_out:
+            for task in tasks:
+                task.depends_on = []
+        agent.subtask_plans[idx_ref] = [task.model_dump() for task in tasks]
+        await save_checkpoint("plan", idx_ref)
+    console.print(f"\n[bold]Running {len(tasks)} planned subtasks, {plan_depth(tasks)} deep, "
+                  f"{agent.model.subtask_concurrency} at a time[/bold]")
+    emit("plan", era=idx_ref, tasks=[task.model_dump(include={"id", "depends_on"}) for task in tasks])
+
+    queries = {}
+    async def run_task(idx_task: int, task: PlannedTask, dependencies: dict[str, str]):
+        with span("task", era=idx_ref, task=idx_task, id=task.id):
+            console.print(f"\n[bold]Running planned SubTask {task.id}: Refine Iteration {idx_ref + 1} "
+                          f"Task {idx_task + 1}[/bold]")
+            queries[idx_task] = await generate_subtask_prompt(agent, task.prompt, task.search_query,
+                                                              era_output, idx_ref, idx_task,
+                                                              console=console, dependencies=dependencies)
+            return await run_subtask_agent(agent, queries[idx_task], console=console)
+
+    async def on_result(idx_task: int, task: PlannedTask, result: str):
+        agent.subtask_queries[idx_ref].append(queries.pop(idx_task))
+        agent.subtask_results[idx_ref].append(result)
+        await compact_subtask_results(agent, idx_ref, console=console)
+        await save_checkpoint("subtask", idx_ref, idx_task)
+
+    await run_plan(tasks, run_task, on_result, concurrency=agent.model.subtask_concurrency,
+                   done=agent.subtask_results[idx_ref])
+    return plan_response
+
+
+async def run_serial_era(agent: AgentConfig, idx_ref: int, era_output: str, console: Console,
+                         save_checkpoint):
+    '''
+    One subtask at a time, the orchestrator picks each one after seeing the
+    results so far. Returns the last orchestrator reply.
+    '''
     orch_response = None
-    for idx_ref in range(agent.model.refine_iter):
-        console.print(f"\n[bold]Refinment Iteration {idx_ref + 1}[/bold]")
-        agent.subtask_queries[idx_ref] = []
-        agent.subtask_results[idx_ref] = []
-
-        for idx_task in range(agent.model.task_iter):
+    for idx_task in range(len(agent.subtask_results[idx_ref]), agent.model.task_iter):
 
+        with span("task", era=idx_ref, task=idx_task):
             console.print(f"\n[bold]Running Orchestrator for SubTask Prompt: Refine Iteration {idx_ref + 1} Task Iteration {idx_task + 1}[/bold]")
             if (idx_ref == 0) and (idx_task == 0):
                 agent.include_files = True
                 (
                     orch_response,
                     search_query
-                ) = query_orchestrator(agent, idx_ref, era_output, console=console)
+                ) = await query_orchestrator(agent, idx_ref, era_output, console=console)
                 agent.include_files = False
             else:
                 (
                     orch_response,
                     search_query
-                ) = query_orchestrator(agent, idx_ref, era_output, console=console)
+                ) = await query_orchestrator(agent, idx_ref, era_output, console=console)
 
             if "Objective Complete:" in orch_response:
                 break
 
-            subtask_query = generate_subtask_prompt(agent, orch_response,
-                                                    search_query, era_output,
-                                                    idx_ref, idx_task, console=console)
-            subtask_result = run_subtask_agent(agent, subtask_query, console=console)
+            subtask_query = await generate_subtask_prompt(agent, orch_response,
+                                                          search_query, era_output,
+                                                          idx_ref, idx_task, console=console)
+            subtask_result = await run_subtask_agent(agent, subtask_query, console=console)
 
             agent.subtask_queries[idx_ref].append(subtask_query)
             agent.subtask_results[idx_ref].append(subtask_result)
+            await compact_subtask_results(agent, idx_ref, console=console)
+            await save_checkpoint("subtask", idx_ref, len(agent.subtask_results[idx_ref]) - 1)
+    return orch_response
+
+
+# --------------------------------------------------------------------------------
+# Orchestration strategies, registered under the names ModelConfig.strategy
+# takes (see strategies.py). Every engine runs refine iterations of subtasks
+# followed by a refine, they differ in how many iterations they run, how the
+# subtasks of an iteration are scheduled and when they stop.
+# --------------------------------------------------------------------------------
 
+
+@register_strategy
+class IterativeRefinement(Strategy):
+    '''
+    refine_iter iterations of task_iter subtasks, each iteration refined into
+    the baseline of the next. The subtasks run one at a time, or as a planned
+    graph with task_planning.
+    '''
+
+    name = "IterativeRefinement"
+
+    async def run(self, agent: AgentConfig, console: Console, save_checkpoint):
+        iterations = self.refine_iterations(agent)
+        # completed eras and subtasks of an interrupted run are not run again
+        start_ref = min(len(agent.era_results), iterations)
+        era_output = agent.era_results[-1] if len(agent.era_results) > 0 else None
+        orch_response = None
+        idx_ref = start_ref
+        for idx_ref in range(start_ref, iterations):
+            with span("era", era=idx_ref):
+                console.print(f"\n[bold]Refinment Iteration {idx_ref + 1}[/bold]")
+                agent.subtask_queries.setdefault(idx_ref, [])
+                agent.subtask_results.setdefault(idx_ref, [])
+
+                if self.plans(agent):
+                    orch_response = await run_planned_era(agent, idx_ref, era_output, console, save_checkpoint,
+                                                          fan_out=self.fan_out)
+                else:
+                    orch_response = await run_serial_era(agent, idx_ref, era_output, console, save_checkpoint)
+
+                if orch_response is not None and "Objective Complete:" in orch_response:
+                    break
+
+                # summarize the results for this era
+                era_output = await refine_output(agent, idx_ref, era_output, console=console)
+                agent.era_results.append(era_output)
+                if idx_ref + 1 < iterations:
+                    await compact_baseline(agent, idx_ref, era_output, console=console)
+                await save_checkpoint("era", idx_ref)
+                if self.done(agent):
+                    break
+
+        # Call the refiner
         if orch_response is not None and "Objective Complete:" in orch_response:
-            break
+            return await refine_output(agent, idx_ref, era_output, console=console)
+        return era_output
 
-        # summarize the results for this era
-        era_output = refine_output(agent, idx_ref, era_output, console=console)
-        agent.era_results.append(era_output)
 
-    # Call the refiner
-    if orch_response is not None and "Objective Complete:" in orch_response:
-        final_output = refine_output(agent, idx_ref, era_output, console=console)
-    else:
-        final_output = era_output
+@register_strategy
+class FixedPointIteration(IterativeRefinement):
+    '''
+    Iterative refinement that stops once a refine iteration no longer
+    changes the output, convergence_threshold is the similarity of two
+    consecutive refined outputs that counts as converged. refine_iter caps
+    the iterations.
+    '''
+
+    name = "FixedPointIteration"
+
+    def done(self, agent: AgentConfig):
+        if len(agent.era_results) < 2:
+            return False
+        score = similarity(agent.era_results[-2], agent.era_results[-1])
+        emit("convergence", era=len(agent.era_results) - 1, similarity=round(score, 4))
+        annotate(similarity=round(score, 4))
+        return score >= agent.model.convergence_threshold
+
+
+@register_strategy
+class PlanThenExecute(IterativeRefinement):
+    '''
+    A single pass, one plan of up to task_iter subtasks run as a dependency
+    graph, subtask_concurrency at a time, then one refine
+    '''
+
+    name = "PlanThenExecute"
+    iterations = 1
+    planning = True
+
+
+@register_strategy
+class MapReduce(IterativeRefinement):
+    '''
+    A single pass, the plan's subtasks all run at once regardless of
+    dependencies (map), subtask_concurrency at a time, and the refiner
+    merges their results (reduce). The lowest latency, the subtasks don't
+    see each other's results.
+    '''
+
+    name = "MapReduce"
+    iterations = 1
+    planning = True
+    fan_out = True
+
+
+async def orchestrate(agent: AgentConfig, console: Console, checkpoint=None):
+    strategy = get_strategy(agent.model.strategy)
+    console.print("\n[bold]Starting orchestrator loop[/bold]")
+    console.print(f"[green]Strategy : {strategy.name}[/green]")
+    console.print(f"[green]Orchestrator : {agent.model.orchestrator_model}[/green]")
+    console.print(f"[green]Subagent : {agent.model.subagent_model}[/green]")
+    console.print(f"[green]Refiner : {agent.model.refiner_model}[/green]")
+
+    fresh = agent.run_state != "running"
+    if fresh:
+        reset_run_state(agent)
+    elif checkpoint is not None:
+        await checkpoint.load(agent)
+    agent.run_state = "running"
+    budget = TokenBudget(agent.token_budget, agent.tokens_used)
+    run_budget.set(budget)
+
+    async def save_checkpoint(step: str, *args):
+        if checkpoint is not None:
+            agent.tokens_used = budget.used
+            await getattr(checkpoint, step)(agent, *args, console=console)
+
+    start_ref = min(len(agent.era_results), strategy.refine_iterations(agent))
+    if start_ref > 0 or len(agent.subtask_results.get(start_ref, [])) > 0:
+        console.print(f"[bold green]Resuming at refine iteration {start_ref + 1} task "
+                      f"{len(agent.subtask_results.get(start_ref, [])) + 1}, "
+                      f"{agent.tokens_used} tokens already used[/bold green]")
+    await save_checkpoint("start", fresh)
+
+    try:
+        final_output = await strategy.run(agent, console, save_checkpoint)
+    except BudgetExceededError as e:
+        # stop on the budget, the output is whatever has been refined so far
+        console.print(f"\n[bold red]{e}, finishing with the results so far[/bold red]")
+        final_output = agent.era_results[-1] if len(agent.era_results) > 0 else None
+        if final_output is None:
+            final_output = "\n\n".join(r for results in agent.subtask_results.values() for r in results)
+    finally:
+        agent.tokens_used = budget.used
+    emit("usage", **budget.summary())
+    console.print(f"[bold green]Run tokens {budget.summary()}[/bold green]")
 
     # Process the final output
-    zip_bytes = extract_output(final_output, agent=agent, console=console)
+    # writing the files and the zip blocks, the other runs of the worker go on
+    zip_path = await asyncio.to_thread(extract_output, final_output, agent=agent, console=console)
+    agent.run_state = "complete"
+    await save_checkpoint("complete")
+
+    return zip_path
 
-    return zip_bytes
+
+def run_orchestrator_loop(agent: AgentConfig, console: Console=Console(record=True)):
+    async def run_and_close():
+        try:
+            return await run_orchestrator_loop_async(agent, console)
+        finally:
+            await providers.aclose()
+    return asyncio.run(run_and_close())
 
 
 # --------------------------------------------------------------------------------
@@ -988,16 +1324,16 @@ def run_orchestrator_loop(agent: AgentConfig, console: Console=Console(record=Tr
 # --------------------------------------------------------------------------------
 
 
-def extract_output(refined_output: str, agent: AgentConfig, console: Console, idx_cont: int = None):
+@traced("extract")
+def extract_output(refined_output: str, agent: AgentConfig, console: Console):
     console.print("\n[bold]Extracting the final output[/bold]")
+    parsed = parse_output(refined_output)
 
     # extract the project name
-    if '<project_name>' in refined_output:
-        project_name = f'{refined_output.split("<project_name>")[1].split("</project_name>")[0]}_{agent.id}'
+    if parsed.project_name is not None:
+        project_name = f'{parsed.project_name.text}_{agent.id}'
     else:
         project_name = f"{agent.name}_{agent.id}"
-    if idx_cont is not None:
-        project_name = f"{project_name}_{idx_cont}"
 
     # print project name
     console.print(f"[green]Project Name : {project_name}[/green]")
@@ -1017,44 +1353,77 @@ def extract_output(refined_output: str, agent: AgentConfig, console: Console, id
     console.print(f"[green]Done :)[/green]")
     console.print(f"[green]Done :)[/green]")
 
-    # extract the folder structure
+    # extract the folder structure, files the refiner already committed to
+    # the run's store are not written again
+    store = artifact_store(agent.id)
     folder_structure = None
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
-
-        if "<folder_structure>" not in refined_output:
-            console.print(f"[red]Folder Structure Not Found In Output[/red]")
-        else:
-            folder_structure = json.loads(refined_output.split("<folder_structure>")[1].split("</folder_structure>")[0])
-
-            # extract the files
-            files = {}
-            def walk_folder(name, entry, files):
-                if isinstance(entry, dict):
-                    for key, value in entry.items():
-                        walk_folder(f"{name}/{key}", value, files)
-                else:
-                    if f'<file name="{name}">' not in refined_output:
-                        console.print(f"\n[bold red]Missing file contents for {name}[/bold red]")
-                        return None
-                    file_contents = refined_output.split( f'<file name="{name}">' )[1].split("</file>")[0]
-                    files[name] = file_contents
-
-            walk_folder("", folder_structure, files)
-
-            for file_name, data in files.items():
-                zip_file.writestr(file_name[1:], data)
-            
-        zip_file.writestr("folder_structure.json", json.dumps(folder_structure, indent=4))
-        zip_file.writestr("final_output.txt", refined_output)
-        zip_file.writestr("exec_log.html", console.export_html())
-
-    with open(f'./output/{project_name}.zip', 'wb') as f:
-        f.write(zip_buffer.getvalue())
-    with open(f'./output/{agent.id}_final.zip', 'wb') as f:
-        f.write(zip_buffer.getvalue())
-
-    return zip_buffer.getvalue()
+    names = []
+    if parsed.folder_structure is None:
+        console.print(f"[red]Folder Structure Not Found In Output[/red]")
+    else:
+        folder_structure = json.loads(parsed.folder_structure.text)
+
+        for name in list_files(folder_structure):
+            tag = parsed.file(name)
+            if tag is None:
+                console.print(f"\n[bold red]Missing file contents for {name}[/bold red]")
+                continue
+            with tag.content() as content:
+                store.put(name[1:], content)
+            names.append(name[1:])
+
+    # the archive is streamed from the store straight to disk
+    zip_path = store.write_zip(f"{OUTPUT_DIR}/{project_name}.zip", names, extras={
+        "folder_structure.json": json.dumps(folder_structure, indent=4),
+        "final_output.txt": parsed.buffer,
+        "exec_log.html": console.export_html(),
+        "trace.json": run_tracer.get().dumps() if run_tracer.get() is not None else "{}",
+    })
+    link_alias(zip_path, f"{OUTPUT_DIR}/{agent.id}_final.zip")
+    store.discard()
+
+    return zip_path
+
+
+async def commit_artifacts(agent: AgentConfig, text: str, console: Console, complete_only: bool = False):
+    '''
+    Commit the files and folder structure in text to the run's artifact store
+    as soon as the refiner produces them. complete_only skips the tag a
+    truncated reply ends in, its continuation commits it. The commits fsync,
+    they run on a thread so the other runs of the worker don't wait on them.
+    '''
+    committed = await asyncio.to_thread(write_artifacts, agent.id, text, complete_only)
+    for name, size in committed:
+        console.print(f"[green]Committed {name} ({size} bytes)[/green]")
+
+
+def write_artifacts(run_id: str, text: str, complete_only: bool = False):
+    store = artifact_store(run_id)
+    parsed = parse_output(text)
+    tags = [(name.lstrip("/"), tag) for name, tag in parsed.files.items()]
+    if parsed.folder_structure is not None:
+        tags.append(("folder_structure.json", parsed.folder_structure))
+    committed = []
+    for name, tag in tags:
+        if complete_only and not tag.complete:
+            continue
+        with tag.content() as content:
+            if store.put(name, content) is not None:
+                committed.append((name, len(tag)))
+    return committed
+
+
+def link_alias(path: str, alias: str):
+    '''
+    Point alias at the file at path, a hard link where the file system
+    supports them and a copy where it doesn't
+    '''
+    alias_tmp = f"{alias}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        os.link(path, alias_tmp)
+    except OSError:
+        shutil.copyfile(path, alias_tmp)
+    os.replace(alias_tmp, alias)
 
 
 # --------------------------------------------------------------------------------
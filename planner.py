@@ -0,0 +1,156 @@
+# --------------------------------------------------------------------------------
+# File : planner.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Dependency graph of the subtasks of a refine iteration.
+# Purp : The loop asked the orchestrator for one subtask at a time, so an era
+#        cost task_iter serial orchestrator and subagent round trips even when
+#        most subtasks don't depend on each other. In planning mode the
+#        orchestrator returns every subtask with its dependencies at once, and
+#        each subtask runs as soon as the ones it depends on are done. An era
+#        then takes about the depth of the graph in round trips.
+# --------------------------------------------------------------------------------
+
+import re
+import json
+import asyncio
+
+from pydantic import BaseModel
+
+
+plan_prompt = '''
+Break the remaining work on the Objective into at most {max_tasks} subtasks for subagents.
+Subtasks that don't need each other's results run at the same time, so only list a dependency
+when a subtask really needs the result of another one. Each subtask prompt must be clear,
+encouraging and comprehensive, and complete on its own apart from the results of its dependencies.
+ALWAYS CHECK CODE FOR ERRORS AND USE THE BEST PRACTICES FOR CODING TASKS.
+Reply with a JSON list wrapped in <plan> tags, one object per subtask, like this:
+<plan>[{{"id": "backend", "prompt": "<prompt for the subagent>", "depends_on": []}},
+{{"id": "tests", "prompt": "<prompt for the subagent>", "depends_on": ["backend"]}}]</plan>
+'''
+
+plan_search_prompt = '''
+Give a subtask a "search_query" key when an online search would yield important information for it.
+The question should be specific and targeted to elicit the most relevant and helpful resources.
+'''
+
+PLAN_TAG = re.compile(r'<plan\s*>(.*?)</plan\s*>', re.DOTALL)
+
+
+class PlanError(ValueError):
+    pass
+
+
+class PlannedTask(BaseModel):
+    id: str
+    prompt: str
+    depends_on: list[str] = []
+    search_query: str | None = None
+
+
+def parse_plan(text: str, max_tasks: int):
+    '''
+    The subtasks of the plan in text, in an order where every subtask comes
+    after its dependencies. Unknown and duplicate ids are dropped, a
+    dependency cycle is broken at the subtask listed first.
+    '''
+    match = PLAN_TAG.search(text)
+    body = match.group(1) if match else text[text.find("["):text.rfind("]") + 1]
+    try:
+        entries = json.loads(body)
+    except ValueError as e:
+        raise PlanError(f"The plan is not valid JSON: {e}")
+    if not isinstance(entries, list):
+        raise PlanError("The plan is not a list of subtasks")
+
+    tasks = {}
+    for idx, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get("prompt"):
+            continue
+        task_id = str(entry.get("id") or f"task_{idx}")
+        depends_on = entry.get("depends_on") or []
+        if not isinstance(depends_on, list):
+            depends_on = [depends_on]
+        if task_id not in tasks:
+            tasks[task_id] = PlannedTask(id=task_id, prompt=str(entry["prompt"]),
+                                         depends_on=[str(dep) for dep in depends_on],
+                                         search_query=entry.get("search_query") or None)
+        if len(tasks) >= max_tasks:
+            break
+    if len(tasks) == 0:
+        raise PlanError("The plan has no subtasks")
+    for task in tasks.values():
+        task.depends_on = [dep for dep in dict.fromkeys(task.depends_on) if dep in tasks and dep != task.id]
+    return order_tasks(list(tasks.values()))
+
+
+def order_tasks(tasks: list[PlannedTask]):
+    '''
+    Stable topological order, ready subtasks are taken in the order planned
+    '''
+    ordered, done = [], set()
+    remaining = list(tasks)
+    while remaining:
+        ready = [task for task in remaining if all(dep in done for dep in task.depends_on)]
+        if len(ready) == 0:
+            # a cycle, the first subtask planned runs without what is still missing
+            ready = [remaining[0]]
+            ready[0].depends_on = [dep for dep in ready[0].depends_on if dep in done]
+        for task in ready:
+            ordered.append(task)
+            done.add(task.id)
+        remaining = [task for task in remaining if task.id not in done]
+    return ordered
+
+
+def plan_depth(tasks: list[PlannedTask]):
+    depth = {}
+    for task in tasks:
+        depth[task.id] = 1 + max([depth[dep] for dep in task.depends_on], default=0)
+    return max(depth.values(), default=0)
+
+
+async def run_plan(tasks: list[PlannedTask], run_task, on_result, concurrency: int = 4,
+                   done: list[str] = ()):
+    '''
+    Run every subtask once its dependencies have finished, at most
+    concurrency at a time. run_task(idx, task, dependencies) returns the
+    result, dependencies maps the id of each dependency to its result.
+    on_result(idx, task, result) is awaited in plan order whatever order the
+    subtasks finish in, so the results merge the same way on every run.
+    done holds the results of the first subtasks of a resumed plan.
+    '''
+    results = list(done)
+    finished = {task.id: asyncio.get_running_loop().create_future() for task in tasks}
+    for task, result in zip(tasks, results):
+        finished[task.id].set_result(result)
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    commit_lock = asyncio.Lock()
+
+    async def commit():
+        async with commit_lock:
+            while len(results) < len(tasks) and finished[tasks[len(results)].id].done():
+                idx = len(results)
+                results.append(finished[tasks[idx].id].result())
+                await on_result(idx, tasks[idx], results[idx])
+
+    async def run_one(idx: int, task: PlannedTask):
+        dependencies = {dep: await finished[dep] for dep in task.depends_on}
+        async with semaphore:
+            result = await run_task(idx, task, dependencies)
+        finished[task.id].set_result(result)
+        await commit()
+
+    pending = [asyncio.create_task(run_one(idx, task))
+               for idx, task in enumerate(tasks) if idx >= len(results)]
+    try:
+        await asyncio.gather(*pending)
+    finally:
+        for future in pending:
+            future.cancel()
+    return results
+
+
+# --------------------------------------------------------------------------------
+# Done :)
+# --------------------------------------------------------------------------------
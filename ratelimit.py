@@ -0,0 +1,226 @@
+# --------------------------------------------------------------------------------
+# File : ratelimit.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Token bucket scheduler for the LLM provider rate limits.
+# Purp : Every run in the process shares one bucket per provider and model so
+#        concurrent agents stay just under the requests/min and tokens/min
+#        quota instead of all hitting a 429, sleeping and stampeding together.
+#        The worker processes of the pool each get an equal share of it.
+# --------------------------------------------------------------------------------
+
+import os
+import time
+import random
+import asyncio
+
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+from metrics import record_wait
+from tracing import span
+
+
+# --------------------------------------------------------------------------------
+# Budgets per provider, requests/min and tokens/min, 0 means unlimited.
+# The provider headers override these once a response has been seen.
+# --------------------------------------------------------------------------------
+
+RATE_LIMITS = {
+    "anthropic": (int(os.environ.get('ANTHROPIC_RPM', 50)), int(os.environ.get('ANTHROPIC_TPM', 40000))),
+    "gemini": (int(os.environ.get('GEMINI_RPM', 60)), int(os.environ.get('GEMINI_TPM', 1000000))),
+    "igpt": (int(os.environ.get('IGPT_RPM', 0)), int(os.environ.get('IGPT_TPM', 0))),
+    "tavily": (int(os.environ.get('TAVILY_RPM', 0)), 0),
+}
+
+BACKOFF_BASE = 2.0
+BACKOFF_CAP = 120.0
+
+
+def estimate_tokens(text: str):
+    return len(text) // 4 + 1
+
+
+def parse_wait(value: str):
+    '''
+    Seconds until a header value, which is either a delay in seconds,
+    an RFC 3339 timestamp (anthropic) or an HTTP date (retry-after)
+    '''
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        reset = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        try:
+            reset = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+    return max(reset.timestamp() - time.time(), 0.0)
+
+
+# --------------------------------------------------------------------------------
+# A bucket refills continuously at limit/60 per second up to limit
+# --------------------------------------------------------------------------------
+
+
+class TokenBucket:
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.level = float(limit)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        if self.limit > 0:
+            self.level = min(self.limit, self.level + (now - self.updated) * self.limit / 60.0)
+        self.updated = now
+
+    def wait_for(self, amount: float):
+        if self.limit <= 0:
+            return 0.0
+        self.refill()
+        # requests larger than the whole bucket go through once it is full
+        amount = min(amount, self.limit)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60.0 / self.limit
+
+    def take(self, amount: float):
+        if self.limit > 0:
+            self.refill()
+            self.level -= amount
+
+    def sync(self, limit: int, remaining: int):
+        if limit is not None and limit > 0:
+            self.limit = limit
+        self.refill()
+        if remaining is not None:
+            self.level = min(self.level, float(remaining))
+
+
+class ProviderLimit:
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.blocked_until = 0.0
+        self.waits = 0
+        self.wait_time = 0.0
+
+
+# --------------------------------------------------------------------------------
+# The scheduler, one per process. Runs are tasks on the same event loop so
+# the buckets are only touched between awaits and need no lock. The provider
+# counts every process against one quota, so with shares processes each one
+# keeps to 1/shares of every limit.
+# --------------------------------------------------------------------------------
+
+
+class RateLimiter:
+
+    def __init__(self, limits: dict = RATE_LIMITS, shares: int = 1):
+        self.defaults = dict(limits)
+        self.limits = {}
+        self.shares = shares
+
+    def share(self, shares: int):
+        '''
+        Keep to 1/shares of every quota, called once in each worker process
+        of a pool of shares workers
+        '''
+        self.shares = max(shares, 1)
+        self.limits = {}
+
+    def part(self, value):
+        return value / self.shares if value is not None else None
+
+    def configure(self, provider: str, model: str = None, rpm: int = 0, tpm: int = 0):
+        if model is None:
+            self.defaults[provider] = (rpm, tpm)
+        else:
+            self.limits[(provider, model)] = ProviderLimit(self.part(rpm), self.part(tpm))
+
+    def get(self, provider: str, model: str):
+        key = (provider, model)
+        if key not in self.limits:
+            rpm, tpm = self.defaults.get(provider, (0, 0))
+            self.limits[key] = ProviderLimit(self.part(rpm), self.part(tpm))
+        return self.limits[key]
+
+    async def acquire(self, provider: str, model: str, tokens: int = 0):
+        limit = self.get(provider, model)
+        while True:
+            wait = max(limit.blocked_until - time.monotonic(),
+                       limit.requests.wait_for(1),
+                       limit.tokens.wait_for(tokens))
+            if wait <= 0:
+                limit.requests.take(1)
+                limit.tokens.take(tokens)
+                return
+            # jitter so the waiting runs don't wake up in lock step
+            wait += random.uniform(0, min(1.0, wait * 0.1))
+            limit.waits += 1
+            limit.wait_time += wait
+            record_wait(wait)
+            with span("rate_limit_wait", provider=provider, model=model, wait=round(wait, 3)):
+                await asyncio.sleep(wait)
+
+    def record(self, provider: str, model: str, estimated: int, actual: int):
+        '''
+        Settle the estimate taken in acquire against the real usage
+        '''
+        self.get(provider, model).tokens.take(actual - estimated)
+
+    def observe(self, provider: str, model: str, headers):
+        '''
+        Sync the buckets with the remaining quota the provider reports
+        '''
+        if headers is None:
+            return
+        limit = self.get(provider, model)
+
+        def header_int(name):
+            value = headers.get(name)
+            return int(value) if value is not None and str(value).isdigit() else None
+
+        prefix = f"{provider}-ratelimit"
+        limit.requests.sync(self.part(header_int(f"{prefix}-requests-limit")),
+                            self.part(header_int(f"{prefix}-requests-remaining")))
+        limit.tokens.sync(self.part(header_int(f"{prefix}-tokens-limit")),
+                          self.part(header_int(f"{prefix}-tokens-remaining")))
+        for kind in ("requests", "tokens"):
+            if header_int(f"{prefix}-{kind}-remaining") == 0:
+                reset = parse_wait(headers.get(f"{prefix}-{kind}-reset"))
+                if reset is not None:
+                    limit.blocked_until = max(limit.blocked_until, time.monotonic() + reset)
+
+    def backoff(self, provider: str, model: str, attempt: int, headers=None):
+        '''
+        Called on a 429, blocks every caller of this provider and model for
+        retry-after if the provider sent it, otherwise jittered exponential
+        backoff. Returns the wait so the caller can log it before sleeping.
+        '''
+        limit = self.get(provider, model)
+        self.observe(provider, model, headers)
+        wait = parse_wait(headers.get("retry-after")) if headers is not None else None
+        if wait is None:
+            wait = min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)
+            wait = random.uniform(wait / 2, wait)
+        else:
+            wait += random.uniform(0, 1.0)
+        limit.blocked_until = max(limit.blocked_until, time.monotonic() + wait)
+        limit.requests.sync(None, 0)
+        return max(limit.blocked_until - time.monotonic(), 0.0)
+
+
+rate_limiter = RateLimiter()
+
+
+# --------------------------------------------------------------------------------
+# Done :)
+# --------------------------------------------------------------------------------
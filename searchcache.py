@@ -0,0 +1,87 @@
+# --------------------------------------------------------------------------------
+# File : searchcache.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : TTL cache with request coalescing for the web search provider.
+# Purp : The orchestrator keeps asking near identical search questions across
+#        task iterations and runs, answer those from memory and let concurrent
+#        identical searches share one request.
+# --------------------------------------------------------------------------------
+
+import os
+import re
+import time
+import asyncio
+
+from collections import OrderedDict
+
+
+SEARCH_CACHE_TTL = float(os.environ.get('SEARCH_CACHE_TTL', 3600))
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 1024))
+
+
+class SearchCache:
+
+    def __init__(self, ttl: float = SEARCH_CACHE_TTL, max_entries: int = SEARCH_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def normalize(query: str):
+        query = re.sub(r"\s+", " ", query).strip().lower()
+        return query.strip(" ?.!'\"")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "coalesced": self.coalesced, "entries": len(self.entries)}
+
+    async def get_or_fetch(self, key: str, fetch, on_lookup=None):
+        '''
+        Value for key from the cache, the request already in flight for it,
+        or a new call to fetch(). The fetch runs as its own task so a waiter
+        that gets cancelled doesn't cancel it for the others. Failures are
+        raised to every waiter and are not cached. on_lookup is called with
+        hit, coalesced or miss before anything is awaited.
+        '''
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            if on_lookup is not None:
+                on_lookup("hit")
+            return entry[1]
+
+        if key in self.inflight:
+            self.coalesced += 1
+            if on_lookup is not None:
+                on_lookup("coalesced")
+        else:
+            self.misses += 1
+            if on_lookup is not None:
+                on_lookup("miss")
+            task = asyncio.ensure_future(fetch())
+            task.add_done_callback(lambda task: self.finish(key, task))
+            self.inflight[key] = task
+        return await asyncio.shield(self.inflight[key])
+
+    def finish(self, key: str, task: asyncio.Future):
+        del self.inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, task.result())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+search_cache = SearchCache()
+
+
+# --------------------------------------------------------------------------------
+# Done :)
+# --------------------------------------------------------------------------------
@@ -8,24 +8,32 @@
 # --------------------------------------------------------------------------------
 
 import os
-import time
+import json
+import asyncio
+from contextlib import aclosing
 from starlette.responses import HTMLResponse
 from starlette.responses import RedirectResponse
-from starlette.responses import StreamingResponse
+from starlette.responses import FileResponse
+from starlette.responses import Response
+from starlette.responses import PlainTextResponse
+from email.utils import parsedate_to_datetime
 
-from fastapi import FastAPI, Request, Form
+from fastapi import FastAPI, Request, Form, HTTPException
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.encoders import jsonable_encoder
 import motor.motor_asyncio
 
-from orchestrator import ModelConfig, AgentConfig, run_orchestrator_loop
+from orchestrator import ModelConfig, AgentConfig
+from orchestrator import OUTPUT_DIR
+from agents import providers
+from events import event_broker
+from workers import worker_pool, QueueFullError
+from artifacts import ArtifactStore
+from checkpoints import results_collection_name
+from metrics import metrics
 from sse_starlette.sse import EventSourceResponse
-from sh import tail
 
-from rich.console import Console
-#from threading import Thread
-import multiprocessing
 from fastapi.middleware.cors import CORSMiddleware
 
 ##############################################################################
@@ -33,6 +41,8 @@ from fastapi.middleware.cors import CORSMiddleware
 ##############################################################################
 
 
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', 256 * 1024))
+
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
@@ -45,6 +55,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def start_workers():
+    event_broker.add_listener(metrics.observe)
+    worker_pool.start()
+
+
+@app.on_event("shutdown")
+async def close_clients():
+    await worker_pool.stop()
+    await providers.aclose()
+    providers.close()
+
+
 ##############################################################################
 # Connect to Mongo DB
 ##############################################################################
@@ -58,6 +81,13 @@ client = motor.motor_asyncio.AsyncIOMotorClient(
             MONGO_CONN, MONGO_PORT, tls=True,
             tlsAllowInvalidCertificates=True)
 mongo_db = client[MONGO_DBNAME]
+mongo_results = mongo_db[results_collection_name(MONGO_DBNAME)]
+
+# the fields the agent pages render, the run history and files stay in Mongo
+VIEW_PROJECTION = {"name": 1, "objective": 1, "run_state": 1, "tokens_used": 1, "token_budget": 1,
+                   "model.task_iter": 1, "model.refine_iter": 1}
+# everything a run needs, the progress log isn't
+RUN_PROJECTION = {"steps": 0}
 
 
 ##############################################################################
@@ -84,7 +114,8 @@ async def save_agent(
     task_iter: int = Form(...),
     refine_iter: int = Form(...),
     objective: str = Form(...),
-    orchestration_strategy: str = Form(...)
+    orchestration_strategy: str = Form(...),
+    token_budget: int = Form(0)
 ):
     print(f"save_agent: {name}")
     model = ModelConfig(orchestrator_model=orchestrator_model,
@@ -93,13 +124,11 @@ async def save_agent(
                         task_iter=task_iter,
                         refine_iter=refine_iter,
                         strategy=orchestration_strategy)
-    agent = AgentConfig(name=name, objective=objective, model=model)
+    agent = AgentConfig(name=name, objective=objective, model=model, token_budget=token_budget)
     agent = jsonable_encoder(agent)
 
     new_agent = await mongo_db[MONGO_DBNAME].insert_one(agent)
-    find_id = {"_id": new_agent.inserted_id}
-    created_agent = await mongo_db[MONGO_DBNAME].find_one(find_id)
-    newurl = app.url_path_for('view_agent', id=created_agent["_id"])
+    newurl = app.url_path_for('view_agent', id=new_agent.inserted_id)
     return RedirectResponse(newurl, status_code=303)
 
 
@@ -111,7 +140,7 @@ async def save_agent(
 @app.get("/view_agent/{id}/", response_class=HTMLResponse)
 async def view_agent(id: str, request: Request):
     print(f"view_agent: {id}")
-    cfg = await mongo_db[MONGO_DBNAME].find_one({"_id": id})
+    cfg = await mongo_db[MONGO_DBNAME].find_one({"_id": id}, VIEW_PROJECTION)
 
     context = {"request": request,
                "agent": cfg,
@@ -120,88 +149,190 @@ async def view_agent(id: str, request: Request):
     return templates.TemplateResponse("view_agent.html", context)
 
 
+@app.get("/agent_results/{id}/")
+async def agent_results(id: str, era: int = None):
+    '''
+    The saved subtask results of a run (task -1 is the era's refined
+    result), served from the (agent_id, era, task) index
+    '''
+    query = {"agent_id": id}
+    if era is not None:
+        query["era"] = era
+    cursor = mongo_results.find(query, {"_id": 0}).sort([("era", 1), ("task", 1)])
+    return await cursor.to_list(length=None)
+
+
 ##############################################################################
-# Logfile streamer, scroll_tick needs to be > 0.1s to avoid overflow/hang
+# Event streamer, viewers of a run subscribe to the broker (or its event file)
+# so there is no subprocess and no blocking read per viewer. The run is
+# cancelled when its last viewer goes away.
 ##############################################################################
 
-SCROLL_TICK = 0.1
-proc_for_loop = {}
-
-async def logfile_reader(request: Request, id: str):
-    logfile = f"logs/run_orch_loop_{id}.log"
-    print(f"logfile_reader: {logfile}")
-    for line in tail("-f", logfile, _iter=True):
-        if await request.is_disconnected():
-            print("client disconnected!!!")
-            global proc_for_loop
-            if id in proc_for_loop:
-                print(f"Terminating process!")
-                proc_for_loop[id].terminate()
-                del proc_for_loop[id]
-                print(f"Done :)")
-            break
-        yield line
-        time.sleep(SCROLL_TICK)
+async def event_reader(id: str):
+    eventfile = f"logs/run_orch_loop_{id}.events"
+    print(f"event_reader: {eventfile}")
+    try:
+        async with aclosing(event_broker.subscribe(id, eventfile)) as events:
+            async for event in events:
+                data = {k: v for k, v in event.items() if k != "event"}
+                yield {"event": event["event"], "data": json.dumps(data)}
+    finally:
+        job = worker_pool.jobs.get(id)
+        if job is not None and job.status in ("queued", "running") and event_broker.viewers(id) == 0:
+            print("last client disconnected!!!")
+            print(f"Cancelling orchestrator run!")
+            worker_pool.cancel(id)
+            print(f"Done :)")
 
 
 @app.get("/stream_loop_logs/{id}/", response_class=EventSourceResponse)
 async def stream_loop_logs(id: str, request: Request):
     print(f"stream_loop_logs: {id}")
-    filepath = f"logs/run_orch_loop_{id}.log"
-    if os.path.exists(filepath):
-        event_generator = logfile_reader(request=request, id=id)
+    filepath = f"logs/run_orch_loop_{id}.events"
+    if event_broker.live(id) or os.path.exists(filepath):
+        event_generator = event_reader(id=id)
         return EventSourceResponse(event_generator)
     print(f"stream_loop_logs: opps file doesn't exist yet {filepath}")
     return ''
 
 
 ##############################################################################
-# Logfile streamer, scroll_tick needs to be > 0.1s to avoid overflow/hang
+# Run submission, the run is queued on the worker pool and starts as soon as a
+# worker has a free slot, higher priority runs go first
 ##############################################################################
 
 
-
 @app.get("/run_orch_loop/{id}/", response_class=HTMLResponse)
-async def run_orch_loop(id: str, request: Request):
+async def run_orch_loop(id: str, request: Request, priority: int = 0, restart: bool = False):
     print(f"run_orch_loop: Getting config from DB {id}")
-    cfg = await mongo_db[MONGO_DBNAME].find_one({"_id": id})
-    model = ModelConfig(**cfg['model'])
-    cfg_vals = {k: v for k, v in cfg.items() if k != 'model'}
-    agent = AgentConfig(model=model, **cfg_vals)
-    filepath = f"logs/run_orch_loop_{id}.log"
-    print(f"run_orch_loop: Starting console with filepath {filepath}")
-    console = Console(file=open(filepath, "wt"), record=True, width=80)
-    print(f"run_orch_loop: Launching thread for config {id}")
-    proc = multiprocessing.Process(target=run_orchestrator_loop, args=(agent, console))
-    #thread = Thread(target=run_orchestrator_loop, args=(agent, console))
-    print(f"run_orch_loop: Starting Orchestrator loop with thread, logfile={filepath}")
-    proc.start()
-    global proc_for_loop
-    proc_for_loop[id] = proc
+    cfg = await mongo_db[MONGO_DBNAME].find_one({"_id": id}, RUN_PROJECTION)
+    if restart and cfg is not None:
+        # start over instead of resuming from the checkpoint
+        cfg["run_state"] = "new"
+    try:
+        job = worker_pool.submit(id, cfg, priority=priority)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=f"Run queue is full, {e}")
+    print(f"run_orch_loop: {id} {job.status} with priority {job.priority}")
     context = {"request": request,
                "agent": cfg,
                "layout": "all"}
     return templates.TemplateResponse("view_agent.html", context)
 
 
-
-@app.get("/download_project/{id}/", response_class=StreamingResponse)
+@app.get("/trace/{id}/")
+async def run_trace(id: str):
+    '''
+    The spans of the run in the Chrome trace format, saved when the run ends
+    (also in the project zip as trace.json)
+    '''
+    filepath = f"logs/run_orch_loop_{id}.trace.json"
+    if not os.path.exists(filepath):
+        raise HTTPException(status_code=404, detail=f"No trace for run {id} yet")
+    return FileResponse(filepath, media_type="application/json")
+
+
+@app.get("/timeline/{id}/", response_class=HTMLResponse)
+async def run_timeline(id: str, request: Request):
+    context = {"request": request, "id": id}
+    return templates.TemplateResponse("timeline.html", context)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    '''
+    Model call metrics of every run since the server started, in the
+    Prometheus text format
+    '''
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/jobs/")
+async def list_jobs():
+    return worker_pool.status()
+
+
+@app.get("/jobs/{id}/")
+async def job_status(id: str):
+    status = worker_pool.job_status(id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"No run {id}")
+    return status
+
+
+def is_not_modified(response_headers, request_headers):
+    '''
+    True when the client's copy is current, If-None-Match wins over
+    If-Modified-Since
+    '''
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        etags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return response_headers["etag"] in etags
+
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since is not None:
+        since = parsedate_to_datetime_or_none(if_modified_since)
+        modified = parsedate_to_datetime_or_none(response_headers["last-modified"])
+        return since is not None and modified is not None and modified <= since
+    return False
+
+
+def parsedate_to_datetime_or_none(value: str):
+    try:
+        return parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def file_download(filepath: str, filename: str, request: Request):
+    # FileResponse sends fixed size chunks, sets the ETag and Last-Modified
+    # from the stat and answers Range and If-Range requests
+    response = FileResponse(filepath, filename=filename, stat_result=os.stat(filepath),
+                            media_type="application/zip")
+    response.chunk_size = DOWNLOAD_CHUNK_SIZE
+    if is_not_modified(response.headers, request.headers):
+        headers = {name: response.headers[name] for name in ("etag", "last-modified")}
+        return Response(status_code=304, headers=headers)
+    return response
+
+
+@app.get("/download_project/{id}/", response_class=FileResponse)
 async def download_project(id: str, request: Request):
 
     filename = f"{id}_final.zip"
-    filepath = f"output/{filename}"
+    filepath = f"{OUTPUT_DIR}/{filename}"
 
     if not os.path.exists(filepath):
-        return {"error": f"file {filepath} doesn't exist, did you wait for loop to complete?"}
-    
-    def iterfile():
-        with open(filepath, mode="rb") as file_like:  # 
-            yield from file_like  # 
-
-    headers = {
-        'Content-Disposition': f'attachment; filename="{filename}"'
-    }
-    return StreamingResponse(iterfile(), headers=headers)
+        raise HTTPException(status_code=404,
+                            detail=f"file {filepath} doesn't exist, did you wait for loop to complete? "
+                                   f"The files generated so far are at /download_project/{id}/partial/")
+    return file_download(filepath, filename, request)
+
+
+@app.get("/download_project/{id}/partial/", response_class=FileResponse)
+async def download_partial(id: str, request: Request):
+    '''
+    The files the run has committed so far, the final archive once it is done
+    '''
+    try:
+        store = ArtifactStore(id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail=f"No run {id}")
+
+    final_path = f"{OUTPUT_DIR}/{id}_final.zip"
+    try:
+        if not os.path.exists(final_path):
+            filepath = await asyncio.to_thread(store.partial_zip)
+            return file_download(filepath, f"{id}_partial.zip", request)
+    except FileNotFoundError:
+        # no files yet, or the run just finished and dropped its store
+        pass
+    if os.path.exists(final_path):
+        return file_download(final_path, f"{id}_final.zip", request)
+    raise HTTPException(status_code=404, detail=f"Run {id} hasn't generated any files yet")
 
 ##############################################################################
 # Done:)
@@ -0,0 +1,89 @@
+# --------------------------------------------------------------------------------
+# File : strategies.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Registry of the orchestration strategies.
+# Purp : ModelConfig.strategy used to be stored and shown but every agent ran
+#        the same nested loop. The engines behind the names are registered
+#        here, each one sets how many refine iterations it runs, whether the
+#        subtasks of an iteration are planned and run concurrently and when it
+#        stops. The engines themselves live with the loop in orchestrator.py.
+# --------------------------------------------------------------------------------
+
+import os
+import re
+
+
+STRATEGY_DEFAULT = os.environ.get('STRATEGY_DEFAULT', 'IterativeRefinement')
+
+WORDS = re.compile(r"\S+")
+
+
+class Strategy:
+    '''
+    An orchestration engine, run returns the final output of the agent.
+    iterations and planning of None take the refine_iter and task_planning
+    of the model config, fan_out drops the dependencies of planned subtasks
+    so they all run at once.
+    '''
+
+    name = None
+    iterations = None
+    planning = None
+    fan_out = False
+
+    def refine_iterations(self, agent):
+        return agent.model.refine_iter if self.iterations is None else self.iterations
+
+    def plans(self, agent):
+        return agent.model.task_planning if self.planning is None else self.planning
+
+    def done(self, agent):
+        '''
+        Checked after every refine iteration, True stops the run early
+        '''
+        return False
+
+    async def run(self, agent, console, save_checkpoint):
+        raise NotImplementedError
+
+
+strategies = {}
+
+
+def register_strategy(cls):
+    strategies[cls.name] = cls
+    return cls
+
+
+def get_strategy(name: str):
+    '''
+    The engine registered as name, agents saved with a name that has no
+    engine run the default one
+    '''
+    return strategies.get(name, strategies[STRATEGY_DEFAULT])()
+
+
+# --------------------------------------------------------------------------------
+# Convergence of the fixed point strategy
+# --------------------------------------------------------------------------------
+
+
+def shingles(text: str, size: int = 3):
+    words = WORDS.findall(text)
+    return {" ".join(words[idx:idx + size]) for idx in range(max(len(words) - size + 1, 1))}
+
+
+def similarity(previous: str, current: str):
+    '''
+    Jaccard similarity of the word 3-grams of two outputs, 1.0 when a
+    refine iteration changed nothing. Linear in the length of the outputs.
+    '''
+    previous, current = shingles(previous), shingles(current)
+    union = len(previous | current)
+    return len(previous & current) / union if union else 1.0
+
+
+# --------------------------------------------------------------------------------
+# Done :)
+# --------------------------------------------------------------------------------
@@ -0,0 +1,179 @@
+# --------------------------------------------------------------------------------
+# File : tagparser.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Single pass parser for the tags in the refiner output.
+# Purp : The project name, folder structure and every file used to be found with
+#        str.split over the whole refined output, once per file. The parser
+#        takes the output in chunks as it streams in, scans every byte a bounded
+#        number of times and hands out tags as offsets into one buffer, so the
+#        file contents are only copied when they are written out.
+# --------------------------------------------------------------------------------
+
+import re
+
+from contextlib import contextmanager
+
+
+# the models write name="x", name='x', name=x, name=\"x\" and name=`x`
+OPEN_TAG = re.compile(rb'<(project_name|folder_structure)\s*>'
+                      rb'|<file\s+name\s*=\s*\\?["\'`]?([^"\'`>\\]*?)\\?["\'`]?\s*>')
+CLOSE_TAGS = {
+    "project_name": re.compile(rb'</project_name\s*>'),
+    "folder_structure": re.compile(rb'</folder_structure\s*>'),
+    "file": re.compile(rb'</file\s*>'),
+}
+# longest partial tag kept back when a chunk ends inside a tag
+MAX_TAG_LEN = 1024
+
+
+class Tag:
+    '''
+    A tag of the refined output, start and end are byte offsets of its
+    content in the parser buffer. complete is False for a tag the output
+    ended inside of, a truncated reply.
+    '''
+
+    def __init__(self, parser: "TagParser", kind: str, name: str, start: int, end: int,
+                 complete: bool = True):
+        self.parser = parser
+        self.kind = kind
+        self.name = name
+        self.start = start
+        self.end = end
+        self.complete = complete
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return f"Tag({self.kind!r}, {self.name!r}, {self.start}, {self.end}, complete={self.complete})"
+
+    @contextmanager
+    def content(self):
+        '''
+        The content as a memoryview of the parser buffer, released on exit
+        since the buffer can't grow while it is exported
+        '''
+        with memoryview(self.parser.buffer) as view, view[self.start:self.end] as content:
+            yield content
+
+    @property
+    def text(self):
+        with self.content() as content:
+            return str(content, "utf-8", "replace")
+
+    def write(self, fp):
+        '''
+        Write the content to a binary file object without copying it
+        '''
+        with self.content() as content:
+            fp.write(content)
+
+
+class TagParser:
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pos = 0
+        # (kind, name, content start) of the tag being read
+        self.open = None
+        self.closed = False
+
+    def feed(self, chunk):
+        '''
+        Add a chunk of output, returns the tags it completed
+        '''
+        if self.closed:
+            raise ValueError("feed() after close()")
+        self.buffer += chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+        return list(self.scan())
+
+    def close(self):
+        '''
+        End of output, returns the tag left open by a truncated reply if any
+        '''
+        self.closed = True
+        if self.open is None:
+            return []
+        kind, name, start = self.open
+        self.open = None
+        self.pos = len(self.buffer)
+        return [Tag(self, kind, name, start, len(self.buffer), complete=False)]
+
+    def keep_back(self, pos: int):
+        # resume at a trailing '<' that may start a tag the next chunk completes
+        idx = self.buffer.rfind(b"<", max(pos, len(self.buffer) - MAX_TAG_LEN))
+        self.pos = len(self.buffer) if idx < 0 else idx
+
+    def scan(self):
+        buffer = self.buffer
+        while True:
+            if self.open is None:
+                match = OPEN_TAG.search(buffer, self.pos)
+                if match is None:
+                    self.keep_back(self.pos)
+                    return
+                if match.group(1) is not None:
+                    kind, name = match.group(1).decode(), None
+                else:
+                    kind, name = "file", match.group(2).decode("utf-8", "replace").strip()
+                self.open = (kind, name, match.end())
+                self.pos = match.end()
+            else:
+                kind, name, start = self.open
+                match = CLOSE_TAGS[kind].search(buffer, self.pos)
+                if match is None:
+                    self.keep_back(self.pos)
+                    return
+                self.open = None
+                self.pos = match.end()
+                yield Tag(self, kind, name, start, match.start())
+
+
+class ParsedOutput:
+    '''
+    The first project name, folder structure and file of each name found in
+    the output, later repeats of a tag (continuations) are ignored
+    '''
+
+    def __init__(self, buffer: bytearray):
+        # the utf-8 output the tags point into
+        self.buffer = buffer
+        self.project_name = None
+        self.folder_structure = None
+        self.files = {}
+
+    def add(self, tag: Tag):
+        if tag.kind == "file":
+            self.files.setdefault(tag.name, tag)
+        elif getattr(self, tag.kind) is None:
+            setattr(self, tag.kind, tag)
+
+    def file(self, name: str):
+        '''
+        The file tag for a folder structure path, with or without the leading /
+        '''
+        for key in (name, name.lstrip("/"), f"/{name.lstrip('/')}"):
+            if key in self.files:
+                return self.files[key]
+        return None
+
+
+def parse_output(chunks):
+    '''
+    Parse a whole refined output, a string or an iterable of chunks
+    '''
+    parser = TagParser()
+    parsed = ParsedOutput(parser.buffer)
+    for chunk in [chunks] if isinstance(chunks, (str, bytes, bytearray)) else chunks:
+        for tag in parser.feed(chunk):
+            parsed.add(tag)
+    for tag in parser.close():
+        parsed.add(tag)
+    return parsed
+
+
+# --------------------------------------------------------------------------------
+# Done :)
+# --------------------------------------------------------------------------------
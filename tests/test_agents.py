@@ -0,0 +1,248 @@
+#---------------------------------------------------------------------------------
+# File : test_agents.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Tests for the provider registry and the iGPT client
+# Purp : Make sure provider clients are only built when used, that the
+#        orchestrator imports without the SDKs, keys or network, and that the
+#        iGPT session pools its connections, retries 5xx answers and
+#        shares one token per key without reloading a revoked one.
+#---------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import asyncio
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import agents
+from agents import ProviderRegistry, iGPT, TokenCache
+
+
+def test_clients_are_built_once_on_first_use():
+    built, closed = [], []
+    registry = ProviderRegistry()
+    registry.register("igpt", lambda: built.append("igpt") or object(), prefixes=("igpt",),
+                      aclose=lambda client: asyncio.sleep(0, closed.append(client)))
+    registry.register("openai", lambda: built.append("openai") or object(), prefixes=("gpt",))
+
+    assert registry.provider_for("igpt-4-turbo") == "igpt"
+    assert registry.provider_for("gpt-4") == "openai"
+    with pytest.raises(ValueError):
+        registry.provider_for("llama-3")
+    assert built == []
+
+    client = registry.client_for("igpt-4-turbo")
+    assert registry.client("igpt") is client
+    assert built == ["igpt"]
+
+    asyncio.run(registry.aclose())
+    assert closed == [client]
+
+
+def test_warm_skips_providers_without_credentials():
+    registry = ProviderRegistry()
+    registry.register("anthropic", lambda: os.environ["NO_SUCH_KEY"])
+    registry.register("tavily", object)
+    assert registry.warm() == ["tavily"]
+
+
+def test_orchestrator_imports_without_provider_sdks_or_keys():
+    env = {key: value for key, value in os.environ.items() if not key.endswith(("_KEY", "_SECRET"))}
+    script = ("import sys, orchestrator; "
+              "print(sorted(m for m in ('anthropic', 'openai', 'tavily', 'google.generativeai', "
+              "'requests', 'aiohttp', 'pandas') if m in sys.modules))")
+    result = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "[]"
+
+
+# --------------------------------------------------------------------------------
+# iGPT client against a local stand-in for the gateway
+# --------------------------------------------------------------------------------
+
+
+class Gateway:
+    '''
+    Answers each POST with the next queued (status, body), 200 once the queue
+    is empty, 401 for a token in expired, and records the client address of
+    every request
+    '''
+
+    def __init__(self):
+        self.replies = []
+        self.requests = []
+        self.expired = set()
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                gateway.requests.append((self.path, self.client_address, body))
+                if self.headers.get("Authorization", "").removeprefix("Bearer ") in gateway.expired:
+                    status, reply = 401, '{"message": "Token has expired"}'
+                elif gateway.replies:
+                    status, reply = gateway.replies.pop(0)
+                else:
+                    status, reply = 200, gateway.ok(self.path)
+                reply = reply.encode()
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def ok(self, path: str):
+        if path == "/auth":
+            return json.dumps({"access_token": f"tok{self.auths() - 1}", "expires_in": 3600})
+        return json.dumps({"currentResponse": "hi", "usage": {"promptTokens": 1, "completionTokens": 1}})
+
+    def auths(self):
+        return sum(1 for path, _, _ in self.requests if path == "/auth")
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def gateway(monkeypatch, tmp_path):
+    gateway = Gateway()
+    monkeypatch.setattr(agents, "IGPT_AUTH_URI", f"{gateway.url}/auth")
+    monkeypatch.setattr(agents, "IGPT_INF_URI", f"{gateway.url}/inference")
+    yield gateway
+    gateway.close()
+
+
+def make_client(tmp_path, **kwargs):
+    return iGPT("key", "secret", backoff=0, retries=2,
+                token_cache=TokenCache(str(tmp_path / "token.json")), **kwargs)
+
+
+def test_session_retries_status_errors_and_reuses_connections(gateway, tmp_path):
+    client = make_client(tmp_path)
+    adapter = client._session.get_adapter(gateway.url)
+    assert adapter._pool_maxsize == client.pool_size
+    assert 503 in adapter.max_retries.status_forcelist
+    assert 429 not in adapter.max_retries.status_forcelist
+
+    gateway.replies = [(503, "busy"), (502, "bad gateway")]
+    assert client.generate([{"role": "user", "content": "x"}])["currentResponse"] == "hi"
+    assert client.generate([{"role": "user", "content": "x"}])["currentResponse"] == "hi"
+
+    paths = [path for path, _, _ in gateway.requests]
+    assert paths == ["/auth", "/auth", "/auth", "/inference", "/inference"]
+    # one keep-alive connection carried every request
+    assert len({address for _, address, _ in gateway.requests}) == 1
+
+    # the retries give up after retries attempts and hand back the last answer
+    gateway.replies = [(500, "down")] * 3
+    assert client.generate([{"role": "user", "content": "x"}]).startswith("iGPT Generate Error  500")
+
+    # a 429 is left to the rate limiter of the caller
+    gateway.replies = [(429, "slow down")]
+    requests = len(gateway.requests)
+    assert client.generate([{"role": "user", "content": "x"}]).startswith("iGPT Generate Error  429")
+    assert len(gateway.requests) == requests + 1
+
+
+def test_async_post_retries_status_errors(gateway, tmp_path):
+    client = make_client(tmp_path)
+    gateway.replies = [(502, "bad gateway"), (503, "busy")]
+
+    async def run():
+        try:
+            first = await client.agenerate([{"role": "user", "content": "x"}])
+            gateway.replies = [(429, "slow down")]
+            return first, await client.agenerate([{"role": "user", "content": "x"}])
+        finally:
+            await client.aclose()
+
+    first, throttled = asyncio.run(run())
+    assert first["currentResponse"] == "hi"
+    assert throttled.startswith("iGPT Generate Error  429")
+    assert [path for path, _, _ in gateway.requests] == ["/auth", "/auth", "/auth", "/inference", "/inference"]
+
+
+def test_providers_close_the_igpt_session(gateway, tmp_path, monkeypatch):
+    monkeypatch.setenv("IGPT_KEY", "key")
+    monkeypatch.setenv("IGPT_SECRET", "secret")
+    monkeypatch.setattr(agents.providers, "clients", {})
+    client = agents.providers.client("igpt")
+    client.token_cache = TokenCache(str(tmp_path / "token.json"))
+    assert agents.providers.client_for("igpt-4-turbo") is client
+
+    client.generate([{"role": "user", "content": "x"}])
+    pools = client._session.get_adapter(gateway.url).poolmanager.pools
+    assert len(pools) == 1
+    agents.providers.close()
+    assert len(pools) == 0
+
+
+def test_token_is_shared_through_the_file_cache(gateway, tmp_path):
+    client = make_client(tmp_path)
+    assert client.get_token() == "tok0"
+    # a second process with the same credentials picks the token from the file
+    assert make_client(tmp_path).get_token() == "tok0"
+    assert make_client(tmp_path).token_cache.load("other key") == (None, 0)
+    assert gateway.auths() == 1
+
+
+def test_concurrent_callers_refresh_the_token_once(gateway, tmp_path):
+    client = make_client(tmp_path)
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(client.get_token())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert tokens == ["tok0"] * 8
+
+    # the async callers of a new client wait on the same refresh
+    client = make_client(tmp_path / "async")
+
+    async def run():
+        try:
+            return await asyncio.gather(*[client.aget_token() for _ in range(8)])
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run()) == ["tok1"] * 8
+    assert gateway.auths() == 2
+
+
+def test_expired_token_is_not_reloaded_from_the_cache(gateway, tmp_path):
+    client = make_client(tmp_path)
+    assert client.generate([{"role": "user", "content": "x"}])["currentResponse"] == "hi"
+
+    # the gateway revokes the token before its cached expiry
+    gateway.expired.add("tok0")
+    assert client.generate([{"role": "user", "content": "x"}])["currentResponse"] == "hi"
+    assert client.get_token() == "tok1"
+    assert client.token_cache.load("key") == ("tok1", client._expires_at)
+
+    gateway.expired.add("tok1")
+    other = make_client(tmp_path)
+
+    async def run():
+        try:
+            return await other.agenerate([{"role": "user", "content": "x"}])
+        finally:
+            await other.aclose()
+
+    assert asyncio.run(run())["currentResponse"] == "hi"
+    assert other.get_token() == "tok2"
+    assert gateway.auths() == 3
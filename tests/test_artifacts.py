@@ -0,0 +1,97 @@
+#---------------------------------------------------------------------------------
+# File : test_artifacts.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Tests for the run artifact store
+# Purp : Make sure committed files survive and archives come from the store.
+#---------------------------------------------------------------------------------
+
+import os
+import zipfile
+
+import pytest
+
+from artifacts import ArtifactStore
+
+
+def test_latest_commit_wins_and_repeats_are_skipped(tmp_path):
+    store = ArtifactStore("run1", root=str(tmp_path))
+
+    assert store.put("app/main.py", "v1") is not None
+    assert store.put("README.md", b"readme") is not None
+    assert store.put("app/main.py", "v1") is None
+    assert store.put("app/main.py", memoryview(b"v2")) is not None
+
+    entries = store.entries()
+    assert list(entries) == ["app/main.py", "README.md"]
+    with open(store.blob_path(entries["app/main.py"]), "rb") as f:
+        assert f.read() == b"v2"
+
+    # a crash mid commit leaves a torn manifest line, it never happened
+    with open(store.manifest, "a") as f:
+        f.write('{"name": "app/util.py", "blo')
+    assert list(ArtifactStore("run1", root=str(tmp_path)).entries()) == ["app/main.py", "README.md"]
+
+
+def test_archives_from_the_store(tmp_path):
+    store = ArtifactStore("run2", root=str(tmp_path))
+    store.put("a.py", "a = 1")
+    store.put("b.py", "b = 2")
+
+    partial = store.partial_zip()
+    assert sorted(zipfile.ZipFile(partial).namelist()) == ["a.py", "b.py"]
+    assert store.partial_zip() == partial
+
+    path = store.write_zip(str(tmp_path / "final.zip"), ["b.py", "missing.py"],
+                           extras={"final_output.txt": bytearray(b"out"), "log.html": "log"})
+    with zipfile.ZipFile(path) as zip_file:
+        assert sorted(zip_file.namelist()) == ["b.py", "final_output.txt", "log.html"]
+        assert zip_file.read("final_output.txt") == b"out"
+
+    store.discard()
+    assert not os.path.exists(store.path)
+    with pytest.raises(ValueError):
+        ArtifactStore("../etc", root=str(tmp_path))
+
+
+def test_commits_keep_the_index_and_run_off_the_loop(tmp_path, monkeypatch):
+    import asyncio
+    import threading
+
+    import artifacts
+    import orchestrator
+    from rich.console import Console
+
+    reads, threads = [], []
+    read_manifest = ArtifactStore.read_manifest
+    put = ArtifactStore.put
+
+    def counted_read(self):
+        reads.append(self.run_id)
+        return read_manifest(self)
+
+    def recorded_put(self, name, data):
+        threads.append(threading.current_thread())
+        return put(self, name, data)
+
+    monkeypatch.setattr(ArtifactStore, "read_manifest", counted_read)
+    monkeypatch.setattr(ArtifactStore, "put", recorded_put)
+    model = orchestrator.ModelConfig(orchestrator_model="claude-3-haiku-20240307",
+                                     refiner_model="claude-3-haiku-20240307",
+                                     subagent_model="claude-3-haiku-20240307", task_iter=1, refine_iter=1,
+                                     strategy="IterativeRefinement")
+    agent = orchestrator.AgentConfig(name="index", objective="objective", model=model)
+    monkeypatch.setattr(artifacts, "stores", {str(agent.id): ArtifactStore(agent.id, root=str(tmp_path))})
+    text = "".join(f"<file name='/f{idx}.py'>x = {idx}</file>" for idx in range(5))
+
+    async def run():
+        await orchestrator.commit_artifacts(agent, text, Console(file=open("/dev/null", "w")))
+        await orchestrator.commit_artifacts(agent, text.replace("x", "y"), Console(file=open("/dev/null", "w")))
+        return threading.current_thread()
+
+    loop_thread = asyncio.run(run())
+
+    assert reads == [str(agent.id)]
+    assert len(threads) == 10 and loop_thread not in threads
+    assert len(artifacts.artifact_store(agent.id).entries()) == 5
+    assert os.path.exists(os.path.join(str(tmp_path), str(agent.id), "manifest.jsonl"))
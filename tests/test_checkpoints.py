@@ -0,0 +1,102 @@
+#---------------------------------------------------------------------------------
+# File : test_checkpoints.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Tests for the run state checkpoints
+# Purp : Make sure steps are saved as small deltas and a run loads back.
+#---------------------------------------------------------------------------------
+
+import asyncio
+
+from checkpoints import CheckpointStore, ERA_TASK
+from orchestrator import ModelConfig, AgentConfig
+
+
+class FakeCursor:
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, keys):
+        for key, direction in reversed(keys):
+            self.docs.sort(key=lambda doc: doc[key], reverse=direction < 0)
+        return self
+
+    async def __aiter__(self):
+        for doc in self.docs:
+            yield doc
+
+
+class FakeCollection:
+
+    def __init__(self):
+        self.docs = []
+        self.updates = []
+
+    async def create_index(self, keys, **kwargs):
+        pass
+
+    async def update_one(self, query, update):
+        self.updates.append(update)
+
+    async def replace_one(self, query, doc, upsert=False):
+        self.docs = [d for d in self.docs if any(d[k] != v for k, v in query.items())] + [doc]
+
+    async def delete_many(self, query):
+        self.docs = [d for d in self.docs if any(d[k] != v for k, v in query.items())]
+
+    def find(self, query, projection=None):
+        return FakeCursor([dict(d) for d in self.docs if all(d[k] == v for k, v in query.items())])
+
+
+def make_agent(**kwargs):
+    model = ModelConfig(orchestrator_model="claude-3-haiku-20240307", refiner_model="claude-3-haiku-20240307",
+                        subagent_model="claude-3-haiku-20240307", strategy="Strategy 1")
+    return AgentConfig(name="checkpoint", objective="objective", model=model, **kwargs)
+
+
+def test_steps_are_deltas_and_load_back():
+    agent = make_agent(run_state="running", tokens_used=42)
+    store = CheckpointStore(FakeCollection(), FakeCollection())
+
+    async def run():
+        await store.start(agent, fresh=True)
+        agent.subtask_queries[0] = ["q0", "q1"]
+        agent.subtask_results[0] = ["r0", "r1"]
+        await store.subtask(agent, 0, 0)
+        agent.subtask_digests[0] = "digest"
+        await store.subtask(agent, 0, 1)
+        agent.era_results.append("era 0")
+        await store.era(agent, 0)
+
+        resumed = make_agent(_id=agent.id, run_state="running")
+        return await store.load(resumed)
+
+    resumed = asyncio.run(run())
+
+    assert resumed.subtask_queries == {0: ["q0", "q1"]}
+    assert resumed.subtask_results == {0: ["r0", "r1"]}
+    assert resumed.era_results == ["era 0"]
+
+    # the agent document only gets the progress, never the results
+    start, first, second, era = store.agents.updates
+    assert "subtask_results" in start["$unset"]
+    assert first["$set"] == {"tokens_used": 42}
+    assert second["$set"] == {"tokens_used": 42, "subtask_digests.0": "digest"}
+    assert era["$push"]["steps"]["task"] == ERA_TASK
+    assert {(d["era"], d["task"]) for d in store.results.docs} == {(0, 0), (0, 1), (0, ERA_TASK)}
+
+
+def test_fresh_start_drops_old_results():
+    agent = make_agent(run_state="running")
+    store = CheckpointStore(FakeCollection(), FakeCollection())
+
+    async def run():
+        agent.subtask_queries[0] = ["q0"]
+        agent.subtask_results[0] = ["r0"]
+        await store.subtask(agent, 0, 0)
+        await store.start(agent, fresh=True)
+
+    asyncio.run(run())
+
+    assert store.results.docs == []
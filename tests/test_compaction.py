@@ -0,0 +1,70 @@
+#---------------------------------------------------------------------------------
+# File : test_compaction.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Tests for the rolling context digest
+# Purp : Make sure the prompt context stays bounded however many subtasks run.
+#---------------------------------------------------------------------------------
+
+import asyncio
+
+from compaction import fold_index, render_results, update_digest
+import tokens
+from tokens import count_tokens
+
+
+def test_render_keeps_last_results_verbatim():
+    results = ["zero", "one", "two", "three"]
+
+    rendered = render_results(results, "digest of 0 and 1", keep=2)
+
+    assert rendered == ["**Subtask 0-1 Results (digest)**\ndigest of 0 and 1",
+                        "**Subtask 2 Results**\ntwo",
+                        "**Subtask 3 Results**\nthree"]
+    assert len(render_results(results, "", keep=2, compact=False)) == 4
+    assert render_results(results[:2], "", keep=2) == ["**Subtask 0 Results**\nzero",
+                                                        "**Subtask 1 Results**\none"]
+
+
+def test_digest_stays_bounded():
+    prompts = []
+
+    async def summarize(prompt, max_tokens):
+        prompts.append(prompt)
+        # a model that ignores the word limit
+        return prompt
+
+    async def run():
+        results, digest = [], ""
+        for idx in range(30):
+            results.append(f"result {idx} " * 200)
+            idx_fold = fold_index(results, keep=2)
+            if idx_fold is not None:
+                digest = await update_digest("objective", digest, results[idx_fold],
+                                             f"Subtask {idx_fold}", 500, summarize)
+        return results, digest
+
+    results, digest = asyncio.run(run())
+    context = "\n".join(render_results(results, digest, keep=2))
+
+    assert len(prompts) == 28
+    assert len(digest) <= 500 * 4 + 100
+    assert len(prompts[-1]) < len(prompts[5]) * 1.1
+    assert "result 29" in context and "result 27" not in context.split("(digest)**")[0]
+
+
+def test_failed_summary_falls_back_to_truncation(monkeypatch):
+
+    async def failed(prompt, max_tokens):
+        return None
+
+    digest = asyncio.run(update_digest("objective", "old", "x" * 10000, "Subtask 3", 100, failed))
+
+    assert digest.startswith("old")
+    assert "[trimmed" in digest
+    assert count_tokens(digest) <= 100
+
+    # code and non-English text run well over a token per 4 characters
+    monkeypatch.setattr(tokens, "count_tokens", lambda text: len(text) // 2)
+    digest = asyncio.run(update_digest("objective", "", "数据" * 5000, "Subtask 4", 100, failed))
+    assert tokens.count_tokens(digest) <= 100
@@ -0,0 +1,63 @@
+#---------------------------------------------------------------------------------
+# File : test_events.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Tests for the run event broker
+# Purp : Check fan out to every viewer, late viewers and the file fallback.
+#---------------------------------------------------------------------------------
+
+import asyncio
+
+from events import EventBroker, RunEvents
+
+
+async def collect(broker, run_id, path):
+    return [event["event"] async for event in broker.subscribe(run_id, path)]
+
+
+def test_broker_fans_out_to_every_viewer(tmp_path):
+    path = str(tmp_path / "run.events")
+
+    async def run():
+        broker = EventBroker()
+        events = RunEvents(path, run_id="run", broker=broker)
+        events.emit("log", text="before")
+        viewers = [asyncio.create_task(collect(broker, "run", path)) for _ in range(3)]
+        await asyncio.sleep(0)
+        events.emit("token", text="hi")
+        events.emit("done", status="complete")
+        return await asyncio.gather(*viewers), broker
+
+    seen, broker = asyncio.run(run())
+
+    assert seen == [["log", "token", "done"]] * 3
+    assert broker.viewers("run") == 0
+    assert not broker.live("run")
+    assert "run" not in broker.subscribers
+
+
+def test_finished_runs_are_read_from_file(tmp_path):
+    path = str(tmp_path / "run.events")
+    broker = EventBroker()
+    events = RunEvents(path, run_id="run", broker=broker)
+    events.emit("log", text="line")
+    events.emit("done", status="complete")
+    events.close()
+
+    assert asyncio.run(collect(broker, "run", path)) == ["log", "done"]
+    # nothing is kept for a run nobody watched
+    assert broker.subscribers == {} and broker.history == {}
+
+
+def test_file_is_followed_until_done(tmp_path):
+    path = str(tmp_path / "run.events")
+    events = RunEvents(path)
+    events.emit("log", text="line")
+
+    async def run():
+        viewer = asyncio.create_task(collect(EventBroker(), "run", path))
+        await asyncio.sleep(0.05)
+        events.emit("done", status="complete")
+        return await asyncio.wait_for(viewer, 2)
+
+    assert asyncio.run(run()) == ["log", "done"]
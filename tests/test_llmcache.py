@@ -0,0 +1,87 @@
+#---------------------------------------------------------------------------------
+# File : test_llmcache.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Tests for the content addressed LLM response cache
+# Purp : Check hits, eviction, ttl, the strict replay mode and that a busy
+#        database doesn't block the event loop.
+#---------------------------------------------------------------------------------
+
+import time
+import sqlite3
+import asyncio
+
+import pytest
+
+from llmcache import LLMCache, CacheMissError
+
+
+def test_cache_round_trip(tmp_path):
+    cache = LLMCache(path=str(tmp_path / "cache.sqlite"), mode="on")
+    key = cache.key("anthropic", "claude", {"max_tokens": 10}, "hello")
+
+    assert cache.get(key) is None
+    cache.put(key, "anthropic", "claude", {"text": "hi"})
+
+    assert cache.get(key) == {"text": "hi"}
+    assert key != cache.key("anthropic", "claude", {"max_tokens": 20}, "hello")
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = LLMCache(path=str(tmp_path / "cache.sqlite"), mode="on", max_bytes=60)
+    cache.put("a", "p", "m", {"text": "a" * 10})
+    cache.put("b", "p", "m", {"text": "b" * 10})
+    time.sleep(0.01)
+    cache.get("a")
+    cache.put("c", "p", "m", {"text": "c" * 10})
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_cache_ttl(tmp_path):
+    cache = LLMCache(path=str(tmp_path / "cache.sqlite"), mode="on", ttl=0.01)
+    cache.put("a", "p", "m", {"text": "a"})
+    time.sleep(0.02)
+
+    assert cache.get("a") is None
+
+
+def test_replay_is_strict(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    LLMCache(path=path, mode="record").put("a", "p", "m", {"text": "a"})
+    replay = LLMCache(path=path, mode="replay")
+    replay.put("b", "p", "m", {"text": "b"})
+
+    assert replay.get("a") == {"text": "a"}
+    with pytest.raises(CacheMissError):
+        replay.get("b")
+
+
+def test_busy_database_does_not_block_the_loop(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = LLMCache(path=path, mode="on")
+    cache.put("a", "p", "m", {"text": "a"})
+    writer = sqlite3.connect(path, check_same_thread=False)
+    writer.execute("BEGIN EXCLUSIVE")
+
+    async def run():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticking = asyncio.create_task(ticker())
+        asyncio.get_running_loop().call_later(0.2, writer.rollback)
+        await cache.aput("b", "p", "m", {"text": "b"})
+        ticking.cancel()
+        return ticks, await cache.aget("b")
+
+    ticks, cached = asyncio.run(run())
+    assert ticks > 5
+    assert cached == {"text": "b"}
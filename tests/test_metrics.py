@@ -0,0 +1,113 @@
+#---------------------------------------------------------------------------------
+# File : test_metrics.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Tests for the model call metrics
+# Purp : Make sure call_end events add up to the right Prometheus series.
+#---------------------------------------------------------------------------------
+
+from types import SimpleNamespace
+
+from metrics import Metrics, CallMetrics, current_call, record_retry, record_wait
+
+
+def call_end(**fields):
+    event = {"event": "call_end", "call": "c1", "phase": "subagent", "model": "claude-3-haiku-20240307",
+             "provider": "anthropic", "input_tokens": 1000, "output_tokens": 200,
+             "cache_read_tokens": 0, "cache_write_tokens": 0, "latency": 3.0, "ttft": 0.4,
+             "retries": 0, "rate_limit_wait": 0.0, "cached": False, "failed": False}
+    event.update(fields)
+    return event
+
+
+def test_call_end_events_are_aggregated():
+    metrics = Metrics()
+    labels = 'provider="anthropic",model="claude-3-haiku-20240307",phase="subagent"'
+
+    metrics.observe("run1", call_end())
+    metrics.observe("run1", call_end(latency=30.0, retries=2, rate_limit_wait=12.5))
+    metrics.observe("run1", call_end(cached=True, latency=0.01))
+    metrics.observe("run1", {"event": "token", "text": "x"})
+    metrics.observe("run1", {"event": "done", "status": "complete"})
+    text = metrics.render()
+
+    assert f'agent_model_calls_total{{{labels},status="ok"}} 2' in text
+    assert f'agent_model_calls_total{{{labels},status="cached"}} 1' in text
+    assert f'agent_model_call_seconds_bucket{{{labels},le="5"}} 2' in text
+    assert f'agent_model_call_seconds_bucket{{{labels},le="+Inf"}} 3' in text
+    assert f'agent_model_call_seconds_sum{{{labels}}} 33.01' in text
+    assert f'agent_model_tokens_total{{{labels},kind="input"}} 2000' in text
+    assert f'agent_model_retries_total{{{labels}}} 2' in text
+    assert f'agent_rate_limit_wait_seconds_total{{{labels}}} 12.5' in text
+    assert 'agent_runs_total{status="complete"} 1' in text
+    assert "# TYPE agent_model_ttft_seconds histogram" in text
+
+
+def test_large_totals_keep_every_digit():
+    metrics = Metrics()
+    labels = 'provider="anthropic",model="claude-3-haiku-20240307",phase="subagent"'
+
+    metrics.observe("run2", call_end(input_tokens=1234567, latency=1234567.25))
+    text = metrics.render()
+
+    assert f'agent_model_tokens_total{{{labels},kind="input"}} 1234567' in text
+    assert f'agent_model_call_seconds_sum{{{labels}}} 1234567.25' in text
+
+
+def test_search_cache_lookups_are_exported(monkeypatch):
+    import asyncio
+    import orchestrator
+    from events import run_events
+    from rich.console import Console
+    from searchcache import SearchCache
+
+    metrics = Metrics()
+    fetched = []
+
+    async def fake_search_tavily(query):
+        fetched.append(query)
+        await asyncio.sleep(0.01)
+        return f"answer to {query}"
+
+    class Events:
+        def emit(self, event, **data):
+            metrics.observe("run3", {"event": event, **data})
+
+    monkeypatch.setattr(orchestrator, "search_cache", SearchCache(ttl=60))
+    monkeypatch.setattr(orchestrator, "search_tavily", fake_search_tavily)
+    console = Console(file=open("/dev/null", "w"))
+
+    async def run():
+        run_events.set(Events())
+        searches = [orchestrator.query_search_provider(query, "tavily", console)
+                    for query in ("What is FastAPI?", "what is fastapi", "What is Flask?")]
+        await asyncio.gather(*searches)
+        await orchestrator.query_search_provider("WHAT IS FLASK", "tavily", console)
+
+    asyncio.run(run())
+    text = metrics.render()
+
+    assert len(fetched) == 2
+    assert 'search_cache_hits_total{provider="tavily"} 1' in text
+    assert 'search_cache_coalesced_total{provider="tavily"} 1' in text
+    assert 'search_cache_misses_total{provider="tavily"} 2' in text
+
+
+def test_call_metrics_collect_retries_and_waits():
+    call = CallMetrics("gemini", "gemini-1.5-pro", "refiner")
+    record_retry()
+    token = current_call.set(call)
+    try:
+        record_retry()
+        record_wait(1.5)
+        call.token()
+    finally:
+        current_call.reset(token)
+    record_wait(10.0)
+
+    fields = call.fields(SimpleNamespace(cached=False, failed=False))
+
+    assert fields["retries"] == 1
+    assert fields["rate_limit_wait"] == 1.5
+    assert fields["provider"] == "gemini"
+    assert 0 <= fields["ttft"] <= fields["latency"]
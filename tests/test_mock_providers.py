@@ -0,0 +1,70 @@
+#---------------------------------------------------------------------------------
+# File : test_mock_providers.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Tests for the benchmark provider stand-ins
+# Purp : Make sure the real clients can talk to the stand-ins, and that the
+#        truncation, continuation and 429 behaviours do what they say.
+#---------------------------------------------------------------------------------
+
+import asyncio
+
+import pytest
+from anthropic import AsyncAnthropic, RateLimitError
+
+from bench.mock_providers import MockServer, MockState, Behaviour
+from bench.run_bench import regressions
+
+
+def test_anthropic_stream_cache_and_rate_limit():
+    with MockServer() as server:
+        client = AsyncAnthropic(api_key="x", base_url=server.url, max_retries=0)
+        content = [{"type": "text", "text": "P" * 400, "cache_control": {"type": "ephemeral"}},
+                   {"type": "text", "text": "hello"}]
+
+        async def stream():
+            async with client.messages.stream(model="claude-x", max_tokens=4096,
+                                              messages=[{"role": "user", "content": content}]) as s:
+                chunks = [text async for text in s.text_stream]
+                return chunks, await s.get_final_message()
+
+        async def run():
+            chunks, first = await stream()
+            assert len(chunks) > 1
+            assert first.stop_reason == "end_turn"
+            assert first.usage.output_tokens == 200
+            assert first.usage.cache_creation_input_tokens == 100
+
+            _, second = await stream()
+            assert second.usage.cache_read_input_tokens == 100
+
+            server.state.behaviour["anthropic"] = Behaviour(rate_limit_rate=1.0, retry_after=2)
+            with pytest.raises(RateLimitError) as error:
+                await client.messages.create(model="claude-x", max_tokens=10,
+                                             messages=[{"role": "user", "content": "x"}])
+            assert error.value.response.headers["retry-after"] == "2"
+
+        asyncio.run(run())
+
+
+def test_truncated_reply_is_continued_after_the_prefill():
+    state = MockState()
+    state.behaviour["anthropic"] = Behaviour(output_tokens=100)
+    whole = state.reply("anthropic", "hello").text
+
+    cut = state.reply("anthropic", "hello", max_tokens=40)
+    assert cut.truncated
+    assert state.output_tokens(cut, 40) == 40
+
+    rest = state.reply("anthropic", "hello", prefill=cut.text[-50:].rstrip())
+    assert cut.text.rstrip() + rest.text == whole
+    assert state.stats["anthropic"]["continuations"] == 1
+
+
+def test_regressions_respect_direction_and_tolerance():
+    baseline = {"loop": {"overhead_per_call": 0.010}, "extraction": {"mb_per_second": 100.0}}
+    assert regressions({"loop": {"overhead_per_call": 0.011}, "extraction": {"mb_per_second": 95.0}},
+                       baseline, 0.2) == []
+    found = regressions({"loop": {"overhead_per_call": 0.020}, "extraction": {"mb_per_second": 50.0}},
+                        baseline, 0.2)
+    assert [path for path, _, _ in found] == ["loop.overhead_per_call", "extraction.mb_per_second"]
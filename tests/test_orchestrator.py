@@ -7,9 +7,12 @@
 #        AI Agent application.
 # --------------------------------------------------------------------------------
 
+import asyncio
+
 from orchestrator import ModelConfig, AgentConfig
 from orchestrator import query_orchestrator, run_orchestrator_loop
 from orchestrator import extract_output
+from orchestrator import list_files
 
 
 def test_orchestrator_query_claude_opus():
@@ -28,7 +31,7 @@ def test_orchestrator_query_claude_opus():
                         use_search=True,
                         include_files=False,
                         model=model)
-    result, search_query = query_orchestrator(agent)
+    result, search_query = asyncio.run(query_orchestrator(agent))
 
     assert result is not None
     assert search_query is not None
@@ -100,4 +103,551 @@ def test_output_pybuddy():
     
     zip_bytes = extract_output(final_output)
     
-    assert zip_bytes is not None
\ No newline at end of file
+    assert zip_bytes is not None
+
+
+def test_list_files_in_folder_order():
+    folder_structure = {"app": {"main.py": None, "static": {"styles.css": None}},
+                        "README.md": None}
+
+    names = list_files(folder_structure)
+
+    assert names == ["/app/main.py", "/app/static/styles.css", "/README.md"]
+
+
+def test_continuation_prefills_tail_and_stops_at_cap(monkeypatch):
+    import orchestrator
+    from orchestrator import ModelResponse, continue_model
+    from rich.console import Console
+
+    calls = []
+
+    async def fake_query_model(model_name, prompt, max_tokens, console, prefill=None, **kwargs):
+        calls.append((prompt, prefill, max_tokens))
+        return ModelResponse(text=f" part{len(calls)}" + " x" * 2000, output_tokens=max_tokens)
+
+    monkeypatch.setattr(orchestrator, "query_model", fake_query_model)
+    first = ModelResponse(text="part0" + " x" * 2000, output_tokens=1000)
+
+    text = asyncio.run(continue_model("claude-3-haiku-20240307", "the prompt", first, 1000,
+                                      Console(file=open("/dev/null", "w")),
+                                      max_continuation_tokens=2500, continuation_tail=200))
+
+    # every continuation sends the prompt once and a bounded tail of the reply
+    assert [prompt for prompt, _, _ in calls] == ["the prompt"] * 3
+    assert all(len(prefill) < 200 * 8 for _, prefill, _ in calls)
+    assert [max_tokens for _, _, max_tokens in calls] == [1000, 1000, 500]
+    assert text.startswith("part0") and "part3" in text
+
+
+def test_anthropic_prefix_is_cached_and_charged(monkeypatch, tmp_path):
+    import orchestrator
+    from types import SimpleNamespace
+    from llmcache import LLMCache
+    from tokens import TokenBudget, run_budget
+    from rich.console import Console
+
+    requests = []
+
+    class FakeStream:
+        response = SimpleNamespace(headers={})
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            return False
+
+        @property
+        async def text_stream(self):
+            yield "ok"
+
+        async def get_final_message(self):
+            usage = SimpleNamespace(input_tokens=20, output_tokens=5,
+                                    cache_read_input_tokens=3000, cache_creation_input_tokens=0)
+            return SimpleNamespace(content=[SimpleNamespace(text="ok")], usage=usage)
+
+    def stream(**kwargs):
+        requests.append(kwargs)
+        return FakeStream()
+
+    monkeypatch.setitem(orchestrator.providers.clients, "anthropic",
+                        SimpleNamespace(messages=SimpleNamespace(stream=stream)))
+    monkeypatch.setattr(orchestrator, "llm_cache", LLMCache(path=str(tmp_path / "cache.sqlite"), mode="off"))
+    budget = TokenBudget(limit=100000)
+
+    async def run():
+        run_budget.set(budget)
+        return await orchestrator.query_model("claude-3-haiku-20240307", "the question", 100,
+                                              Console(file=open("/dev/null", "w")),
+                                              prefix="the stable prefix ")
+
+    response = asyncio.run(run())
+
+    content = requests[0]["messages"][0]["content"]
+    assert content[0] == {"type": "text", "text": "the stable prefix ",
+                          "cache_control": {"type": "ephemeral"}}
+    assert content[1] == {"type": "text", "text": "the question"}
+    assert response.cache_read_tokens == 3000
+    assert budget.used == 3025
+
+
+def test_budget_capped_reply_is_cached_under_the_allowance_sent(monkeypatch, tmp_path):
+    import orchestrator
+    from types import SimpleNamespace
+    from llmcache import LLMCache
+    from tokens import TokenBudget, run_budget
+    from rich.console import Console
+
+    sent = []
+
+    class FakeStream:
+        response = SimpleNamespace(headers={})
+
+        def __init__(self, max_tokens):
+            self.max_tokens = max_tokens
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            return False
+
+        @property
+        async def text_stream(self):
+            yield "cut"
+
+        async def get_final_message(self):
+            # the reply always runs up to the allowance it was given
+            usage = SimpleNamespace(input_tokens=20, output_tokens=self.max_tokens,
+                                    cache_read_input_tokens=0, cache_creation_input_tokens=0)
+            return SimpleNamespace(content=[SimpleNamespace(text=f"cut at {self.max_tokens}")], usage=usage)
+
+    def stream(**kwargs):
+        sent.append(kwargs["max_tokens"])
+        return FakeStream(kwargs["max_tokens"])
+
+    monkeypatch.setitem(orchestrator.providers.clients, "anthropic",
+                        SimpleNamespace(messages=SimpleNamespace(stream=stream)))
+    monkeypatch.setattr(orchestrator, "llm_cache", LLMCache(path=str(tmp_path / "cache.sqlite"), mode="on"))
+    console = Console(file=open("/dev/null", "w"))
+
+    async def run(budget):
+        run_budget.set(budget)
+        return await orchestrator.query_model("claude-3-haiku-20240307", "the question", 2000, console)
+
+    capped = asyncio.run(run(TokenBudget(limit=1000)))
+    assert sent == [capped.max_tokens] and capped.max_tokens < 1000
+    assert orchestrator.is_truncated(capped, 2000)
+    # the same cap is answered from the cache
+    assert asyncio.run(run(TokenBudget(limit=1000))).cached
+    assert len(sent) == 1
+
+    # without the cap the full allowance is asked for, not the capped reply
+    full = asyncio.run(run(None))
+    assert sent[-1] == 2000 and not full.cached
+    assert full.text == "cut at 2000" and full.max_tokens == 2000
+    assert asyncio.run(run(None)).cached
+
+
+def test_budget_allowance_is_sent_to_every_provider(monkeypatch, tmp_path):
+    import agents
+    import orchestrator
+    from types import SimpleNamespace
+    from bench.mock_providers import MockServer, Behaviour
+    from llmcache import LLMCache
+    from tokens import TokenBudget, run_budget
+    from rich.console import Console
+
+    monkeypatch.setattr(orchestrator, "llm_cache", LLMCache(path=str(tmp_path / "cache.sqlite"), mode="off"))
+    console = Console(file=open("/dev/null", "w"))
+    configs = []
+
+    class FakeGeminiResponse:
+        text = "short"
+        usage_metadata = SimpleNamespace(prompt_token_count=10, candidates_token_count=20)
+
+        async def __aiter__(self):
+            yield SimpleNamespace(text=self.text)
+
+    async def generate_content_async(contents, generation_config=None, **kwargs):
+        configs.append(generation_config)
+        return FakeGeminiResponse()
+
+    monkeypatch.setitem(orchestrator.providers.clients, "gemini", SimpleNamespace(
+        GenerativeModel=lambda name: SimpleNamespace(generate_content_async=generate_content_async)))
+
+    async def run(model_name, limit):
+        run_budget.set(TokenBudget(limit=limit))
+        response = await orchestrator.query_model(model_name, "the question", 2000, console)
+        return response, run_budget.get()
+
+    response, budget = asyncio.run(run("gemini-1.5-pro", 1000))
+    assert configs == [{"max_output_tokens": response.max_tokens}] and response.max_tokens < 1000
+    assert not orchestrator.is_truncated(response, 2000)
+
+    with MockServer() as server:
+        server.state.behaviour["igpt"] = Behaviour(output_tokens=3000)
+        monkeypatch.setattr(agents, "IGPT_AUTH_URI", f"{server.url}/igpt/auth")
+        monkeypatch.setattr(agents, "IGPT_INF_URI", f"{server.url}/igpt/inference")
+        client = agents.iGPT("key", "secret", token_cache=agents.TokenCache(str(tmp_path / "token.json")))
+        monkeypatch.setitem(orchestrator.providers.clients, "igpt", client)
+
+        async def run_igpt():
+            try:
+                return await run("igpt-4-turbo", 1000)
+            finally:
+                await client.aclose()
+
+        response, budget = asyncio.run(run_igpt())
+
+    # the shared client keeps its own allowance, the request carries the capped one
+    assert client.max_tokens == 4096
+    assert response.output_tokens == response.max_tokens < 1000
+    assert budget.used <= 1000 and budget.held == 0
+
+
+def test_concurrent_calls_stay_within_the_budget(monkeypatch, tmp_path):
+    import orchestrator
+    from types import SimpleNamespace
+    from llmcache import LLMCache
+    from tokens import TokenBudget, run_budget, BudgetExceededError
+    from rich.console import Console
+
+    class FakeStream:
+        response = SimpleNamespace(headers={})
+
+        def __init__(self, max_tokens):
+            self.max_tokens = max_tokens
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            return False
+
+        @property
+        async def text_stream(self):
+            await asyncio.sleep(0.01)
+            yield "long"
+
+        async def get_final_message(self):
+            usage = SimpleNamespace(input_tokens=10, output_tokens=self.max_tokens,
+                                    cache_read_input_tokens=0, cache_creation_input_tokens=0)
+            return SimpleNamespace(content=[SimpleNamespace(text="long")], usage=usage)
+
+    monkeypatch.setitem(orchestrator.providers.clients, "anthropic", SimpleNamespace(
+        messages=SimpleNamespace(stream=lambda **kwargs: FakeStream(kwargs["max_tokens"]))))
+    monkeypatch.setattr(orchestrator, "llm_cache", LLMCache(path=str(tmp_path / "cache.sqlite"), mode="off"))
+    console = Console(file=open("/dev/null", "w"))
+    budget = TokenBudget(limit=5000)
+
+    async def run():
+        run_budget.set(budget)
+        calls = [orchestrator.query_model("claude-3-haiku-20240307", f"question {i}", 2000, console)
+                 for i in range(4)]
+        return await asyncio.gather(*calls, return_exceptions=True)
+
+    results = asyncio.run(run())
+
+    assert sum(isinstance(result, BudgetExceededError) for result in results) == 1
+    assert budget.used <= 5000 and budget.held == 0
+
+
+def test_failed_file_cancels_the_other_files(monkeypatch):
+    import orchestrator
+    from rich.console import Console
+    from tokens import BudgetExceededError
+
+    started, committed = [], []
+
+    async def fake_query_model(*args, **kwargs):
+        return orchestrator.ModelResponse(
+            text='<folder_structure>{"a.py": null, "b.py": null, "c.py": null, "d.py": null}</folder_structure>',
+            output_tokens=10, max_tokens=100)
+
+    async def fake_refine_file(agent, name, *args, **kwargs):
+        started.append(name)
+        await asyncio.sleep(0.01 if name == "/b.py" else 0.2)
+        if name == "/b.py":
+            raise BudgetExceededError("budget exhausted")
+        committed.append(name)
+        return name
+
+    monkeypatch.setattr(orchestrator, "query_model", fake_query_model)
+    monkeypatch.setattr(orchestrator, "refine_file", fake_refine_file)
+
+    async def no_commit(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(orchestrator, "commit_artifacts", no_commit)
+    model = ModelConfig(orchestrator_model="claude-3-haiku-20240307", refiner_model="claude-3-haiku-20240307",
+                        subagent_model="claude-3-haiku-20240307", task_iter=1, refine_iter=1,
+                        strategy="IterativeRefinement", refine_concurrency=4)
+    agent = AgentConfig(name="cancel", objective="objective", model=model, subtask_results={0: ["done"]})
+
+    async def run():
+        try:
+            await orchestrator.refine_output(agent, 0, None, Console(file=open("/dev/null", "w")))
+        except BudgetExceededError:
+            pass
+        # the run has moved on, nothing else may finish
+        await asyncio.sleep(0.4)
+
+    asyncio.run(run())
+
+    assert sorted(started) == ["/a.py", "/b.py", "/c.py", "/d.py"]
+    assert committed == ["/a.py"]
+
+
+def test_refined_file_is_wrapped_once(monkeypatch):
+    import orchestrator
+    from rich.console import Console
+
+    replies = []
+
+    async def fake_query_model(*args, **kwargs):
+        return orchestrator.ModelResponse(text=replies.pop(0), output_tokens=10, max_tokens=100)
+
+    monkeypatch.setattr(orchestrator, "query_model", fake_query_model)
+
+    async def no_commit(agent, text, console):
+        return None
+
+    monkeypatch.setattr(orchestrator, "commit_artifacts", no_commit)
+    model = ModelConfig(orchestrator_model="claude-3-haiku-20240307", refiner_model="claude-3-haiku-20240307",
+                        subagent_model="claude-3-haiku-20240307", task_iter=1, refine_iter=1,
+                        strategy="IterativeRefinement")
+    agent = AgentConfig(name="wrap", objective="objective", model=model)
+    console = Console(file=open("/dev/null", "w"))
+
+    async def refine(name):
+        return await orchestrator.refine_file(agent, name, "", "{}", {}, "", console)
+
+    replies[:] = ["<file name='app.py'>print(1)</file>", "<file name=/app.py>print(1)</file>", "print(1)"]
+    for expected in ("<file name='app.py'>", "<file name=/app.py>", '<file name="app.py">'):
+        output = asyncio.run(refine("app.py"))
+        assert output.count("<file ") == 1
+        assert expected in output
+
+
+def test_streamed_tokens_and_usage(monkeypatch, tmp_path):
+    import json
+    import orchestrator
+    from anthropic import AsyncAnthropic
+    from bench.mock_providers import MockServer, Behaviour
+    from events import RunEvents, run_events
+    from llmcache import LLMCache
+    from rich.console import Console
+
+    monkeypatch.setattr(orchestrator, "llm_cache", LLMCache(path=str(tmp_path / "cache.sqlite"), mode="off"))
+    path = str(tmp_path / "events.jsonl")
+
+    with MockServer() as server:
+        server.state.behaviour["anthropic"] = Behaviour(output_tokens=60, chunk_tokens=4, tokens_per_second=2000)
+        monkeypatch.setitem(orchestrator.providers.clients, "anthropic",
+                            AsyncAnthropic(api_key="x", base_url=server.url, max_retries=0))
+
+        async def run():
+            events = RunEvents(path)
+            run_events.set(events)
+            try:
+                return await orchestrator.query_model("claude-3-haiku-20240307", "the question", 1000,
+                                                      Console(file=open("/dev/null", "w")), phase="subtask")
+            finally:
+                events.close()
+
+        response = asyncio.run(run())
+        stats = server.state.stats["anthropic"]
+
+    with open(path) as fid:
+        events = [json.loads(line) for line in fid]
+    names = [event["event"] for event in events]
+    tokens = [event for event in events if event["event"] == "token"]
+
+    # one call_start, the chunks in the order they were streamed, one call_end
+    assert names == ["call_start"] + ["token"] * len(tokens) + ["call_end"]
+    assert len(tokens) == 15
+    assert "".join(event["text"] for event in tokens) == response.text
+    assert {event["call"] for event in events} == {events[0]["call"]}
+    assert all(event["phase"] == "subtask" for event in tokens)
+
+    # usage is taken from the final message, not the 1 token of message_start
+    end = events[-1]
+    assert (response.input_tokens, response.output_tokens) == (stats["input_tokens"], stats["output_tokens"])
+    assert (end["input_tokens"], end["output_tokens"]) == (response.input_tokens, 60)
+    assert end["ttft"] <= end["latency"]
+
+
+def test_resume_skips_checkpointed_steps(monkeypatch):
+    import orchestrator
+    from rich.console import Console
+
+    calls = []
+    crashes = ["task 1.1"]
+
+    async def fake_query_orchestrator(agent, idx_ref, era_output, console):
+        return f"task {idx_ref}.{len(agent.subtask_results[idx_ref])}", None
+
+    async def fake_generate_subtask_prompt(agent, orch_response, *args, **kwargs):
+        return orch_response
+
+    async def fake_run_subtask_agent(agent, subtask_query, console):
+        if subtask_query in crashes:
+            crashes.remove(subtask_query)
+            raise RuntimeError("worker died")
+        calls.append(subtask_query)
+        return f"result of {subtask_query}"
+
+    async def fake_refine_output(agent, idx_ref, era_output, console):
+        calls.append(f"refine {idx_ref}")
+        return f"era {idx_ref}"
+
+    monkeypatch.setattr(orchestrator, "query_orchestrator", fake_query_orchestrator)
+    monkeypatch.setattr(orchestrator, "generate_subtask_prompt", fake_generate_subtask_prompt)
+    monkeypatch.setattr(orchestrator, "run_subtask_agent", fake_run_subtask_agent)
+    monkeypatch.setattr(orchestrator, "refine_output", fake_refine_output)
+    monkeypatch.setattr(orchestrator, "extract_output", lambda output, agent, console: output)
+
+    class FakeCheckpoint:
+
+        def __init__(self):
+            self.steps = []
+            self.results = {}
+
+        async def load(self, agent):
+            agent.subtask_results = {}
+            agent.era_results = []
+            for (era, task), result in sorted(self.results.items()):
+                if task < 0:
+                    agent.era_results.append(result)
+                else:
+                    agent.subtask_results.setdefault(era, []).append(result)
+
+        async def start(self, agent, fresh, console=None):
+            self.steps.append(("start", fresh))
+
+        async def subtask(self, agent, era, task, console=None):
+            self.results[(era, task)] = agent.subtask_results[era][task]
+            self.steps.append(("subtask", era, task))
+
+        async def era(self, agent, era, console=None):
+            self.results[(era, -1)] = agent.era_results[era]
+            self.steps.append(("era", era))
+
+        async def complete(self, agent, console=None):
+            self.steps.append(("complete",))
+
+    checkpoint = FakeCheckpoint()
+
+    model = ModelConfig(orchestrator_model="claude-3-haiku-20240307", refiner_model="claude-3-haiku-20240307",
+                        subagent_model="claude-3-haiku-20240307", task_iter=2, refine_iter=2,
+                        strategy="Strategy 1", context_compaction=False)
+    agent = AgentConfig(name="resume", objective="objective", model=model)
+    console = Console(file=open("/dev/null", "w"))
+
+    try:
+        asyncio.run(orchestrator.run_orchestrator_loop_async(agent, console, checkpoint=checkpoint))
+    except RuntimeError:
+        pass
+    assert calls == ["task 0.0", "task 0.1", "refine 0", "task 1.0"]
+    assert checkpoint.steps == [("start", True), ("subtask", 0, 0), ("subtask", 0, 1), ("era", 0),
+                                ("subtask", 1, 0)]
+
+    # start again from the last checkpoint, only the missing steps run
+    calls.clear()
+    checkpoint.steps.clear()
+    resumed = AgentConfig(_id=agent.id, name="resume", objective="objective", model=model,
+                          run_state="running")
+    output = asyncio.run(orchestrator.run_orchestrator_loop_async(resumed, console, checkpoint=checkpoint))
+
+    assert calls == ["task 1.1", "refine 1"]
+    assert output == "era 1"
+    assert resumed.subtask_results[1] == ["result of task 1.0", "result of task 1.1"]
+    assert checkpoint.steps == [("start", False), ("subtask", 1, 1), ("era", 1), ("complete",)]
+
+
+def test_planned_era_runs_the_graph_and_resumes(monkeypatch):
+    import orchestrator
+    from rich.console import Console
+    from planner import parse_plan
+
+    plans = []
+    prompts = {}
+    crashes = ["tests"]
+
+    async def fake_query_planner(agent, idx_ref, era_output, console):
+        plans.append(idx_ref)
+        if idx_ref == 1:
+            return "Objective Complete: done", []
+        return "plan", parse_plan('[{"id": "docs", "prompt": "docs", "depends_on": ["backend"]},'
+                                  ' {"id": "backend", "prompt": "backend"},'
+                                  ' {"id": "css", "prompt": "css"},'
+                                  ' {"id": "tests", "prompt": "tests", "depends_on": ["backend"]}]', 5)
+
+    async def fake_run_subtask_agent(agent, subtask_query, console):
+        name = subtask_query.split("\n")[0]
+        await asyncio.sleep({"backend": 0.03, "css": 0.0, "tests": 0.02}.get(name, 0.01))
+        if name in crashes:
+            crashes.remove(name)
+            raise RuntimeError("worker died")
+        prompts[name] = subtask_query
+        return f"result of {name}"
+
+    async def fake_refine_output(agent, idx_ref, era_output, console):
+        return f"era {idx_ref}"
+
+    class FakeCheckpoint:
+
+        def __init__(self):
+            self.steps = []
+
+        async def load(self, agent):
+            pass
+
+        async def start(self, agent, fresh, console=None):
+            pass
+
+        async def plan(self, agent, era, console=None):
+            self.steps.append(("plan", era))
+
+        async def subtask(self, agent, era, task, console=None):
+            self.steps.append(("subtask", era, task))
+
+        async def era(self, agent, era, console=None):
+            self.steps.append(("era", era))
+
+        async def complete(self, agent, console=None):
+            self.steps.append(("complete",))
+
+    monkeypatch.setattr(orchestrator, "query_planner", fake_query_planner)
+    monkeypatch.setattr(orchestrator, "run_subtask_agent", fake_run_subtask_agent)
+    monkeypatch.setattr(orchestrator, "refine_output", fake_refine_output)
+    monkeypatch.setattr(orchestrator, "extract_output", lambda output, agent, console: output)
+
+    checkpoint = FakeCheckpoint()
+    model = ModelConfig(orchestrator_model="claude-3-haiku-20240307", refiner_model="claude-3-haiku-20240307",
+                        subagent_model="claude-3-haiku-20240307", task_iter=5, refine_iter=3,
+                        strategy="Strategy 1", context_compaction=False, task_planning=True,
+                        subtask_concurrency=3)
+    agent = AgentConfig(name="planned", objective="objective", model=model)
+    console = Console(file=open("/dev/null", "w"))
+
+    try:
+        asyncio.run(orchestrator.run_orchestrator_loop_async(agent, console, checkpoint=checkpoint))
+    except RuntimeError:
+        pass
+    # css finished first but the results are only merged in plan order
+    assert agent.subtask_results[0] == ["result of backend", "result of css", "result of docs"]
+    assert checkpoint.steps == [("plan", 0), ("subtask", 0, 0), ("subtask", 0, 1), ("subtask", 0, 2)]
+
+    # the resumed era runs the rest of the saved plan without asking again
+    checkpoint.steps.clear()
+    agent.run_state = "running"
+    output = asyncio.run(orchestrator.run_orchestrator_loop_async(agent, console, checkpoint=checkpoint))
+
+    assert output == "era 1"
+    assert plans == [0, 1]
+    assert agent.subtask_results[0][3] == "result of tests"
+    assert "result of backend" in prompts["tests"] and "result of css" not in prompts["tests"]
+    assert checkpoint.steps == [("subtask", 0, 3), ("era", 0), ("complete",)]
@@ -0,0 +1,86 @@
+#---------------------------------------------------------------------------------
+# File : test_planner.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Tests for the subtask dependency graph
+# Purp : Make sure plans parse into a valid order, independent subtasks run
+#        concurrently within the bound and results merge in plan order.
+#---------------------------------------------------------------------------------
+
+import asyncio
+
+import pytest
+
+from planner import parse_plan, plan_depth, run_plan, PlanError
+
+
+def test_plan_is_ordered_after_dependencies():
+    text = '''Here is the plan
+<plan>[{"id": "docs", "prompt": "write docs", "depends_on": ["backend", "nope"]},
+       {"id": "backend", "prompt": "write backend"},
+       {"id": "css", "prompt": "write css", "depends_on": "css"},
+       {"id": "backend", "prompt": "again"},
+       {"id": "tests", "prompt": "write tests", "depends_on": ["backend", "docs"]}]</plan>'''
+
+    tasks = parse_plan(text, max_tasks=10)
+
+    assert [task.id for task in tasks] == ["backend", "css", "docs", "tests"]
+    assert tasks[0].prompt == "write backend"
+    assert [task.depends_on for task in tasks] == [[], [], ["backend"], ["backend", "docs"]]
+    assert plan_depth(tasks) == 3
+    assert len(parse_plan(text, max_tasks=2)) == 2
+
+
+def test_cycles_are_broken_and_bad_plans_raise():
+    tasks = parse_plan('[{"id": "a", "prompt": "a", "depends_on": ["b"]},'
+                       ' {"id": "b", "prompt": "b", "depends_on": ["a"]}]', max_tasks=5)
+    assert [(task.id, task.depends_on) for task in tasks] == [("a", []), ("b", ["a"])]
+
+    with pytest.raises(PlanError):
+        parse_plan("<plan>not json</plan>", max_tasks=5)
+    with pytest.raises(PlanError):
+        parse_plan('<plan>[{"id": "a"}]</plan>', max_tasks=5)
+
+
+def test_ready_subtasks_run_concurrently_and_merge_in_plan_order():
+    tasks = parse_plan('[{"id": "slow", "prompt": "slow"}, {"id": "fast", "prompt": "fast"},'
+                       ' {"id": "mid", "prompt": "mid"},'
+                       ' {"id": "join", "prompt": "join", "depends_on": ["slow", "fast"]}]', max_tasks=5)
+    delays = {"slow": 0.05, "fast": 0.0, "mid": 0.02, "join": 0.0}
+    running, peak, finished, merged = [0], [0], [], []
+
+    async def run_task(idx, task, dependencies):
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        await asyncio.sleep(delays[task.id])
+        running[0] -= 1
+        finished.append(task.id)
+        return f"{task.id}({','.join(dependencies.values())})"
+
+    async def on_result(idx, task, result):
+        merged.append((idx, result))
+
+    results = asyncio.run(run_plan(tasks, run_task, on_result, concurrency=2))
+
+    assert peak[0] == 2
+    assert finished[0] == "fast"
+    assert results == ["slow()", "fast()", "mid()", "join(slow(),fast())"]
+    assert merged == list(enumerate(results))
+
+
+def test_resumed_plan_runs_only_the_rest():
+    tasks = parse_plan('[{"id": "a", "prompt": "a"}, {"id": "b", "prompt": "b", "depends_on": ["a"]}]',
+                       max_tasks=5)
+    ran = []
+
+    async def run_task(idx, task, dependencies):
+        ran.append(task.id)
+        return f"{task.id} after {dependencies}"
+
+    async def on_result(idx, task, result):
+        pass
+
+    results = asyncio.run(run_plan(tasks, run_task, on_result, done=["saved a"]))
+
+    assert ran == ["b"]
+    assert results == ["saved a", "b after {'a': 'saved a'}"]
@@ -0,0 +1,90 @@
+#---------------------------------------------------------------------------------
+# File : test_ratelimit.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Tests for the provider rate limit scheduler
+# Purp : Make sure concurrent runs share the budget and back off together,
+#        also when they run in several worker processes.
+#---------------------------------------------------------------------------------
+
+import time
+import asyncio
+import multiprocessing
+
+from ratelimit import RateLimiter, TokenBucket, parse_wait
+
+
+def test_bucket_waits_when_empty():
+    bucket = TokenBucket(60)
+    bucket.take(60)
+
+    assert bucket.wait_for(1) > 0.9
+    assert TokenBucket(0).wait_for(10 ** 9) == 0
+
+
+def test_headers_sync_remaining_quota():
+    limiter = RateLimiter({"anthropic": (50, 40000)})
+    headers = {"anthropic-ratelimit-tokens-limit": "80000",
+               "anthropic-ratelimit-tokens-remaining": "100"}
+
+    limiter.observe("anthropic", "claude", headers)
+    limit = limiter.get("anthropic", "claude")
+
+    assert limit.tokens.limit == 80000
+    assert limit.tokens.level < 200
+
+
+def test_backoff_blocks_every_caller():
+    limiter = RateLimiter({"anthropic": (0, 0)})
+
+    wait = limiter.backoff("anthropic", "claude", 0, {"retry-after": "0.2"})
+
+    async def acquire_all():
+        start = time.monotonic()
+        await asyncio.gather(*[limiter.acquire("anthropic", "claude") for _ in range(3)])
+        return time.monotonic() - start
+
+    assert 0.2 <= wait <= 1.2
+    assert asyncio.run(acquire_all()) >= 0.2
+
+
+def test_parse_wait_formats():
+    assert parse_wait("3") == 3.0
+    assert parse_wait("1970-01-01T00:00:00Z") == 0.0
+    assert parse_wait(None) is None
+
+
+def acquire_until(shares: int, rpm: int, deadline: float, results: multiprocessing.Queue):
+    # one pool worker, every worker process has its own limiter
+    limiter = RateLimiter({"anthropic": (rpm, 0)})
+    limiter.share(shares)
+
+    async def acquire():
+        count = 0
+        while True:
+            await limiter.acquire("anthropic", "claude")
+            if time.time() > deadline:
+                return count
+            count += 1
+
+    results.put(asyncio.run(acquire()))
+
+
+def test_worker_pool_shares_one_quota():
+    rpm, workers = 120, 2
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    # the workers start acquiring as soon as they are up and stop at the deadline
+    begin = time.time()
+    deadline = begin + 3.0
+    processes = [context.Process(target=acquire_until, args=(workers, rpm, deadline, results))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    counts = [results.get(timeout=30) for _ in processes]
+    for process in processes:
+        process.join(10)
+
+    # the whole pool stays within one bucket, full at the start then rpm/60 per second
+    assert sum(counts) <= rpm + rpm / 60 * (deadline - begin)
+    assert all(count >= rpm / workers for count in counts)
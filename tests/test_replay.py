@@ -0,0 +1,95 @@
+#---------------------------------------------------------------------------------
+# File : test_replay.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Runs the orchestrator loop from recorded model responses
+# Purp : Make sure a whole run works offline from tests/recordings, with no
+#        provider keys or network. Record the fixture again with
+#        python -m tests.test_replay after a prompt changes.
+#---------------------------------------------------------------------------------
+
+import os
+import shutil
+import asyncio
+import zipfile
+import tempfile
+
+RECORDING = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recordings", "llm_cache.sqlite")
+
+
+def replay_agent():
+    from orchestrator import ModelConfig, AgentConfig
+    model = ModelConfig(orchestrator_model="claude-3-haiku-20240307", refiner_model="claude-3-haiku-20240307",
+                        subagent_model="claude-3-haiku-20240307", task_iter=1, refine_iter=1,
+                        strategy="Strategy 1", refine_concurrency=1)
+    return AgentConfig(name="replay", objective="Build a small command line tool.", model=model)
+
+
+def test_loop_replays_the_recorded_run(tmp_path, monkeypatch):
+    import orchestrator
+    from agents import providers
+    from llmcache import LLMCache
+    from rich.console import Console
+
+    def no_provider(name):
+        raise AssertionError(f"replay called the {name} provider")
+
+    # a hit updates the entry, the checked in fixture stays as recorded
+    shutil.copy(RECORDING, tmp_path / "llm_cache.sqlite")
+    cache = LLMCache(path=str(tmp_path / "llm_cache.sqlite"), mode="replay")
+    monkeypatch.setattr(orchestrator, "llm_cache", cache)
+    monkeypatch.setattr(providers, "client", no_provider)
+    monkeypatch.setattr(orchestrator, "OUTPUT_DIR", str(tmp_path / "output"))
+    monkeypatch.setenv("HOSTNAME", "localhost")
+    monkeypatch.setenv("APP_PORT", "3434")
+    monkeypatch.chdir(tmp_path)
+    for folder in ("output", "final"):
+        os.makedirs(tmp_path / folder)
+
+    agent = replay_agent()
+    try:
+        console = Console(record=True, file=open("/dev/null", "w"))
+        zip_path = asyncio.run(orchestrator.run_orchestrator_loop_async(agent, console))
+    finally:
+        cache.close()
+
+    assert cache.misses == 0 and cache.hits > 0
+    assert agent.subtask_results[0] and agent.era_results
+    with zipfile.ZipFile(zip_path) as zip_file:
+        assert "final_output.txt" in zip_file.namelist()
+
+
+def record():
+    '''
+    Run the loop against the provider stand-ins in bench/ and record every
+    response to the fixture
+    '''
+    from bench.mock_providers import MockServer, environ
+
+    with MockServer() as server, tempfile.TemporaryDirectory() as workdir:
+        # the run commits its files under the working directory
+        os.chdir(workdir)
+        os.environ.update(environ(server.url))
+        for key in ("ANTHROPIC_RPM", "ANTHROPIC_TPM", "TAVILY_RPM"):
+            os.environ[key] = "0"
+        for key in ("OPENAI_API_KEY", "ANTHROPIC_API_KEY", "TAVILY_API_KEY", "GOOGLE_API_KEY",
+                    "IGPT_KEY", "IGPT_SECRET", "MONGO_CONN", "MONGO_PORT", "MONGO_DBNAME"):
+            os.environ.setdefault(key, "1")
+        # the orchestrator reads the environment when it is imported
+        import orchestrator
+        from llmcache import LLMCache
+        from rich.console import Console
+
+        os.makedirs(os.path.dirname(RECORDING), exist_ok=True)
+        if os.path.exists(RECORDING):
+            os.remove(RECORDING)
+        orchestrator.llm_cache = LLMCache(path=RECORDING, mode="record")
+        orchestrator.extract_output = lambda output, agent, console: output
+
+        asyncio.run(orchestrator.run_orchestrator_loop_async(replay_agent(), Console(file=open(os.devnull, "w"))))
+        orchestrator.llm_cache.close()
+        print(f"Recorded {RECORDING}")
+
+
+if __name__ == "__main__":
+    record()
@@ -0,0 +1,56 @@
+#---------------------------------------------------------------------------------
+# File : test_searchcache.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Tests for the search result cache
+# Purp : Check normalisation, ttl and coalescing of concurrent searches.
+#---------------------------------------------------------------------------------
+
+import asyncio
+
+import pytest
+
+from searchcache import SearchCache
+
+
+def test_concurrent_searches_are_coalesced():
+    cache = SearchCache(ttl=60)
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def search_all():
+        keys = [cache.normalize(q) for q in ("What is FastAPI?", " what is  fastapi", "WHAT IS FASTAPI")]
+        return await asyncio.gather(*[cache.get_or_fetch(key, fetch, lookups.append) for key in keys])
+
+    lookups = []
+    assert asyncio.run(search_all()) == ["result"] * 3
+    assert asyncio.run(cache.get_or_fetch("what is fastapi", fetch, lookups.append)) == "result"
+    assert len(calls) == 1
+    assert lookups == ["miss", "coalesced", "coalesced", "hit"]
+    assert cache.stats() == {"hits": 1, "misses": 1, "coalesced": 2, "entries": 1}
+
+
+def test_failed_searches_are_not_cached():
+    cache = SearchCache(ttl=60)
+
+    async def fail():
+        raise ValueError("down")
+
+    with pytest.raises(ValueError):
+        asyncio.run(cache.get_or_fetch("q", fail))
+    assert cache.stats()["entries"] == 0
+
+
+def test_expired_entries_are_refetched():
+    cache = SearchCache(ttl=0)
+
+    async def fetch():
+        return "result"
+
+    asyncio.run(cache.get_or_fetch("q", fetch))
+    asyncio.run(cache.get_or_fetch("q", fetch))
+    assert cache.misses == 2
@@ -48,4 +48,63 @@ def test_run():
     assert "refiner_model" in response.json()
     assert "subagent_model" in response.json()
     assert "goal" in response.json()
-    assert "orchestration_strategy" in response.json()
\ No newline at end of file
+    assert "orchestration_strategy" in response.json()
+
+def test_download_range_and_conditional(monkeypatch, tmp_path):
+    import server
+    monkeypatch.setattr(server, "OUTPUT_DIR", str(tmp_path))
+    data = bytes(range(256)) * 4096
+    (tmp_path / "abc_final.zip").write_bytes(data)
+
+    response = client.get("/download_project/abc/")
+    assert response.status_code == 200
+    assert response.content == data
+    etag = response.headers["etag"]
+
+    response = client.get("/download_project/abc/", headers={"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.content == data[100:200]
+    assert response.headers["content-range"] == f"bytes 100-199/{len(data)}"
+
+    response = client.get("/download_project/abc/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    response = client.get("/download_project/nope/")
+    assert response.status_code == 404
+    assert "/download_project/nope/partial/" in response.json()["detail"]
+
+def test_download_partial_mid_run(monkeypatch, tmp_path):
+    import io
+    import zipfile
+    import server
+    from artifacts import ArtifactStore
+    monkeypatch.setattr(server, "OUTPUT_DIR", str(tmp_path))
+    monkeypatch.setattr(server, "ArtifactStore", lambda id: ArtifactStore(id, root=str(tmp_path / "artifacts")))
+
+    assert client.get("/download_project/run3/partial/").status_code == 404
+
+    ArtifactStore("run3", root=str(tmp_path / "artifacts")).put("app/main.py", "print(1)")
+    response = client.get("/download_project/run3/partial/")
+    assert response.status_code == 200
+    assert zipfile.ZipFile(io.BytesIO(response.content)).namelist() == ["app/main.py"]
+
+def test_metrics_endpoint():
+    from metrics import metrics
+    metrics.observe("run4", {"event": "done", "status": "complete"})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert "agent_runs_total{status=\"complete\"}" in response.text
+
+
+def test_trace_and_timeline(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    assert client.get("/trace/run5/").status_code == 404
+
+    (tmp_path / "logs").mkdir()
+    (tmp_path / "logs" / "run_orch_loop_run5.trace.json").write_text('{"traceEvents": []}')
+    response = client.get("/trace/run5/")
+    assert response.status_code == 200
+    assert response.json() == {"traceEvents": []}
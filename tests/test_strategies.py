@@ -0,0 +1,102 @@
+#---------------------------------------------------------------------------------
+# File : test_strategies.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Tests for the orchestration strategy engines
+# Purp : Make sure ModelConfig.strategy picks the engine, and that each engine
+#        keeps to its own iteration and concurrency policy.
+#---------------------------------------------------------------------------------
+
+import asyncio
+
+import pytest
+from rich.console import Console
+
+import orchestrator
+from orchestrator import ModelConfig, AgentConfig
+from planner import parse_plan
+from strategies import get_strategy, similarity
+
+
+def test_similarity_and_lookup():
+    text = "def main():\n    print('hello world')\n    return 0\n"
+    assert similarity(text, text) == 1.0
+    assert 0 < similarity(text, text + "extra words at the end") < 1
+    assert similarity(text, "something else entirely") == 0.0
+
+    assert get_strategy("MapReduce").name == "MapReduce"
+    # agents saved before the engines existed run the default loop
+    assert get_strategy("Strategy 1").name == "IterativeRefinement"
+
+
+@pytest.fixture
+def fake_models(monkeypatch):
+    calls = []
+    running, peak = [0], [0]
+
+    async def fake_query_orchestrator(agent, idx_ref, era_output, console):
+        return f"task {idx_ref}.{len(agent.subtask_results[idx_ref])}", None
+
+    async def fake_query_planner(agent, idx_ref, era_output, console):
+        calls.append(f"plan {idx_ref}")
+        return "plan", parse_plan('[{"id": "a", "prompt": "a"}, {"id": "b", "prompt": "b", "depends_on": ["a"]},'
+                                  ' {"id": "c", "prompt": "c", "depends_on": ["b"]}]', 5)
+
+    async def fake_generate_subtask_prompt(agent, orch_response, *args, **kwargs):
+        return orch_response
+
+    async def fake_run_subtask_agent(agent, subtask_query, console):
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        await asyncio.sleep(0.01)
+        running[0] -= 1
+        calls.append(subtask_query)
+        return f"result of {subtask_query}"
+
+    async def fake_refine_output(agent, idx_ref, era_output, console):
+        calls.append(f"refine {idx_ref}")
+        # the output stops changing after the second refine
+        return "the refined project output " * 20 + ("first draft" if idx_ref == 0 else "")
+
+    monkeypatch.setattr(orchestrator, "query_orchestrator", fake_query_orchestrator)
+    monkeypatch.setattr(orchestrator, "query_planner", fake_query_planner)
+    monkeypatch.setattr(orchestrator, "generate_subtask_prompt", fake_generate_subtask_prompt)
+    monkeypatch.setattr(orchestrator, "run_subtask_agent", fake_run_subtask_agent)
+    monkeypatch.setattr(orchestrator, "refine_output", fake_refine_output)
+    monkeypatch.setattr(orchestrator, "extract_output", lambda output, agent, console: output)
+
+    def run(strategy: str):
+        calls.clear()
+        peak[0] = 0
+        model = ModelConfig(orchestrator_model="claude-3-haiku-20240307", refiner_model="claude-3-haiku-20240307",
+                            subagent_model="claude-3-haiku-20240307", task_iter=2, refine_iter=5,
+                            strategy=strategy, context_compaction=False, convergence_threshold=0.9)
+        agent = AgentConfig(name=strategy, objective="objective", model=model)
+        asyncio.run(orchestrator.run_orchestrator_loop_async(agent, Console(file=open("/dev/null", "w"))))
+        return calls, peak[0], agent
+
+    return run
+
+
+def test_fixed_point_stops_when_the_output_converges(fake_models):
+    calls, peak, agent = fake_models("FixedPointIteration")
+
+    assert [call for call in calls if call.startswith("refine")] == ["refine 0", "refine 1", "refine 2"]
+    assert len(agent.era_results) == 3
+    assert peak == 1
+
+    calls, _, agent = fake_models("IterativeRefinement")
+    assert len(agent.era_results) == 5
+
+
+def test_single_pass_engines_plan_once(fake_models):
+    calls, peak, agent = fake_models("PlanThenExecute")
+    assert calls == ["plan 0", "a", "b", "c", "refine 0"]
+    assert peak == 1
+
+    calls, peak, agent = fake_models("MapReduce")
+    assert calls[0] == "plan 0" and calls[-1] == "refine 0"
+    assert sorted(calls[1:4]) == ["a", "b", "c"]
+    assert peak == 3
+    assert agent.subtask_results[0] == ["result of a", "result of b", "result of c"]
+    assert all(task["depends_on"] == [] for task in agent.subtask_plans[0])
@@ -0,0 +1,65 @@
+#---------------------------------------------------------------------------------
+# File : test_tagparser.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Tests for the refiner output tag parser
+# Purp : Make sure tags are found however the output is chunked or quoted.
+#---------------------------------------------------------------------------------
+
+import io
+import time
+
+from tagparser import TagParser, parse_output
+
+
+output = '''<project_name>demo</project_name>
+<folder_structure>{"app": {"main.py": null}, "README.md": null}</folder_structure>
+<file name="/app/main.py">print("<b>ü</b>")</file>
+<file name='/README.md' >
+# Demo
+</file >
+<file name=\\"/app/main.py\\">a repeat is ignored</file>
+<file name=`notes.txt`>truncated'''
+
+
+def test_parse_any_chunking():
+    whole = parse_output(output)
+    chunked = parse_output([output[i:i + 3] for i in range(0, len(output), 3)])
+
+    for parsed in (whole, chunked):
+        assert parsed.project_name.text == "demo"
+        assert parsed.folder_structure.text.startswith('{"app"')
+        assert parsed.file("/app/main.py").text == 'print("<b>ü</b>")'
+        assert parsed.file("README.md").text == "\n# Demo\n"
+        assert parsed.file("/notes.txt").text == "truncated"
+        assert not parsed.file("notes.txt").complete
+        assert parsed.file("/missing.py") is None
+
+    fp = io.BytesIO()
+    whole.file("/app/main.py").write(fp)
+    assert fp.getvalue().decode() == 'print("<b>ü</b>")'
+
+
+def test_feed_returns_completed_tags():
+    parser = TagParser()
+
+    assert parser.feed("<file name=\"a.py\">x = 1</fi") == []
+    tags = parser.feed("le><file name=\"b.py\">")
+    assert [(tag.name, tag.text) for tag in tags] == [("a.py", "x = 1")]
+    assert [tag.name for tag in parser.close()] == ["b.py"]
+
+
+def test_parse_is_linear():
+    def build(count):
+        return "".join(f'<file name="/f{i}.py">{"x" * 2000}</file>\n' for i in range(count))
+
+    def timed(text):
+        start = time.perf_counter()
+        parsed = parse_output(text[i:i + 16] for i in range(0, len(text), 16))
+        return time.perf_counter() - start, parsed
+
+    small, _ = timed(build(200))
+    large, parsed = timed(build(2000))
+
+    assert len(parsed.files) == 2000
+    assert large < small * 30
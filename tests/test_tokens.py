@@ -0,0 +1,94 @@
+#---------------------------------------------------------------------------------
+# File : test_tokens.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Tests for token accounting and budgets
+# Purp : Prompts fit the window, usage reads the same for every provider and
+#        runs stop on their budget.
+#---------------------------------------------------------------------------------
+
+from types import SimpleNamespace
+
+import pytest
+
+from tokens import count_tokens, context_window, fit_sections, fit_prompt, tail_tokens
+from tokens import normalize_usage, cache_usage, TokenBudget, BudgetExceededError
+
+
+def test_fit_sections_trims_lowest_priority_first():
+    sections = [("keep this objective. ", None),
+                ("results " * 400, 2),
+                ("files " * 400, 1)]
+
+    prompt = fit_sections(sections, 500)
+
+    assert count_tokens(prompt) <= 500
+    assert prompt.startswith("keep this objective. ")
+    assert prompt.count("results") > prompt.count("files")
+
+
+def test_fit_prompt_reduces_output_then_trims():
+    prompt = "word " * 40000
+
+    fitted, max_tokens = fit_prompt(prompt, "gemini-1.0-pro", 4096)
+
+    assert context_window("gemini-1.0-pro") == 30720
+    assert context_window("claude-3-opus-20240229") == 200000
+    assert max_tokens == 256
+    assert count_tokens(fitted) + max_tokens <= 30720
+    assert fit_prompt("short", "claude-3-haiku-20240307", 4096) == ("short", 4096)
+
+
+def test_usage_is_normalized():
+    assert normalize_usage("anthropic", SimpleNamespace(input_tokens=10, output_tokens=5)) == (10, 5)
+    assert normalize_usage("gemini", SimpleNamespace(prompt_token_count=7, candidates_token_count=3)) == (7, 3)
+    assert normalize_usage("igpt", {"promptTokens": 4, "completionTokens": 2}) == (4, 2)
+    assert normalize_usage("gemini", None) == (0, 0)
+
+
+def test_budget_caps_output_and_stops():
+    budget = TokenBudget(limit=5000)
+
+    assert budget.reserve(1000, 4096) == 4000
+    budget.charge(1000, 3500, held=5000)
+    with pytest.raises(BudgetExceededError):
+        budget.reserve(400, 4096)
+    assert budget.summary()["used"] == 4500
+    assert budget.held == 0
+    assert TokenBudget().reserve(10 ** 6, 4096) == 4096
+
+
+def test_concurrent_calls_share_the_budget():
+    budget = TokenBudget(limit=10000)
+
+    # the second call only gets what the first one doesn't hold
+    assert budget.reserve(1000, 4096) == 4096
+    assert budget.reserve(1000, 4096) == 3904
+    with pytest.raises(BudgetExceededError):
+        budget.reserve(1000, 4096)
+
+    # a failed call gives its hold back, a finished one is settled to its usage
+    budget.release(1000 + 3904)
+    budget.charge(1000, 500, held=1000 + 4096)
+    assert (budget.used, budget.held) == (1500, 0)
+    assert budget.reserve(1000, 4096) == 4096
+
+
+def test_tail_starts_on_a_line():
+    text = "".join(f"line {i}\n" for i in range(1000))
+
+    tail = tail_tokens(text, 50)
+
+    assert text.endswith(tail)
+    assert tail.startswith("line ")
+    assert count_tokens(tail) <= 50
+    assert tail_tokens("short", 50) == "short"
+
+
+def test_cache_usage():
+    usage = SimpleNamespace(input_tokens=10, output_tokens=5,
+                            cache_read_input_tokens=900, cache_creation_input_tokens=100)
+
+    assert cache_usage("anthropic", usage) == (900, 100)
+    assert cache_usage("gemini", SimpleNamespace(cached_content_token_count=64)) == (64, 0)
+    assert cache_usage("igpt", {"promptTokens": 4}) == (0, 0)
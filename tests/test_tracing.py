@@ -0,0 +1,72 @@
+#---------------------------------------------------------------------------------
+# File : test_tracing.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Tests for the run tracing
+# Purp : Make sure spans nest, concurrent tasks get their own lanes and the
+#        export is a valid Chrome trace.
+#---------------------------------------------------------------------------------
+
+import json
+import asyncio
+
+from tracing import Tracer, run_tracer, span, traced, annotate
+
+
+def test_spans_nest_and_concurrent_tasks_get_lanes(tmp_path):
+    tracer = Tracer(str(tmp_path / "trace.json"))
+
+    @traced("refine_file")
+    async def refine_file(name):
+        annotate(file=name)
+        await asyncio.sleep(0.01)
+
+    async def run():
+        run_tracer.set(tracer)
+        with span("run"):
+            with span("era", era=0):
+                await asyncio.gather(refine_file("a.py"), refine_file("b.py"))
+        tracer.save()
+
+    asyncio.run(run())
+    events = json.load(open(tmp_path / "trace.json"))["traceEvents"]
+    by_name = {}
+    for event in events:
+        by_name.setdefault(event["name"], []).append(event)
+
+    run_span, era_span = by_name["run"][0], by_name["era"][0]
+    files = by_name["refine_file"]
+    assert all(event["ph"] == "X" for event in events)
+    assert era_span["args"]["parent_id"] == run_span["args"]["span_id"]
+    assert era_span["tid"] == run_span["tid"]
+    assert {event["args"]["file"] for event in files} == {"a.py", "b.py"}
+    assert all(event["args"]["parent_id"] == era_span["args"]["span_id"] for event in files)
+    # the files overlap in time, so each gets a lane of its own
+    assert len({event["tid"] for event in files} | {run_span["tid"]}) == 3
+    assert era_span["ts"] <= min(event["ts"] for event in files)
+    assert era_span["ts"] + era_span["dur"] >= max(event["ts"] + event["dur"] for event in files)
+
+
+def test_open_and_failed_spans_are_exported():
+    tracer = Tracer()
+
+    async def run():
+        run_tracer.set(tracer)
+        with span("run"):
+            try:
+                with span("subagent"):
+                    raise RuntimeError("boom")
+            except RuntimeError:
+                pass
+            return tracer.export()
+
+    events = {event["name"]: event for event in asyncio.run(run())["traceEvents"]}
+    assert events["run"]["args"]["open"] is True
+    assert "open" not in events["subagent"]["args"]
+    assert "boom" in events["subagent"]["args"]["error"]
+
+
+def test_spans_are_free_outside_a_traced_run():
+    with span("run") as opened:
+        annotate(ignored=True)
+    assert opened is None
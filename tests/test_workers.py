@@ -0,0 +1,85 @@
+#---------------------------------------------------------------------------------
+# File : test_workers.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Tests for the orchestrator run queue
+# Purp : Check priority order, queue limits and cancelling queued runs.
+#---------------------------------------------------------------------------------
+
+import asyncio
+
+import pytest
+
+import workers
+from events import EventBroker
+from workers import WorkerPool, QueueFullError
+
+
+@pytest.fixture
+def started(monkeypatch):
+    '''
+    Runs finish when their event is set instead of running an agent
+    '''
+    order = []
+    gates = {}
+
+    async def fake_run_job(run_id, agent_data, broker):
+        order.append(run_id)
+        await gates.setdefault(run_id, asyncio.Event()).wait()
+        broker.publish(run_id, {"event": "done", "status": "complete"})
+        return "complete"
+
+    monkeypatch.setattr(workers, "run_job", fake_run_job)
+    return order, gates
+
+
+def test_higher_priority_runs_first(started):
+    order, gates = started
+
+    async def run():
+        pool = WorkerPool(size=0, concurrency=1, broker=EventBroker())
+        pool.start()
+        pool.submit("first", {})
+        pool.submit("low", {}, priority=0)
+        pool.submit("high", {}, priority=5)
+        await asyncio.sleep(0)
+        assert pool.job_status("low")["position"] == 1
+        for run_id in ("first", "high", "low"):
+            while run_id not in order:
+                await asyncio.sleep(0)
+            gates[run_id].set()
+        while pool.local_tasks:
+            await asyncio.sleep(0)
+        return pool
+
+    pool = asyncio.run(run())
+
+    assert order == ["first", "high", "low"]
+    assert {job.status for job in pool.jobs.values()} == {"complete"}
+
+
+def test_queue_depth_and_cancel(started):
+    order, gates = started
+
+    async def run():
+        broker = EventBroker()
+        pool = WorkerPool(size=0, concurrency=1, max_queue=1, broker=broker)
+        pool.start()
+        pool.submit("running", {})
+        pool.submit("queued", {})
+        # submitting the same run again doesn't queue it twice
+        assert pool.submit("queued", {}).status == "queued"
+        with pytest.raises(QueueFullError):
+            pool.submit("refused", {})
+        pool.cancel("queued")
+        pool.cancel("running")
+        while pool.local_tasks:
+            await asyncio.sleep(0)
+        return pool, broker
+
+    pool, broker = asyncio.run(run())
+
+    assert pool.jobs["queued"].status == "cancelled"
+    assert pool.jobs["running"].status == "cancelled"
+    assert not broker.live("queued")
+    assert "queued" not in order
@@ -0,0 +1,263 @@
+# --------------------------------------------------------------------------------
+# File : tokens.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Token counting, context windows, usage and per run budgets.
+# Purp : Prompts are counted before they are sent so they can be trimmed to
+#        the model window instead of failing after a round trip, the usage
+#        reported by each provider is read into one shape, and a run stops
+#        cleanly once it has spent its token budget.
+# --------------------------------------------------------------------------------
+
+import os
+
+from typing import Optional
+from contextvars import ContextVar
+
+from ratelimit import estimate_tokens
+
+
+TOKENIZER = os.environ.get('TOKENIZER', 'cl100k_base')
+
+# longest match wins, iGPT serves gpt-4-turbo
+CONTEXT_WINDOWS = {
+    "claude": 200000,
+    "gemini-1.0": 30720,
+    "gemini-pro": 30720,
+    "gemini-1.5": 1000000,
+    "gemini": 1000000,
+    "igpt": 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 128000
+
+# room left for the role and message framing the prompt doesn't include
+PROMPT_OVERHEAD = 64
+MIN_OUTPUT_TOKENS = 256
+
+
+class BudgetExceededError(RuntimeError):
+    pass
+
+
+# --------------------------------------------------------------------------------
+# Counting, the tokenizer is loaded on first use. No provider ships an offline
+# tokenizer for its current models, cl100k is close enough for budgeting and
+# the chars / 4 estimate is used when tiktoken or its encoding isn't available
+# --------------------------------------------------------------------------------
+
+
+_encoding = None
+
+
+def get_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(TOKENIZER)
+        except Exception:
+            _encoding = False
+    return _encoding
+
+
+def count_tokens(text: str):
+    encoding = get_encoding()
+    if not encoding:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def context_window(model_name: str):
+    matches = [prefix for prefix in CONTEXT_WINDOWS if prefix in model_name]
+    if not matches:
+        return DEFAULT_CONTEXT_WINDOW
+    return CONTEXT_WINDOWS[max(matches, key=len)]
+
+
+def truncate_to_tokens(text: str, max_tokens: int):
+    '''
+    Keep the start and the end of text within max_tokens
+    '''
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    marker = "\n\n... [trimmed to fit the context window] ...\n\n"
+    chars = len(text) * max_tokens // count_tokens(text)
+    while chars > 0:
+        half = chars // 2
+        trimmed = f"{text[:half]}{marker}{text[-half:]}" if half else marker
+        if count_tokens(trimmed) <= max_tokens:
+            return trimmed
+        chars = int(chars * 0.9)
+    return ""
+
+
+def tail_tokens(text: str, max_tokens: int):
+    '''
+    The last max_tokens of text, started on a line boundary when there is one
+    '''
+    encoding = get_encoding()
+    if encoding:
+        ids = encoding.encode(text, disallowed_special=())
+        if len(ids) <= max_tokens:
+            return text
+        tail = encoding.decode(ids[-max_tokens:])
+    else:
+        if len(text) <= max_tokens * 4:
+            return text
+        tail = text[-max_tokens * 4:]
+    newline = tail.find("\n")
+    if 0 <= newline < len(tail) // 2:
+        tail = tail[newline + 1:]
+    return tail
+
+
+def fit_sections(sections: list[tuple[str, Optional[int]]], max_tokens: int):
+    '''
+    Join the (text, priority) sections of a prompt, trimming the lowest
+    priority sections first until the prompt fits max_tokens. Sections with
+    priority None are never trimmed.
+    '''
+    return "".join(fit_section_texts(sections, max_tokens))
+
+
+def fit_section_texts(sections: list[tuple[str, Optional[int]]], max_tokens: int):
+    '''
+    The texts of the sections after fitting, see fit_sections
+    '''
+    texts = [text for text, _ in sections]
+    counts = [count_tokens(text) for text in texts]
+    excess = sum(counts) - max_tokens
+    order = sorted((i for i, (_, priority) in enumerate(sections) if priority is not None),
+                   key=lambda i: sections[i][1])
+    for i in order:
+        if excess <= 0:
+            break
+        keep = max(counts[i] - excess, 0)
+        texts[i] = truncate_to_tokens(texts[i], keep)
+        excess -= counts[i] - count_tokens(texts[i])
+    return texts
+
+
+def fit_prompt(prompt: str, model_name: str, max_tokens: int):
+    '''
+    (prompt, max_tokens) that fit the model window, the output allowance is
+    reduced first and the middle of the prompt is trimmed after that
+    '''
+    window = context_window(model_name) - PROMPT_OVERHEAD
+    prompt_tokens = count_tokens(prompt)
+    if prompt_tokens + max_tokens <= window:
+        return prompt, max_tokens
+    max_tokens = max(min(max_tokens, window - prompt_tokens), MIN_OUTPUT_TOKENS)
+    return truncate_to_tokens(prompt, window - max_tokens), max_tokens
+
+
+# --------------------------------------------------------------------------------
+# Usage reported by the providers
+#   anthropic : usage.input_tokens / usage.output_tokens
+#   gemini    : usage_metadata.prompt_token_count / candidates_token_count
+#   igpt      : usage['promptTokens'] / usage['completionTokens']
+# anthropic reports prompt cache reads and writes separately from input_tokens
+# --------------------------------------------------------------------------------
+
+
+def normalize_usage(provider: str, usage):
+    '''
+    (input_tokens, output_tokens) from a provider's usage field
+    '''
+    if usage is None:
+        return 0, 0
+    if provider == "anthropic":
+        return usage.input_tokens or 0, usage.output_tokens or 0
+    if provider == "gemini":
+        return (getattr(usage, "prompt_token_count", 0) or 0,
+                getattr(usage, "candidates_token_count", 0) or 0)
+    if provider == "igpt":
+        return usage.get("promptTokens", 0) or 0, usage.get("completionTokens", 0) or 0
+    raise ValueError(f"Unsupported provider: {provider}")
+
+
+def cache_usage(provider: str, usage):
+    '''
+    (cache_read_tokens, cache_write_tokens) of the provider side prompt
+    cache, these are not part of the input tokens
+    '''
+    if usage is None:
+        return 0, 0
+    if provider == "anthropic":
+        return (getattr(usage, "cache_read_input_tokens", 0) or 0,
+                getattr(usage, "cache_creation_input_tokens", 0) or 0)
+    if provider == "gemini":
+        # implicit caching, the cached tokens are counted in the prompt tokens
+        return getattr(usage, "cached_content_token_count", 0) or 0, 0
+    return 0, 0
+
+
+# --------------------------------------------------------------------------------
+# Per run budget, every model call of a run is checked against it before it is
+# sent and charged with its reported usage after. The prompt and the output
+# allowance are held from the check to the charge, so the concurrent calls of a
+# run (planned subtasks, refined files) can't all spend the same tokens.
+# --------------------------------------------------------------------------------
+
+
+class TokenBudget:
+
+    def __init__(self, limit: int = 0, used: int = 0):
+        self.limit = limit
+        self.used = used
+        self.held = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.calls = 0
+
+    def remaining(self):
+        if self.limit <= 0:
+            return None
+        return self.limit - self.used - self.held
+
+    def reserve(self, prompt_tokens: int, max_tokens: int):
+        '''
+        Output allowance for a call of prompt_tokens, capped by what is left.
+        prompt_tokens plus the allowance are held until charge or release.
+        Raises BudgetExceededError when the call can't usefully be made.
+        '''
+        remaining = self.remaining()
+        if remaining is None:
+            return max_tokens
+        allowance = min(max_tokens, remaining - prompt_tokens)
+        if allowance < min(MIN_OUTPUT_TOKENS, max_tokens):
+            raise BudgetExceededError(f"Token budget {self.limit} exhausted, {self.used} used, "
+                                      f"{self.held} held, next call needs {prompt_tokens} prompt tokens")
+        self.held += prompt_tokens + allowance
+        return allowance
+
+    def release(self, held: int):
+        '''
+        Give back what reserve held for a call that was never charged
+        '''
+        self.held -= held
+
+    def charge(self, input_tokens: int, output_tokens: int, held: int = 0):
+        '''
+        Replace what reserve held for the call with its reported usage
+        '''
+        self.held -= held
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        self.used += input_tokens + output_tokens
+        self.calls += 1
+
+    def summary(self):
+        return {"limit": self.limit, "used": self.used, "calls": self.calls,
+                "input_tokens": self.input_tokens, "output_tokens": self.output_tokens}
+
+
+# the budget of the run the current task belongs to
+run_budget = ContextVar("run_budget", default=None)
+
+
+# --------------------------------------------------------------------------------
+# Done :)
+# --------------------------------------------------------------------------------
@@ -0,0 +1,148 @@
+# --------------------------------------------------------------------------------
+# File : tracing.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Hierarchical spans of a run, exported in the Chrome trace format.
+# Purp : The run log says what happened but not where a long run spent its
+#        time. The loop and its callees open spans for the orchestrator,
+#        search, subagent, continuation, refiner, extraction and rate limit
+#        sleeps. The trace goes into the output zip next to exec_log.html and
+#        loads in the timeline page, chrome://tracing or Perfetto.
+# --------------------------------------------------------------------------------
+
+import json
+import time
+import asyncio
+import functools
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+class Span:
+
+    def __init__(self, tracer: "Tracer", name: str, cat: str, parent, lane: int, args: dict):
+        self.tracer = tracer
+        self.id = len(tracer.spans) + 1
+        self.name = name
+        self.cat = cat
+        self.parent = parent
+        self.lane = lane
+        self.args = args
+        self.start = time.monotonic()
+        self.end = None
+
+    def annotate(self, **args):
+        self.args.update(args)
+
+
+class Tracer:
+    '''
+    The spans of one run. Spans opened by concurrent tasks go in separate
+    lanes (Chrome trace tids) so every lane nests properly.
+    '''
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.spans = []
+        self.origin = time.monotonic()
+        self.wall_origin = time.time()
+        self.lanes = {}
+
+    def lane(self):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        return self.lanes.setdefault(id(task), len(self.lanes) + 1)
+
+    def open(self, name: str, cat: str, parent: Span, args: dict):
+        span = Span(self, name, cat, parent, self.lane(), args)
+        self.spans.append(span)
+        return span
+
+    def export(self):
+        '''
+        Chrome trace events, spans still open are cut at the time of export
+        '''
+        now = time.monotonic()
+        events = []
+        for span in self.spans:
+            end = span.end if span.end is not None else now
+            args = {"span_id": span.id, **span.args}
+            if span.parent is not None:
+                args["parent_id"] = span.parent.id
+            if span.end is None:
+                args["open"] = True
+            events.append({"name": span.name, "cat": span.cat, "ph": "X", "pid": 1, "tid": span.lane,
+                           "ts": round((span.start - self.origin) * 1e6), "dur": round((end - span.start) * 1e6),
+                           "args": args})
+        return {"traceEvents": events, "displayTimeUnit": "ms",
+                "otherData": {"start_time": self.wall_origin}}
+
+    def dumps(self):
+        return json.dumps(self.export(), default=str)
+
+    def save(self):
+        if self.path is not None:
+            with open(self.path, "w") as f:
+                f.write(self.dumps())
+
+
+# the tracer of the run and the innermost open span of the current task
+run_tracer = ContextVar("run_tracer", default=None)
+current_span = ContextVar("current_span", default=None)
+
+
+@contextmanager
+def span(name: str, cat: str = None, **args):
+    '''
+    Time the block as a child of the current span, a no-op outside a traced run
+    '''
+    tracer = run_tracer.get()
+    if tracer is None:
+        yield None
+        return
+    opened = tracer.open(name, cat or name, current_span.get(), args)
+    token = current_span.set(opened)
+    try:
+        yield opened
+    except BaseException as e:
+        opened.annotate(error=repr(e))
+        raise
+    finally:
+        opened.end = time.monotonic()
+        current_span.reset(token)
+
+
+def traced(name: str, cat: str = None):
+    '''
+    Decorator, runs the whole (async or plain) function in a span
+    '''
+    def decorate(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with span(name, cat):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with span(name, cat):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def annotate(**args):
+    '''
+    Add attributes to the current span
+    '''
+    opened = current_span.get()
+    if opened is not None:
+        opened.annotate(**args)
+
+
+# --------------------------------------------------------------------------------
+# Done :)
+# --------------------------------------------------------------------------------
@@ -0,0 +1,367 @@
+# --------------------------------------------------------------------------------
+# File : workers.py
+# Auth : Dan Gilbert
+# Date : 10/17/2026
+# Desc : Pool of pre-warmed worker processes that run the orchestrator loops.
+# Purp : The worker processes import the providers once at startup and each
+#        runs many agents as tasks on its own event loop, so a run submission
+#        only queues a job. The server keeps the priority queue, hands jobs to
+#        workers with free slots and relays their events to the broker.
+#        AGENT_WORKERS=0 runs the agents as tasks in the server process.
+# --------------------------------------------------------------------------------
+
+import os
+import time
+import heapq
+import asyncio
+import threading
+import multiprocessing
+
+from typing import Optional
+
+from pydantic import BaseModel
+from rich.console import Console
+
+from events import RunEvents, RunLog, event_broker
+
+
+WORKER_POOL_SIZE = int(os.environ.get('AGENT_WORKERS', 2))
+WORKER_CONCURRENCY = int(os.environ.get('AGENT_WORKER_CONCURRENCY', 8))
+WORKER_QUEUE_DEPTH = int(os.environ.get('AGENT_QUEUE_DEPTH', 100))
+WORKER_MONITOR_TICK = 2.0
+FINISHED_JOBS_KEPT = 1000
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+class JobStatus(BaseModel):
+    id: str
+    priority: int = 0
+    status: str = "queued"
+    worker: Optional[int] = None
+    submitted: float
+    started: Optional[float] = None
+    finished: Optional[float] = None
+
+
+# --------------------------------------------------------------------------------
+# Running one agent, in a worker process or in the server
+# --------------------------------------------------------------------------------
+
+
+class RelayBroker:
+    '''
+    Stands in for the event broker inside a worker, every event goes back to
+    the server which publishes it to the viewers
+    '''
+
+    def __init__(self, outbox: multiprocessing.Queue):
+        self.outbox = outbox
+
+    def open(self, run_id: str):
+        pass
+
+    def publish(self, run_id: str, event: dict):
+        self.outbox.put(("event", run_id, event))
+
+
+async def run_job(run_id: str, agent_data: dict, broker):
+    from orchestrator import AgentConfig, run_orchestrator_loop_async
+    from checkpoints import checkpoint_store, RUN_CHECKPOINTS
+    from tracing import Tracer
+
+    filepath = f"logs/run_orch_loop_{run_id}.log"
+    events = RunEvents(f"logs/run_orch_loop_{run_id}.events", run_id=run_id, broker=broker)
+    console = Console(file=RunLog(filepath, events), record=True, width=80)
+    status = "complete"
+    try:
+        agent = AgentConfig(**agent_data)
+        await run_orchestrator_loop_async(agent, console, events=events,
+                                          checkpoint=checkpoint_store if RUN_CHECKPOINTS else None,
+                                          tracer=Tracer(f"logs/run_orch_loop_{run_id}.trace.json"))
+    except asyncio.CancelledError:
+        status = "cancelled"
+    except Exception as e:
+        status = "failed"
+        console.print(f"\n[bold red]Orchestrator loop failed {e!r}[/bold red]")
+    events.emit("done", status=status)
+    events.close()
+    return status
+
+
+# --------------------------------------------------------------------------------
+# Worker process, imports everything once then runs jobs until told to stop
+# --------------------------------------------------------------------------------
+
+
+def worker_main(worker_idx: int, inbox: multiprocessing.Queue, outbox: multiprocessing.Queue,
+                pool_size: int = 1):
+    # pre-warm, the provider SDKs and clients load before the first job
+    # imported only so the first job doesn't pay for the import
+    import orchestrator  # noqa: F401
+    from agents import providers
+    from ratelimit import rate_limiter
+    providers.warm()
+    # every worker has its own limiter, the provider quotas are split between them
+    rate_limiter.share(pool_size)
+    asyncio.run(worker_loop(worker_idx, inbox, outbox))
+
+
+async def worker_loop(worker_idx: int, inbox: multiprocessing.Queue, outbox: multiprocessing.Queue):
+    broker = RelayBroker(outbox)
+    tasks = {}
+
+    async def run_and_report(run_id, agent_data):
+        status = await run_job(run_id, agent_data, broker)
+        del tasks[run_id]
+        outbox.put(("finished", worker_idx, run_id, status))
+
+    outbox.put(("ready", worker_idx, os.getpid()))
+    while True:
+        message = await asyncio.to_thread(inbox.get)
+        if message[0] == "run":
+            _, run_id, agent_data = message
+            tasks[run_id] = asyncio.create_task(run_and_report(run_id, agent_data))
+        elif message[0] == "cancel":
+            if message[1] in tasks:
+                tasks[message[1]].cancel()
+        elif message[0] == "stop":
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            break
+
+
+# --------------------------------------------------------------------------------
+# The pool, lives in the server process and is only touched on its event loop
+# --------------------------------------------------------------------------------
+
+
+class Worker:
+
+    def __init__(self, idx: int, context):
+        self.idx = idx
+        self.inbox = context.Queue()
+        self.process = None
+        self.pid = None
+        self.ready = False
+        self.running = set()
+
+
+class WorkerPool:
+
+    def __init__(self, size: int = WORKER_POOL_SIZE,
+                 concurrency: int = WORKER_CONCURRENCY,
+                 max_queue: int = WORKER_QUEUE_DEPTH,
+                 broker=event_broker):
+        self.size = size
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.broker = broker
+        self.jobs = {}
+        self.queue = []
+        self.agents = {}
+        self.local_tasks = {}
+        self.workers = []
+        self._seq = 0
+        self._loop = None
+        self._context = multiprocessing.get_context("spawn")
+        self._outbox = None
+        self._relay = None
+        self._monitor = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        if self.size <= 0:
+            return
+        self._outbox = self._context.Queue()
+        self.workers = [Worker(idx, self._context) for idx in range(self.size)]
+        for worker in self.workers:
+            self.spawn(worker)
+        self._relay = threading.Thread(target=self.relay, daemon=True)
+        self._relay.start()
+        self._monitor = asyncio.create_task(self.monitor())
+
+    def spawn(self, worker: Worker):
+        worker.ready = False
+        worker.process = self._context.Process(target=worker_main, daemon=True,
+                                               args=(worker.idx, worker.inbox, self._outbox, self.size))
+        worker.process.start()
+
+    async def stop(self):
+        if self._monitor is not None:
+            self._monitor.cancel()
+        for task in self.local_tasks.values():
+            task.cancel()
+        for worker in self.workers:
+            worker.inbox.put(("stop",))
+        for worker in self.workers:
+            await asyncio.to_thread(worker.process.join, 10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        if self._outbox is not None:
+            self._outbox.put(None)
+
+    # ----------------------------------------------------------------------------
+    # Submitting and cancelling
+    # ----------------------------------------------------------------------------
+
+    def submit(self, run_id: str, agent_data: dict, priority: int = 0):
+        '''
+        Queue a run, higher priority goes first. A run that is already
+        queued or running is not submitted twice.
+        '''
+        job = self.jobs.get(run_id)
+        if job is not None and job.status in ("queued", "running"):
+            return job
+        if len(self.queue) >= self.max_queue:
+            raise QueueFullError(f"{len(self.queue)} runs already queued")
+
+        job = JobStatus(id=run_id, priority=priority, submitted=time.time())
+        self.jobs[run_id] = job
+        self.agents[run_id] = agent_data
+        self._seq += 1
+        heapq.heappush(self.queue, (-priority, self._seq, run_id))
+        # viewers that connect before the run starts get every event
+        self.broker.open(run_id)
+        self.dispatch()
+        return job
+
+    def cancel(self, run_id: str):
+        job = self.jobs.get(run_id)
+        if job is None:
+            return
+        if job.status == "queued":
+            self.queue = [entry for entry in self.queue if entry[2] != run_id]
+            heapq.heapify(self.queue)
+            self.finish(run_id, "cancelled")
+            self.broker.publish(run_id, {"event": "done", "status": "cancelled"})
+        elif job.status == "running":
+            if run_id in self.local_tasks:
+                self.local_tasks[run_id].cancel()
+            else:
+                self.workers[job.worker].inbox.put(("cancel", run_id))
+
+    # ----------------------------------------------------------------------------
+    # Dispatching to free slots
+    # ----------------------------------------------------------------------------
+
+    def dispatch(self):
+        while self.queue:
+            worker = self.free_worker()
+            if worker is None:
+                return
+            _, _, run_id = heapq.heappop(self.queue)
+            job = self.jobs[run_id]
+            job.status = "running"
+            job.started = time.time()
+            agent_data = self.agents.pop(run_id)
+            if worker == "local":
+                task = asyncio.create_task(run_job(run_id, agent_data, self.broker))
+                task.add_done_callback(lambda task, run_id=run_id: self.finish_local(run_id, task))
+                self.local_tasks[run_id] = task
+            else:
+                job.worker = worker.idx
+                worker.running.add(run_id)
+                worker.inbox.put(("run", run_id, agent_data))
+
+    def free_worker(self):
+        if self.size <= 0:
+            return "local" if len(self.local_tasks) < self.concurrency else None
+        ready = [w for w in self.workers if w.ready and len(w.running) < self.concurrency]
+        if not ready:
+            return None
+        return min(ready, key=lambda w: len(w.running))
+
+    def finish_local(self, run_id: str, task: asyncio.Task):
+        del self.local_tasks[run_id]
+        self.finish(run_id, "cancelled" if task.cancelled() else task.result())
+        self.dispatch()
+
+    def finish(self, run_id: str, status: str):
+        job = self.jobs[run_id]
+        job.status = status
+        job.finished = time.time()
+        self.agents.pop(run_id, None)
+        finished = [j for j in self.jobs.values() if j.finished is not None]
+        for job in sorted(finished, key=lambda j: j.finished)[:-FINISHED_JOBS_KEPT]:
+            del self.jobs[job.id]
+
+    # ----------------------------------------------------------------------------
+    # Messages from the workers, read on a thread and handled on the loop
+    # ----------------------------------------------------------------------------
+
+    def relay(self):
+        while True:
+            message = self._outbox.get()
+            if message is None:
+                break
+            self._loop.call_soon_threadsafe(self.handle, message)
+
+    def handle(self, message: tuple):
+        if message[0] == "event":
+            _, run_id, event = message
+            self.broker.publish(run_id, event)
+        elif message[0] == "ready":
+            _, worker_idx, pid = message
+            self.workers[worker_idx].ready = True
+            self.workers[worker_idx].pid = pid
+            self.dispatch()
+        elif message[0] == "finished":
+            _, worker_idx, run_id, status = message
+            self.workers[worker_idx].running.discard(run_id)
+            self.finish(run_id, status)
+            self.dispatch()
+
+    async def monitor(self):
+        '''
+        Restart crashed workers, their runs are reported as failed
+        '''
+        while True:
+            await asyncio.sleep(WORKER_MONITOR_TICK)
+            for worker in self.workers:
+                if worker.process.is_alive():
+                    continue
+                print(f"worker {worker.idx} pid {worker.pid} died, restarting")
+                for run_id in list(worker.running):
+                    self.finish(run_id, "failed")
+                    self.broker.publish(run_id, {"event": "done", "status": "failed"})
+                worker.running.clear()
+                self.spawn(worker)
+
+    # ----------------------------------------------------------------------------
+    # Status for the server
+    # ----------------------------------------------------------------------------
+
+    def status(self):
+        queued = [run_id for _, _, run_id in sorted(self.queue)]
+        return {
+            "size": self.size,
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+            "workers": [{"idx": w.idx, "pid": w.pid, "ready": w.ready,
+                         "alive": w.process.is_alive(), "running": sorted(w.running)}
+                        for w in self.workers],
+            "local": sorted(self.local_tasks),
+            "queued": queued,
+            "jobs": {run_id: job.model_dump() for run_id, job in self.jobs.items()},
+        }
+
+    def job_status(self, run_id: str):
+        job = self.jobs.get(run_id)
+        if job is None:
+            return None
+        status = job.model_dump()
+        if job.status == "queued":
+            status["position"] = [entry[2] for entry in sorted(self.queue)].index(run_id)
+        return status
+
+
+worker_pool = WorkerPool()
+
+
+# --------------------------------------------------------------------------------
+# Done :)
+# --------------------------------------------------------------------------------